@@ -8,10 +8,11 @@ from pprint import pprint
 
 import uvicorn
 from prisma import Prisma
-from fastapi import FastAPI, Body
+from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.db.prisma_client import prisma
+from app.redis.client import init_redis, close_redis
 from app.routers.slack import events, interactions, oauth
 from app.routers.zendesk import zendesk_guide
 from app.utils.gpt import (
@@ -19,8 +20,13 @@ from app.utils.gpt import (
     generate_context_array,
     generate_gpt_chat_response,
     continue_chat_response,
+    count_context_tokens,
 )
-from app.utils.helpers import get_dataframe_from_csv
+from app.utils.issue_writer import issue_writer
+from app.utils.llm import llm_client
+from app.utils.embedding_store import load_csv_knowledge_base
+from app.utils.retrieval import LocalBackend, DEFAULT_NAMESPACE
+from app.utils.slack import close_slack_clients
 from app.utils.types import ChatPayload
 from celery.result import AsyncResult
 import app.worker as worker
@@ -61,11 +67,21 @@ api.include_router(zendesk_guide.router, prefix="/zendesk", tags=["zendesk", "kn
 @api.on_event("startup")
 async def startup():
     await prisma.connect()
+    await init_redis()
+    await llm_client.start()
+    await issue_writer.start()
+    if events.SLACK_EVENT_QUEUE:
+        await events.slack_event_queue.start()
 
 
 @api.on_event("shutdown")
 async def shutdown():
+    await events.slack_event_queue.close()
+    await issue_writer.close()
     await prisma.disconnect()
+    await llm_client.close()
+    await close_slack_clients()
+    await close_redis()
 
 
 @api.get("/")
@@ -78,15 +94,9 @@ def get_cwd():
     return {"cwd": os.getcwd()}
 
 
-@api.post("/tasks", status_code=201)
-def run_task(payload=Body(...)):
-    task = worker.create_task.delay(payload["id"], payload["ttl"])
-    return JSONResponse({"task_id": task.id, "convo_id": payload["id"]})
-
-
 @api.get("/tasks/{task_id}")
 def get_status(task_id):
-    task_result = AsyncResult(task_id)
+    task_result = AsyncResult(task_id, app=worker.celery)
     result = {
         "task_id": task_id,
         "task_status": task_result.status,
@@ -107,10 +117,10 @@ async def test_prisma():
 @api.post("/api/v1/generate-chat-response")
 async def chat(payload: ChatPayload):
     pprint(payload)
-    # download knowledge base embeddings from csv
-    knowledge_base = get_dataframe_from_csv(f"{os.getcwd()}/app/data", "zendesk_vector_embeddings.csv")
+    # open the memory-mapped knowledge base store built from the csv (converted once on first use)
+    knowledge_base = load_csv_knowledge_base(f"{os.getcwd()}/app/data/zendesk_vector_embeddings.csv")
     # create query embedding and fetch relatedness between query and knowledge base in dataframe
-    similarities = await get_similarities(payload.query, knowledge_base, "csv")
+    similarities = await get_similarities(payload.query, LocalBackend({DEFAULT_NAMESPACE: knowledge_base}))
     # Combine all top n answers into one chunk of text to use as knowledge base context for GPT
     context = generate_context_array(similarities)
     print(context.split("\n"))
@@ -121,7 +131,9 @@ async def chat(payload: ChatPayload):
         is_question = "?" in payload.query
         response, messages = await continue_chat_response(payload.query, context, payload.history, is_question)
     else:
-        response, messages = await generate_gpt_chat_response(payload.query, context, payload.name, payload.company)
+        response, messages = await generate_gpt_chat_response(
+            payload.query, context, payload.name, payload.company, context_tokens=count_context_tokens(similarities)
+        )
     print(response)
     return {"reply": response, "messages": messages}
 
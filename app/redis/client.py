@@ -1,7 +1,7 @@
 import os
-from pprint import pprint
 
 import redis
+import redis.asyncio as aioredis
 
 HOST = os.environ.get('REDIS_HOST', 'localhost')
 PORT = int(os.environ.get('REDIS_PORT', 6379))
@@ -9,9 +9,24 @@ DB = int(os.environ.get('REDIS_DB', 0))
 USERNAME = os.environ.get('REDIS_USERNAME', None)
 PASSWORD = os.environ.get('REDIS_PASSWORD', None)
 SOCKET_TIMEOUT = os.environ.get('REDIS_SOCKET_TIMEOUT', None)
+MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 32))
+HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+
+
+def _connection_kwargs(host, port, db, username, password, socket_timeout):
+    kwargs = {
+        "max_connections": MAX_CONNECTIONS,
+        "health_check_interval": HEALTH_CHECK_INTERVAL,
+        "socket_timeout": float(socket_timeout) if socket_timeout else None,
+    }
+    if username or password:
+        return f"rediss://{username}:{password}@{host}:{port}", kwargs
+    return f"redis://{host}:{port}/{db}", kwargs
 
 
 class Redis(object):
+    """Async Redis client. One instance, and so one bounded connection pool, is shared by the whole process."""
+
     def __init__(
             self,
             host=HOST,
@@ -22,13 +37,53 @@ class Redis(object):
             socket_timeout=SOCKET_TIMEOUT
     ):
         # Set up Redis client
-        if USERNAME or PASSWORD:
-            redis_url = f"rediss://{username}:{password}@{host}:{port}"
-            pool = redis.ConnectionPool.from_url(redis_url)
-            self.__redis = redis.StrictRedis(connection_pool=pool, decode_responses=True, ssl=True)
-        else:
-            pool = redis.ConnectionPool(host=host, port=port, db=db)
-            self.__redis = redis.Redis(connection_pool=pool)
+        url, kwargs = _connection_kwargs(host, port, db, username, password, socket_timeout)
+        self.__redis = aioredis.from_url(url, **kwargs)
+
+    @property
+    def client(self) -> aioredis.Redis:
+        return self.__redis
+
+    async def add_to_cache(self, key, value, ttl):
+        await self.__redis.setex(key, ttl, value=value)
+
+    async def get_ttl(self, key):
+        return await self.__redis.ttl(key)
+
+    async def get_value(self, key):
+        return await self.__redis.get(key)
+
+    async def delete_key(self, key):
+        await self.__redis.delete(key)
+
+    async def increment(self, key):
+        return await self.__redis.incr(key)
+
+    async def ping(self):
+        return await self.__redis.ping()
+
+    async def close(self):
+        await self.__redis.close(close_connection_pool=True)
+
+
+class SyncRedis(object):
+    """Blocking twin of `Redis` with the same surface, for Celery tasks which run outside an event loop."""
+
+    def __init__(
+            self,
+            host=HOST,
+            port=PORT,
+            db=DB,
+            username=USERNAME,
+            password=PASSWORD,
+            socket_timeout=SOCKET_TIMEOUT
+    ):
+        url, kwargs = _connection_kwargs(host, port, db, username, password, socket_timeout)
+        self.__redis = redis.Redis.from_url(url, **kwargs)
+
+    @property
+    def client(self) -> redis.Redis:
+        return self.__redis
 
     def add_to_cache(self, key, value, ttl):
         self.__redis.setex(key, ttl, value=value)
@@ -41,3 +96,56 @@ class Redis(object):
 
     def delete_key(self, key):
         self.__redis.delete(key)
+
+    def increment(self, key):
+        return self.__redis.incr(key)
+
+    def close(self):
+        self.__redis.close()
+        self.__redis.connection_pool.disconnect()
+
+
+_redis: Redis | None = None
+_sync_redis: SyncRedis | None = None
+
+
+async def init_redis() -> Redis:
+    """Creates the process-wide async client and checks the connection, called on FastAPI startup"""
+    global _redis
+    if _redis is None:
+        _redis = Redis()
+    await _redis.ping()
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.close()
+    _redis = None
+
+
+def get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis()
+    return _redis
+
+
+def init_sync_redis() -> SyncRedis:
+    """Creates the process-wide blocking client, called when a Celery worker process starts"""
+    global _sync_redis
+    if _sync_redis is None:
+        _sync_redis = SyncRedis()
+    return _sync_redis
+
+
+def close_sync_redis():
+    global _sync_redis
+    if _sync_redis is not None:
+        _sync_redis.close()
+    _sync_redis = None
+
+
+def get_sync_redis() -> SyncRedis:
+    return init_sync_redis()
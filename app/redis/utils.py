@@ -1,16 +1,105 @@
-from pprint import pprint
+import os
+from contextlib import asynccontextmanager
 from pprint import pprint
 from typing import Literal, List, Dict
 
-from celery.result import AsyncResult
 from prisma.models import Organization
 from redis.exceptions import ResponseError, RedisError
-from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
 
-from app.db.prisma_client import prisma
+from app.redis.client import get_redis
+from app.utils.codec import decode_messages, encode_messages, encode_messages_text
+from app.utils.helpers import ONE_HOUR_IN_SECONDS
+from app.utils.issue_writer import issue_writer
 from app.utils.slack import get_conversation_id
 from app.utils.types import Profile
 
+# slack retries an event up to three times within a few minutes, so an event id only needs remembering for an hour
+SLACK_EVENT_TTL = int(os.environ.get("SLACK_EVENT_TTL", ONE_HOUR_IN_SECONDS))
+# a reply can take over a minute to generate, the lock expires on its own if its holder dies
+CONVERSATION_LOCK_TIMEOUT = float(os.environ.get("CONVERSATION_LOCK_TIMEOUT", 180))
+CONVERSATION_LOCK_WAIT = float(os.environ.get("CONVERSATION_LOCK_WAIT", 180))
+
+
+async def get_conversation(conversation_id: str) -> List[Dict[str, str]] | None:
+    """Reads the GPT conversation history cached for a conversation, if it has not expired"""
+    byte_result = await get_redis().get_value(conversation_id)
+    if not byte_result:
+        return None
+    return decode_messages(byte_result)
+
+
+def transcript_key(conversation_id: str) -> str:
+    return f"transcript:{conversation_id}"
+
+
+async def get_transcript(conversation_id: str) -> List[Dict[str, str]] | None:
+    """
+    Reads every turn of a conversation. Unlike the cached history, which is trimmed and summarised to fit the prompt,
+    the transcript is never compacted, it is what gets written to the conversation's issue.
+    """
+    return await get_conversation(transcript_key(conversation_id))
+
+
+async def cache_conversation(conversation_id: str, messages: List[Dict[str, str]], ttl: int = ONE_HOUR_IN_SECONDS):
+    await get_redis().add_to_cache(conversation_id, encode_messages(messages), ttl)
+
+
+async def replace_conversation(conversation_id: str, messages: List[Dict[str, str]]):
+    """Overwrites the cached history without extending the conversation's remaining lifetime"""
+    ttl = await get_redis().get_ttl(conversation_id)
+    if ttl and ttl > 0:
+        await cache_conversation(conversation_id, messages, ttl)
+
+
+async def claim_event(event_id: str, ttl: int = SLACK_EVENT_TTL) -> bool:
+    """
+    Marks a Slack event as seen. Returns False if the event was already claimed, i.e. it is a retry or a redelivery
+    that must not be processed again. Fails open so that a redis outage does not drop events.
+    """
+    try:
+        return bool(await get_redis().client.set(f"slack_event:{event_id}", 1, nx=True, ex=ttl))
+    except (ResponseError, RedisError) as e:
+        print(f"Redis Error: {e}")
+        return True
+
+
+async def release_event(event_id: str):
+    """Forgets a claimed Slack event that could not be queued, so that Slack's retry of it is processed"""
+    try:
+        await get_redis().client.delete(f"slack_event:{event_id}")
+    except (ResponseError, RedisError) as e:
+        print(f"Redis Error: {e}")
+
+
+@asynccontextmanager
+async def conversation_lock(conversation_key: str):
+    """
+    Holds the in-flight lock of a conversation so that messages in one thread are answered one after another instead
+    of racing on the cached history. If the lock cannot be taken in time the message is processed anyway.
+    """
+    lock = get_redis().client.lock(
+        f"conversation_lock:{conversation_key}",
+        timeout=CONVERSATION_LOCK_TIMEOUT,
+        blocking_timeout=CONVERSATION_LOCK_WAIT,
+    )
+    acquired = False
+    try:
+        acquired = await lock.acquire()
+    except (ResponseError, RedisError) as e:
+        print(f"Redis Error: {e}")
+    if not acquired:
+        print(f"Processing conversation {conversation_key} without its lock")
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                await lock.release()
+            except (ResponseError, RedisError) as e:
+                # the lock expired while the reply was being generated
+                print(f"Redis Error: {e}")
+
 
 async def update_issue(
     conversation_id: str,
@@ -21,32 +110,18 @@ async def update_issue(
     category: str,
     messages: List[Dict[str, str]]
 ):
-    # fetch the latest open issue with matching conversation_id
-    issues = await prisma.issue.find_many(
-        where={"conversation_id": conversation_id, "status": "open"},
-        order={"created_at": "desc"},
-        take=1
-    )
-    # revoke the previous celery task if it exists
-    if len(issues) and issues[0].celery_task_id:
-        print(f"Previous celery task ID: {issues[0].celery_task_id}")
-        task = AsyncResult(issues[0].celery_task_id)
-        task.revoke(terminate=True, signal="SIGKILL")
-        # issue already exists, locate issue in DB and update accordingly
-        return await prisma.issue.update(
-            where={"id": issues[0].id},
-            data={
-                "issue_id": issue_id,
-                "celery_task_id": task_id,
-                "employee_id": employee_id,
-                "employee_name": slack_profile.name,
-                "employee_email": slack_profile.email,
-                "category": category,
-                "messageHistory": str(messages),
-                "status": "open"
-            },
-        )
-    return None
+    """Queues a turn that updates the conversation's latest open issue, written to the DB by the issue writer"""
+    await issue_writer.record({
+        "kind": "update",
+        "conversation_id": conversation_id,
+        "issue_id": issue_id,
+        "celery_task_id": task_id,
+        "employee_id": employee_id,
+        "employee_name": slack_profile.name,
+        "employee_email": slack_profile.email,
+        "category": category,
+        "messages": encode_messages_text(messages),
+    })
 
 
 async def create_issue(
@@ -59,35 +134,32 @@ async def create_issue(
         category: str,
         messages: List[Dict[str, str]]
 ):
-    return await prisma.issue.create(
-        data={
-            "issue_id": issue_id,
-            "conversation_id": conversation_id,
-            "celery_task_id": task_id,
-            "org_id": org.clerk_id,
-            "org_name": org.name,
-            "channel": "slack",
-            "employee_id": employee_id,
-            "employee_name": slack_profile.name,
-            "employee_email": slack_profile.email,
-            "category": category,
-            "messageHistory": str(messages),
-            "status": "open",
-            "is_satisfied": False,
-        }
-    )
+    """Queues the first turn of a conversation, which creates its issue once the issue writer flushes it"""
+    await issue_writer.record({
+        "kind": "create",
+        "conversation_id": conversation_id,
+        "issue_id": issue_id,
+        "celery_task_id": task_id,
+        "org_id": org.clerk_id,
+        "org_name": org.name,
+        "employee_id": employee_id,
+        "employee_name": slack_profile.name,
+        "employee_email": slack_profile.email,
+        "category": category,
+        "messages": encode_messages_text(messages),
+    })
 
 
-def generate_conversation_id(
+async def generate_conversation_id(
         channel_type: Literal["DM_REPLY", "DM_MESSAGE", "CHANNEL_MENTION_REPLY"],
         last_message,
-        client: WebClient,
-        history: List[Dict[str, str]]
+        client: AsyncWebClient,
+        history: List[Dict[str, str]],
+        bot_id: str
 ):
     try:
-        bot_id = client.auth_test()['bot_id']
         if channel_type == "CHANNEL_MENTION_REPLY" or channel_type == "DM_REPLY":
-            root_message_id = get_conversation_id(
+            root_message_id = await get_conversation_id(
                 last_message["channel"],
                 last_message["message"]["thread_ts"],
                 client
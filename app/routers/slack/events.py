@@ -1,23 +1,36 @@
+import asyncio
 import json
 import logging
 import os
-import time
+import uuid
 from pprint import pprint
-from typing import Callable, Literal
+from typing import Callable, Dict, Literal
 
-from celery.result import AsyncResult
-from app.db.prisma_client import prisma
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Response
 from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
 from slack_bolt.app.async_app import AsyncApp
 from slack_bolt.async_app import AsyncSay
 from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
-from slack_sdk import WebClient
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_bolt.response import BoltResponse
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.oauth.installation_store import FileInstallationStore
 from slack_sdk.oauth.state_store import FileOAuthStateStore
+from slack_sdk.signature import SignatureVerifier
 
-from app.redis.client import Redis
-from app.redis.utils import generate_conversation_id, create_issue, update_issue
+from app.redis.utils import (
+    generate_conversation_id,
+    create_issue,
+    update_issue,
+    get_conversation,
+    get_transcript,
+    transcript_key,
+    cache_conversation,
+    replace_conversation,
+    claim_event,
+    release_event,
+    conversation_lock,
+)
 from app.utils.gpt import (
     get_similarities,
     generate_context_array,
@@ -25,21 +38,32 @@ from app.utils.gpt import (
     generate_gpt_chat_response,
     send_zendesk_ticket,
     classify_issue,
+    count_context_tokens,
+    embed_query,
 )
 from app.utils.helpers import (
     remove_custom_delimiters,
     check_reply_requires_action,
     check_can_create_ticket,
-    get_vector_embeddings_from_pinecone, ONE_HOUR_IN_SECONDS, border_asterisk,
+    ONE_HOUR_IN_SECONDS, border_asterisk,
 )
+from app.utils.event_queue import EventQueue
+from app.utils.memory import conversation_memory, append_turns
+from app.utils.tenant import get_tenant
+from app.utils.timer import StageTimings
+from app.utils.retrieval import get_retrieval_backend
 from app.utils.slack import (
     display_support_dialog,
     get_user_from_event,
     get_profile_from_id,
     fetch_access_token,
     installation_base_dir,
+    StreamingMessage,
+    abandon_reply,
+    get_slack_client,
+    get_bot_identity,
 )
-from app.worker import create_task
+from app.worker import schedule_follow_up
 
 router = APIRouter()
 
@@ -49,6 +73,13 @@ SLACK_SIGNING_SECRET = os.environ["SLACK_SIGNING_SECRET"]
 SLACK_CLIENT_ID = os.environ["SLACK_CLIENT_ID"]
 SLACK_CLIENT_SECRET = os.environ["SLACK_CLIENT_SECRET"]
 SLACK_APP_SCOPES = os.environ["SLACK_APP_SCOPES"].split(",")
+SLACK_STREAM_REPLIES = os.environ.get("SLACK_STREAM_REPLIES", "true").lower() == "true"
+# acknowledge events as soon as they are verified and queued, Slack retries any event not acknowledged within 3 seconds
+SLACK_EVENT_QUEUE = os.environ.get("SLACK_EVENT_QUEUE", "true").lower() == "true"
+# only the headers bolt reads are kept with a queued event
+QUEUED_HEADERS = (
+    "content-type", "x-slack-request-timestamp", "x-slack-signature", "x-slack-retry-num", "x-slack-retry-reason"
+)
 
 
 oauth_settings = AsyncOAuthSettings(
@@ -62,85 +93,134 @@ oauth_settings = AsyncOAuthSettings(
 )
 
 # Event API & Web API
-app = AsyncApp(oauth_settings=oauth_settings, signing_secret=SLACK_SIGNING_SECRET)
+# queued events are verified on intake and may be processed after the signature timestamp has gone stale, and their
+# listeners are awaited so that a queued event is acknowledged only once it has been handled
+app = AsyncApp(
+    oauth_settings=oauth_settings,
+    signing_secret=SLACK_SIGNING_SECRET,
+    process_before_response=SLACK_EVENT_QUEUE,
+    request_verification_enabled=not SLACK_EVENT_QUEUE,
+)
 app_handler = AsyncSlackRequestHandler(app)
+signature_verifier = SignatureVerifier(SLACK_SIGNING_SECRET)
+
+
+def conversation_lock_key(event) -> str:
+    """Messages continuing a thread or the app's DM share cached history, a new mention in a channel starts its own"""
+    if event.get("thread_ts") or str(event["channel"]).startswith("D"):
+        return f"{event['team']}:{event.get('thread_ts') or event['channel']}"
+    return f"{event['team']}:{event['ts']}"
 
 
 async def generate_reply(
-    event, client: WebClient, token: str, logger: logging.Logger, reply_in_thread=True
+    event, client: AsyncWebClient, token: str, logger: logging.Logger, reply_in_thread=True
 ):
-    history = []
-    issue_id = None
-    pprint(event)
-    # fetch slack + user info from DB
-    slack = await prisma.slack.find_first(where={"team_id": event["team"]})
-    if slack is None:
-        logger.error(f"Slack not found for team {event['team']}")
-        return "", None, [], None
-    org = await prisma.organization.find_unique(where={"clerk_id": slack.org_id})
-    slack_profile = get_profile_from_id(event["user"], client)
-    logger.debug(org)
-    thread_ts = event.get("thread_ts", None)
+    async with conversation_lock(conversation_lock_key(event)):
+        return await _generate_reply(event, client, token, logger, reply_in_thread)
+
+
+async def get_zendesk_config(team_id: str):
+    tenant = await get_tenant(team_id)
+    return tenant.zendesk if tenant else None
+
+
+async def post_placeholder(event, client: AsyncWebClient, reply_in_thread: bool):
     # initially return a message that Alfred is thinking and store metadata for that message
-    logger.debug(f"IN_THREAD: {reply_in_thread}")
     if reply_in_thread:
-        to_replace = client.chat_postMessage(
+        return await client.chat_postMessage(
             channel=event["channel"],
             thread_ts=event["event_ts"],
             text=f"Alfred is thinking :robot_face:",
         )
-    else:
-        to_replace = client.chat_postMessage(
-            channel=event["channel"], text=f"Alfred is thinking :robot_face:"
-        )
+    return await client.chat_postMessage(channel=event["channel"], text=f"Alfred is thinking :robot_face:")
+
 
-    bot_id = client.auth_test()["bot_id"]
+async def fetch_history(event, client: AsyncWebClient):
+    """Returns the bot's id, the cached history the prompt is built from and the full transcript of the conversation"""
+    bot_id = (await get_bot_identity(event["team"], client)).bot_id
     # check if the message was made inside a thread and not root of channel
-    if thread_ts:
-        conversation_id = f"{bot_id}:{thread_ts}"
-        # check if the GPT conversation history is cached in memory
-        r = Redis()
-        byte_result = r.get_value(conversation_id)
-        if byte_result:
-            str_result = str(byte_result, encoding="utf-8")
-            history = json.loads(str_result)
+    if event.get("thread_ts", None):
+        conversation_id = f"{bot_id}:{event['thread_ts']}"
     # check if the message was made inside alfred chat message tab
     elif str(event["channel"]).startswith("D"):
         conversation_id = f"{bot_id}:{event['channel']}"
-        r = Redis()
-        # check if the GPT conversation history is cached in memory
-        byte_result = r.get_value(conversation_id)
-        if byte_result:
-            str_result = str(byte_result, encoding="utf-8")
-            history = json.loads(str_result)
-
-    sender_name = (await get_user_from_event(event, client))["first_name"]
+    else:
+        return bot_id, [], []
+    # check if the GPT conversation history is cached in memory
+    history, transcript = await asyncio.gather(get_conversation(conversation_id), get_transcript(conversation_id))
+    # a conversation cached before transcripts were kept has not been compacted, so its history is every turn
+    return bot_id, history or [], transcript or history or []
+
+
+async def _generate_reply(
+    event, client: AsyncWebClient, token: str, logger: logging.Logger, reply_in_thread=True
+):
+    issue_id = None
+    pprint(event)
+    thread_ts = event.get("thread_ts", None)
+    logger.debug(f"IN_THREAD: {reply_in_thread}")
     # Extract raw message from the event
     raw_message = str(event["text"])
     # remove any mention tags from the message and sanitize it
     message = remove_custom_delimiters(raw_message).strip()
     print(f"\nMESSAGE:\t {message}")
-    # download knowledge base embeddings from pinecone namespace
-    knowledge_base = get_vector_embeddings_from_pinecone("alfred", org.slug)
-    # create query embedding and fetch relatedness between query and knowledge base in dataframe
-    similarities = await get_similarities(message, knowledge_base)
-    # Combine all top n answers into one chunk of text to use as knowledge base context for GPT
-    context = generate_context_array(similarities)
-    # check if the query is the first question of the conversation
-    if len(history):
-        # check if the message from user was a question or not
-        is_question = "?" in message
-        reply, messages = await continue_chat_response(
-            message, context, history, is_question
+    # none of these lookups depend on each other, so they all run concurrently
+    timings = StageTimings()
+    tenant_task = timings.start("tenant", get_tenant(event["team"]))
+    placeholder_task = timings.start("placeholder", post_placeholder(event, client, reply_in_thread))
+    history_task = timings.start("history", fetch_history(event, client))
+    profile_task = timings.start("profile", get_profile_from_id(event["user"], client))
+    sender_task = timings.start("sender", get_user_from_event(event, client))
+    # the query embedding only needs the message, so it is created while the tenant is being looked up
+    embedding_task = timings.start("embedding", embed_query(message))
+    stages = (tenant_task, history_task, profile_task, sender_task, embedding_task)
+    try:
+        # fetch slack + org info from the tenant cache
+        tenant = await tenant_task
+        if tenant is None:
+            logger.error(f"Slack not found for team {event['team']}")
+            await abandon_reply(client, placeholder_task, stages)
+            return "", None, [], None
+        org = tenant.organization
+        logger.debug(org)
+        # fetch the most related chunks from the org's knowledge base namespace
+        similarities = await timings.run(
+            "retrieval",
+            get_similarities(message, get_retrieval_backend("alfred"), org.slug, question_vector=await embedding_task),
         )
-    else:
-        reply, messages = await generate_gpt_chat_response(
-            message, context, sender_name
+        # Combine all top n answers into one chunk of text to use as knowledge base context for GPT
+        context = generate_context_array(similarities)
+        to_replace, (bot_id, history, transcript), slack_profile, sender = await asyncio.gather(
+            placeholder_task, history_task, profile_task, sender_task
         )
-    print(f"\nREPLY: {reply}")
-    response = client.chat_update(
-        channel=event["channel"], ts=to_replace["message"]["ts"], text=reply
-    )
+        sender_name = sender["first_name"]
+        # stream the reply into the placeholder message as it is generated
+        stream = StreamingMessage(client, event["channel"], to_replace["message"]["ts"], event["team"])
+        on_delta = stream.update if SLACK_STREAM_REPLIES else None
+        # check if the query is the first question of the conversation
+        if len(history):
+            # check if the message from user was a question or not
+            is_question = "?" in message
+            # keep the history within the token budget before sending it back to the model
+            prompt = conversation_memory.prepare(history)
+            prompt_length = len(prompt)
+            reply, messages = await timings.run("generation", continue_chat_response(
+                message, context, prompt, is_question, on_delta
+            ))
+            # only the prompt and the cached history are compacted, the issue keeps every turn
+            transcript = append_turns(transcript, messages, prompt_length)
+        else:
+            reply, messages = await timings.run("generation", generate_gpt_chat_response(
+                message, context, sender_name, on_delta=on_delta, context_tokens=count_context_tokens(similarities)
+            ))
+            transcript = list(messages)
+        print(f"\nREPLY: {reply}")
+        response = await stream.finish(reply)
+    except (Exception, asyncio.CancelledError):
+        # no reply is sent, so the placeholder is not left saying Alfred is thinking
+        await abandon_reply(client, placeholder_task, stages)
+        raise
+    logger.info(f"Reply stages: {timings.summary()}")
     channel_type: Literal["DM_REPLY", "DM_MESSAGE", "CHANNEL_MENTION_REPLY"]
     # if the message was made inside the app message tab
     if "channel_type" in event and event["channel_type"] == "im":
@@ -152,48 +232,56 @@ async def generate_reply(
     # if the message was made in a group channel where the bot is mentioned
     else:
         channel_type = "CHANNEL_MENTION_REPLY"
-    conversation_id = generate_conversation_id(channel_type, response.data, client, messages)
-    issue_id = f"issue_{int(time.time())}"
-    r = Redis()
+    conversation_id = await generate_conversation_id(channel_type, response.data, client, messages, bot_id)
+    # unique even for replies sent within the same second, the issue writer tells replayed creates apart by it
+    issue_id = f"issue_{uuid.uuid4().hex}"
     # Cache the message in Redis using the message ID as the key, TTL = 1 hour
-    r.add_to_cache(conversation_id, json.dumps(messages), ONE_HOUR_IN_SECONDS)
-    # schedule a worker job to send a message to the user that the conversation is now finished after the
-    # cache expires
-    task = create_task.delay(conversation_id, issue_id, token, event["channel"], ENVIRONMENT == "dev")
+    await asyncio.gather(
+        cache_conversation(conversation_id, messages, ONE_HOUR_IN_SECONDS),
+        cache_conversation(transcript_key(conversation_id), transcript, ONE_HOUR_IN_SECONDS),
+    )
+    # fold older turns of a long conversation into a summary once the reply has been sent
+    conversation_memory.schedule_compaction(
+        messages,
+        load=lambda: get_conversation(conversation_id),
+        save=lambda compacted: replace_conversation(conversation_id, compacted),
+    )
+    # queue a follow-up asking the user if the conversation is finished, sent by the worker's periodic sweep
+    follow_up_id = await schedule_follow_up(conversation_id, issue_id, token, event["channel"], ENVIRONMENT == "dev")
     category = classify_issue(message)
-    # create reference to the start of the issue in the DB or update the issue if already exists
+    # create reference to the start of the issue in the DB or update the issue if already exists, the write is
+    # queued and flushed to the DB in the background
     if not len(history):
-        issue = await create_issue(
+        await create_issue(
             conversation_id,
             issue_id,
-            task.id,
+            follow_up_id,
             org,
             slack_profile,
             event["user"],
             category,
-            messages
+            transcript
         )
     else:
-        issue = await update_issue(
+        await update_issue(
             conversation_id,
             issue_id,
-            task.id,
+            follow_up_id,
             slack_profile,
             event["user"],
             category,
-            messages
+            transcript
         )
     return reply, response.data, messages, org
 
 
 async def check_bot_mentioned_in_thread(
-    token: str, channel: str, thread_ts: str, client: WebClient
+    team_id: str, channel: str, thread_ts: str, client: AsyncWebClient
 ):
-    response = client.conversations_replies(
+    response = await client.conversations_replies(
         channel=channel, ts=thread_ts, inclusive=True
     )
-    bot_info = client.auth_test(token=token)
-    bot_user_id = bot_info["user_id"]
+    bot_user_id = (await get_bot_identity(team_id, client)).user_id
     for message in response.data["messages"]:
         # Check if the message was authored by the Slack bot or contains a mention of the bot user ID
         # check if any message contains the bot user id
@@ -214,6 +302,21 @@ async def log_request(logger: logging.Logger, body: dict, next: Callable):
     return await next()
 
 
+async def is_duplicate_event(data: dict, retry_num: str | None = None) -> bool:
+    if "event_id" not in data or await claim_event(data["event_id"]):
+        return False
+    print(f"Skipping duplicate event {data['event_id']} (retry {retry_num})")
+    return True
+
+
+@app.middleware
+async def deduplicate_events(request: AsyncBoltRequest, body: dict, next: Callable):
+    # queued events are deduplicated on intake, before they are queued
+    if not SLACK_EVENT_QUEUE and await is_duplicate_event(body, request.headers.get("x-slack-retry-num", [None])[0]):
+        return BoltResponse(status=200, body="")
+    return await next()
+
+
 # This gets activated when the bot is tagged in a channel
 @app.event("app_mention")
 async def handle_app_mention(body: dict, say: AsyncSay, logger):
@@ -221,7 +324,7 @@ async def handle_app_mention(body: dict, say: AsyncSay, logger):
     event = body["event"]
     logger.debug(event)
     token = await fetch_access_token(body["authorizations"][0]["team_id"], logger)
-    client = WebClient(token=token)
+    client = get_slack_client(token)
     # Check if the message was made in the main channel (outside thread)
     if not event.get("thread_ts", None):
         thread_ts = event.get("thread_ts", None) or event["ts"]
@@ -230,9 +333,9 @@ async def handle_app_mention(body: dict, say: AsyncSay, logger):
         )
         # check if Alfred wants to create a Zendesk ticket and has all information needed to create one
         if check_can_create_ticket(reply, history):
-            profile = get_profile_from_id(event["user"], client)
-            # fetch zendesk config for the user in DB
-            zendesk = await prisma.zendesk.find_first(where={"user_id": user.clerk_id})
+            profile = await get_profile_from_id(event["user"], client)
+            # fetch zendesk config for the workspace from the tenant cache
+            zendesk = await get_zendesk_config(event["team"])
             await send_zendesk_ticket(reply, profile, zendesk)
         # check if Alfred could not find the answer in the knowledge base and is offering to create a ticket on zendesk
         # OR to contact someone from HR/IT
@@ -248,7 +351,7 @@ async def handle_message(body: dict, say: AsyncSay, logger: logging.Logger):
     logger.debug(event)
     thread_ts = event.get("thread_ts", None)
     token = await fetch_access_token(body["authorizations"][0]["team_id"], logger)
-    client = WebClient(token=token)
+    client = get_slack_client(token)
     # USE CASE 1: Message sent directly to Alfred bot via the message tab
     if event["channel_type"] == "im":
         print("handle_bot_message event:")
@@ -257,9 +360,9 @@ async def handle_message(body: dict, say: AsyncSay, logger: logging.Logger):
         )
         # check if Alfred wants to create a Zendesk ticket and has all information needed to create one
         if check_can_create_ticket(reply, history):
-            slack_profile = get_profile_from_id(event["user"], client)
-            # fetch zendesk config for the user in DB
-            zendesk = await prisma.zendesk.find_first(where={"user_id": user.clerk_id})
+            slack_profile = await get_profile_from_id(event["user"], client)
+            # fetch zendesk config for the workspace from the tenant cache
+            zendesk = await get_zendesk_config(event["team"])
             if zendesk:
                 await send_zendesk_ticket(reply, slack_profile, zendesk)
             else:
@@ -279,7 +382,7 @@ async def handle_message(body: dict, say: AsyncSay, logger: logging.Logger):
         print("handle_message_in_thread event:")
         # check for any messages in thread history where Alfred was tagged
         is_mentioned = await check_bot_mentioned_in_thread(
-            token, event["channel"], thread_ts, client
+            body["authorizations"][0]["team_id"], event["channel"], thread_ts, client
         )
         if is_mentioned:
             # extract message from event
@@ -288,11 +391,9 @@ async def handle_message(body: dict, say: AsyncSay, logger: logging.Logger):
             )
             # check if Alfred wants to create a Zendesk ticket and has all information needed to create one
             if check_can_create_ticket(reply, history):
-                slack_profile = get_profile_from_id(event["user"], client)
-                # fetch zendesk config for the user in DB
-                zendesk = await prisma.zendesk.find_first(
-                    where={"user_id": user.clerk_id}
-                )
+                slack_profile = await get_profile_from_id(event["user"], client)
+                # fetch zendesk config for the workspace from the tenant cache
+                zendesk = await get_zendesk_config(event["team"])
                 if zendesk:
                     await send_zendesk_ticket(reply, slack_profile, zendesk)
                 else:
@@ -346,9 +447,40 @@ async def command(ack, body):
     await ack(text=f"Hi <@{user_id}>! How can I help you?")
 
 
+def event_ordering_key(data: dict) -> str:
+    """Events in the same thread, or the same channel outside threads, are processed in the order they arrived"""
+    event = data.get("event", {})
+    return f"{data.get('team_id')}:{event.get('thread_ts') or event.get('channel')}"
+
+
+async def process_queued_event(event: Dict[str, str]):
+    response = await app.async_dispatch(AsyncBoltRequest(body=event["body"], headers=json.loads(event["headers"])))
+    # bolt turns a listener's error into an error response, raised so that the queue retries the event
+    if response.status >= 500:
+        raise RuntimeError(f"Error handling queued event: {response.status} {response.body}")
+
+
+slack_event_queue = EventQueue("slack_events", process_queued_event)
+
+
 @router.post("/events")
 async def endpoint(req: Request):
     data = await req.json()
     if "challenge" in data:
         return {"challenge": data["challenge"]}
-    return await app_handler.handle(req)
+    if not SLACK_EVENT_QUEUE:
+        return await app_handler.handle(req)
+    body = (await req.body()).decode()
+    if not signature_verifier.is_valid_request(body, req.headers):
+        return Response(status_code=401)
+    if await is_duplicate_event(data, req.headers.get("x-slack-retry-num")):
+        return Response(status_code=200)
+    headers = {name: req.headers[name] for name in QUEUED_HEADERS if name in req.headers}
+    try:
+        await slack_event_queue.enqueue(event_ordering_key(data), {"body": body, "headers": json.dumps(headers)})
+    except Exception:
+        # the event was claimed but not queued, Slack retries it after the error response
+        if "event_id" in data:
+            await release_event(data["event_id"])
+        raise
+    return Response(status_code=200)
@@ -10,7 +10,6 @@ from slack_bolt.app.async_app import AsyncApp
 from slack_bolt.context.ack.async_ack import AsyncAck
 from slack_bolt.context.respond.async_respond import AsyncRespond
 from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from slack_sdk.models.blocks import DividerBlock, SectionBlock, ActionsBlock, ButtonElement, InputBlock, \
     PlainTextObject, PlainTextInputElement, UserSelectElement
@@ -18,11 +17,12 @@ from slack_sdk.oauth.installation_store import FileInstallationStore
 from slack_sdk.oauth.state_store import FileOAuthStateStore
 
 from app.db.prisma_client import prisma
-from app.redis.client import Redis
+from app.redis.client import get_redis
 from app.utils.gpt import send_zendesk_ticket
 from app.utils.helpers import border_line, border_asterisk
 from app.utils.slack import get_user_from_id, display_plain_text_dialog, get_profile_from_id, fetch_access_token, \
-    installation_base_dir
+    installation_base_dir, get_slack_client
+from app.utils.tenant import get_tenant
 from app.utils.types import Profile
 
 router = APIRouter()
@@ -50,9 +50,9 @@ async def validate_user(body: dict) -> Tuple[bool, Profile | None, str]:
     # fetch the user's ID
     user_id = body["user"]["id"]
     token = await fetch_access_token(body["team"]["id"], logging.Logger)
-    client = WebClient(token=token)
-    profile = get_profile_from_id(user_id, client)
-    conversation = client.conversations_history(channel=body["channel"]["id"], limit=5)
+    client = get_slack_client(token)
+    profile = await get_profile_from_id(user_id, client)
+    conversation = await client.conversations_history(channel=body["channel"]["id"], limit=5)
     for message in conversation.data['messages']:
         border_line()
         print(message['text'][:100])
@@ -72,11 +72,11 @@ async def handle_user_select(ack: AsyncAck, body: dict, respond: AsyncRespond):
     channel_id = body["channel"]["id"]
     selected_user_id = body["actions"][0]["selected_user"]
     token = await fetch_access_token(body["authorizations"][0]["team_id"], logging.Logger)
-    client = WebClient(token=token)
-    recipient = get_user_from_id(selected_user_id, client)
+    client = get_slack_client(token)
+    recipient = await get_user_from_id(selected_user_id, client)
     logging.log(logging.DEBUG, f"Selected user: {recipient['real_name_normalized']}")
     try:
-        conversation = client.conversations_history(channel=channel_id, limit=7)
+        conversation = await client.conversations_history(channel=channel_id, limit=7)
         # for message in conversation.data['messages']:
         #     print(f"{'-' * 50}\n{message['text'][0:50]}\n{'-' * 50}")
 
@@ -85,7 +85,7 @@ async def handle_user_select(ack: AsyncAck, body: dict, respond: AsyncRespond):
             print("app_id" in message)
             if "user" in message and "app_id" not in message:
                 last_message = message
-                response = client.chat_postMessage(
+                response = await client.chat_postMessage(
                     text=f"Hello {recipient['first_name']}, <@{last_message['user']}> wants to know:\n",
                     channel=selected_user_id,
                 )
@@ -109,8 +109,8 @@ async def handle_reply_support(ack: AsyncAck, body: dict, respond: AsyncRespond)
     user_id = body["actions"][0]["block_id"]
     sender = body["user"]["id"]
     token = await fetch_access_token(body["authorizations"][0]["team_id"], logging.Logger)
-    client = WebClient(token=token)
-    client.chat_postMessage(channel=user_id, text=f"<@{sender}> says: {body['actions'][0]['value']}")
+    client = get_slack_client(token)
+    await client.chat_postMessage(channel=user_id, text=f"<@{sender}> says: {body['actions'][0]['value']}")
     await respond(
         replace_original=True,
         text=f":white_check_mark:  Thank you for replying to <@{user_id}>",
@@ -135,10 +135,9 @@ async def handle_create_ticket(ack: AsyncAck, body: dict, respond: AsyncRespond)
             replace_original=False,
             text="Ok, hold on while I create your Zendesk support ticket for you",
         )
-        # fetch user from the DB
-        slack = await prisma.slack.find_first(where={"team_id": body["team"]["id"]})
-        # fetch zendesk config for the user in DB
-        zendesk = await prisma.zendesk.find_first(where={"org_id": slack.org_id})
+        # fetch the workspace's zendesk config from the tenant cache
+        tenant = await get_tenant(body["team"]["id"])
+        zendesk = tenant.zendesk if tenant else None
         # Create a Zendesk support ticket using the data from the action payload
         ticket = await send_zendesk_ticket(last_message, profile, zendesk)
         if ticket:
@@ -204,9 +203,9 @@ async def handle_issue_resolved(ack: AsyncAck, body: dict, respond: AsyncRespond
             where={"issue_id": issue_id},
             data={"status": "resolved", "resolved_at": datetime.now(), "is_satisfied": True},
         )
-        r = Redis()
+        r = get_redis()
         # delete the conversation_id from the redis cache
-        r.delete_key(issue.conversation_id)
+        await r.delete_key(issue.conversation_id)
         if issue:
             # storing the conversation_id in the block_id property of the action payload
             section = SectionBlock(
@@ -271,9 +270,9 @@ async def handle_issue_not_resolved(ack: AsyncAck, body: dict, respond: AsyncRes
             where={"issue_id": issue_id},
             data={"status": "unresolved", "resolved_at": datetime.now()},
         )
-        r = Redis()
+        r = get_redis()
         # delete the conversation_id from the redis cache
-        r.delete_key(issue.conversation_id)
+        await r.delete_key(issue.conversation_id)
         if issue:
             await respond(
                 replace_original=True,
@@ -3,11 +3,11 @@ from pprint import pprint
 from typing import Tuple
 
 from fastapi import APIRouter, HTTPException, Depends
-from slack_sdk import WebClient
 from slack_sdk.oauth.installation_store import FileInstallationStore, Installation
 from app.db.prisma_client import prisma
 from prisma.models import Organization
-from app.utils.slack import installation_base_dir
+from app.utils.slack import installation_base_dir, get_slack_client, cache_bot_identity
+from app.utils.tenant import invalidate_tenants
 from app.utils.types import OAuthPayload
 
 
@@ -37,9 +37,9 @@ async def oauth_callback(payload: OAuthPayload):
         org, verified = await verify_state(payload.state)
         # Verify the state parameter
         if verified:
-            client = WebClient()  # no prepared token needed for this
+            client = get_slack_client()  # no prepared token needed for this
             # Complete the installation by calling oauth.v2.access API method
-            oauth_response = client.oauth_v2_access(
+            oauth_response = await client.oauth_v2_access(
                 client_id=SLACK_CLIENT_ID,
                 client_secret=SLACK_CLIENT_SECRET,
                 redirect_uri=f"{CLIENT_HOST}/integrations/slack",
@@ -53,10 +53,14 @@ async def oauth_callback(payload: OAuthPayload):
             bot_token = oauth_response.get("access_token")
             # NOTE: oauth.v2.access doesn't include bot_id in response
             bot_id = None
+            bot_user_id = oauth_response.get("bot_user_id")
             enterprise_url = None
             if bot_token is not None:
-                auth_test = client.auth_test(token=bot_token)
+                auth_test = await client.auth_test(token=bot_token)
                 bot_id = auth_test["bot_id"]
+                bot_user_id = auth_test["user_id"]
+                # cache the bot identity so message handlers never need to call auth.test
+                cache_bot_identity(installed_team.get("id"), bot_id, bot_user_id)
                 if is_enterprise_install is True:
                     enterprise_url = auth_test.get("url")
 
@@ -69,7 +73,7 @@ async def oauth_callback(payload: OAuthPayload):
                 team_name=installed_team.get("name"),
                 bot_token=bot_token,
                 bot_id=bot_id,
-                bot_user_id=oauth_response.get("bot_user_id"),
+                bot_user_id=bot_user_id,
                 bot_scopes=oauth_response.get("scope"),  # comma-separated string
                 user_id=installer.get("id"),
                 user_token=installer.get("access_token"),
@@ -96,6 +100,7 @@ async def oauth_callback(payload: OAuthPayload):
                         "team_id": installed_team.get("id"),
                         "team_name": installed_team.get("name"),
                         "bot_id": bot_id,
+                        "bot_user_id": bot_user_id,
                         "bot_access_token": bot_token,
                         "scopes": oauth_response.get("scope"),
                     }
@@ -107,8 +112,12 @@ async def oauth_callback(payload: OAuthPayload):
                         "access_token": bot_token,
                         "team_id": installed_team.get("id"),
                         "team_name": installed_team.get("name"),
+                        "bot_id": bot_id,
+                        "bot_user_id": bot_user_id,
                     },
                 )
+            # the workspace's tenant may be cached with the previous installation's token
+            await invalidate_tenants()
             return {
                 "status": "Success",
                 "message": "Thanks for installing Alfred!",
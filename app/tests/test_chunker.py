@@ -0,0 +1,55 @@
+import re
+
+from app.utils.chunker import chunk_article, sections
+
+
+class WordEncoding(object):
+    """Stands in for tiktoken with one token per word or run of whitespace"""
+
+    def encode(self, text):
+        return re.findall(r"\S+|\s+", text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+BODY = (
+    "<p>Intro line.</p>"
+    '<h2 id="leave">Annual leave</h2><p>six seven</p><p>one two three four five</p><ul><li>nine ten</li></ul>'
+    "<h3>Sick <b>pay</b></h3><p>eleven<br>twelve</p>"
+)
+
+
+def test_sections_split_on_headings_without_markup():
+    assert sections(BODY) == [
+        ("", ["Intro line."]),
+        ("leave", ["Annual leave", "six seven", "one two three four five", "nine ten"]),
+        ("sick-pay", ["Sick pay", "eleven twelve"]),
+    ]
+
+
+def test_chunks_respect_the_target_and_overlap_within_a_section():
+    chunks = chunk_article("Leave", BODY, "HR", target_tokens=13, overlap_tokens=5, encoding=WordEncoding())
+    assert all(chunk.tokens <= 13 for chunk in chunks)
+    assert [(c.anchor, c.content) for c in chunks] == [
+        ("", "Intro line."),
+        ("leave", "Annual leave\n\nsix seven"),
+        # the last paragraph that fits in the overlap is repeated in the next chunk
+        ("leave", "six seven\n\none two three four five"),
+        ("leave", "nine ten"),
+        ("sick-pay", "Sick pay\n\neleven twelve"),
+    ]
+    assert chunks[1].tokens == len(WordEncoding().encode(chunks[1].content))
+
+
+def test_long_paragraphs_are_windowed():
+    body = "<p>" + " ".join(str(i) for i in range(20)) + "</p>"
+    chunks = chunk_article("Long", body, "IT", target_tokens=10, overlap_tokens=4, encoding=WordEncoding())
+    assert [c.tokens for c in chunks] == [10, 10, 10, 10, 10, 9]
+    assert chunks[0].content.split() == ["0", "1", "2", "3", "4"]
+    assert chunks[1].content.split() == ["3", "4", "5", "6", "7"]
+    assert chunks[-1].content.split()[-1] == "19"
+    assert chunk_article("Empty", "", "IT", encoding=WordEncoding())[0].content == ""
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from app.utils.codec import CodecError, decode_messages, encode_messages, encode_messages_text
+
+MESSAGES = [
+    {"role": "system", "content": "You are Alfred"},
+    {"role": "user", "content": "How do I book annual leave? 🏖️"},
+    {"role": "assistant", "content": "Open the HR portal and select 'Time off'."},
+    {"role": "function", "content": ""},
+]
+
+
+def test_binary_round_trip():
+    assert decode_messages(encode_messages(MESSAGES)) == MESSAGES
+
+
+def test_large_history_is_compressed():
+    messages = MESSAGES * 50
+    encoded = encode_messages(messages)
+    assert len(encoded) < len(json.dumps(messages))
+    assert decode_messages(encoded) == messages
+
+
+def test_text_round_trip():
+    encoded = encode_messages_text(MESSAGES * 50)
+    assert encoded.isascii()
+    assert decode_messages(encoded) == MESSAGES * 50
+
+
+def test_decodes_legacy_payloads():
+    assert decode_messages(json.dumps(MESSAGES).encode("utf-8")) == MESSAGES
+    assert decode_messages(str(MESSAGES)) == MESSAGES
+
+
+def test_rejects_truncated_payload():
+    with pytest.raises(CodecError):
+        decode_messages(encode_messages(MESSAGES)[:-3])
@@ -0,0 +1,81 @@
+import asyncio
+from unittest import mock
+
+import numpy as np
+
+from app.utils.embedding_cache import EmbeddingCache, ContentEmbeddingCache, normalise_query, vector_from_bytes, vector_to_bytes
+
+
+class FakeRedis(object):
+    store = {}
+
+    async def get_value(self, key):
+        return self.store.get(key)
+
+    async def add_to_cache(self, key, value, ttl):
+        self.store[key] = value
+
+
+def test_normalise_query():
+    assert normalise_query("  How do I reset my   PASSWORD?? ") == "how do i reset my password"
+
+
+def test_vector_bytes_round_trip():
+    vector = [0.25, -1.5, 3.0]
+    assert vector_from_bytes(vector_to_bytes(vector)).tolist() == vector
+
+
+@mock.patch("app.utils.embedding_cache.get_redis", FakeRedis)
+def test_get_or_create_uses_both_tiers():
+    FakeRedis.store = {}
+    calls = []
+
+    async def embed(text, model):
+        calls.append(text)
+        return [0.1, 0.2, 0.3]
+
+    cache = EmbeddingCache(max_entries=1)
+    first = asyncio.run(cache.get_or_create("How do I reset my password?", "ada", embed))
+    second = asyncio.run(cache.get_or_create("how do i reset my password", "ada", embed))
+    np.testing.assert_allclose(first, second)
+    # evict the in-process copy so the next lookup has to come from redis
+    asyncio.run(cache.get_or_create("vpn", "ada", embed))
+    asyncio.run(cache.get_or_create("how do I reset my password", "ada", embed))
+    assert calls == ["How do I reset my password?", "vpn"]
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.stats()["redis_hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+class FakeSyncRedis(object):
+    store = {}
+
+    @property
+    def client(self):
+        return self
+
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def setex(self, key, ttl, value):
+        self.store[key] = value
+
+    def execute(self):
+        return []
+
+
+@mock.patch("app.utils.embedding_cache.get_sync_redis", FakeSyncRedis)
+def test_content_cache_returns_only_the_distinct_misses():
+    FakeSyncRedis.store = {}
+    cache = ContentEmbeddingCache()
+    vectors, missing = cache.lookup("ada", ["a", "bb", "a"])
+    assert vectors == [None, None, None] and missing == ["a", "bb"]
+    cache.set_many("ada", missing, [[1.0, 1.0], [2.0, 1.0]])
+    # a re-run, or another tenant with the same text, is served from the cache
+    vectors, missing = cache.lookup("ada", ["bb", "ccc"])
+    assert vectors[0].tolist() == [2.0, 1.0] and vectors[1] is None
+    assert missing == ["ccc"]
+    assert cache.stats() == {"hits": 2, "misses": 3, "hit_rate": 0.4}
@@ -0,0 +1,52 @@
+from unittest import mock
+
+import openai
+import pytest
+
+from app.utils.embedding_scheduler import EmbeddingScheduler, TokenBudget, pack_batches
+
+
+def test_batches_are_packed_by_tokens_and_items():
+    assert pack_batches(list("abcdef"), [4, 4, 4, 9, 1, 1], max_tokens=10, max_items=2) == [[0, 1], [2], [3, 4], [5]]
+    # a text over the token limit still gets a batch of its own
+    assert pack_batches(["a", "b"], [20, 1], max_tokens=10, max_items=5) == [[0], [1]]
+
+
+def rate_limited():
+    return openai.error.RateLimitError("slow down", headers={"retry-after": "0"})
+
+
+@mock.patch("app.utils.embedding_scheduler.time.sleep")
+def test_rate_limited_batches_are_retried(sleep):
+    failures = [rate_limited(), rate_limited()]
+
+    def embed(texts, model):
+        if failures:
+            raise failures.pop()
+        return [[float(len(text))] for text in texts]
+
+    scheduler = EmbeddingScheduler(embed, batch_size=2, batch_tokens=100, max_concurrency=1)
+    assert scheduler.run(["a", "bb", "ccc"], [1, 1, 1], "ada") == {"a": [1.0], "bb": [2.0], "ccc": [3.0]}
+    assert not failures
+
+
+@mock.patch("app.utils.embedding_scheduler.time.sleep")
+def test_completed_batches_are_checkpointed_when_another_fails(sleep):
+    def embed(texts, model):
+        if "bad" in texts:
+            raise openai.error.Timeout("timed out")
+        return [[1.0] for _ in texts]
+
+    checkpoint = {}
+    scheduler = EmbeddingScheduler(embed, batch_size=1, max_concurrency=2, max_retries=2)
+    with pytest.raises(openai.error.Timeout):
+        scheduler.run(["good", "bad", "fine"], [1, 1, 1], "ada", on_batch=lambda t, v: checkpoint.update(zip(t, v)))
+    assert checkpoint == {"good": [1.0], "fine": [1.0]}
+    assert sleep.call_count == 2
+
+
+def test_rate_limit_drains_the_budget():
+    budget = TokenBudget(tokens_per_minute=600)
+    budget.acquire(600)
+    budget.pause(1)
+    assert budget.available <= -10
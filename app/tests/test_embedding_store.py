@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+os.environ.setdefault("PINECONE_API_KEY", "test")
+
+from app.utils.embedding_store import write_store, open_store
+from app.utils.knowledge_base import KnowledgeBase
+
+
+def test_store_round_trip(tmp_path):
+    knowledge_base = KnowledgeBase.from_records(
+        titles=["Payslips", "Holidays"],
+        content=["Payslips are on the HR portal", "You get 25 days of annual leave 🌴"],
+        categories=["HR", "HR"],
+        embeddings=[[3.0, 4.0, 0.0], [0.0, 0.0, 2.0]],
+        tokens=[6, 9],
+    )
+    base_path = str(tmp_path / "kb")
+    write_store(knowledge_base, base_path)
+    store = open_store(base_path)
+    assert isinstance(store.embeddings, np.memmap)
+    np.testing.assert_allclose(store.embeddings, [[0.6, 0.8, 0.0], [0.0, 0.0, 1.0]], rtol=1e-6)
+    assert list(store.content) == knowledge_base.content
+    assert store.titles == knowledge_base.titles
+    assert store.tokens == [6, 9]
+    indices, scores = store.top_k([0.0, 0.1, 1.0], 1)
+    assert store.content[indices[0]] == "You get 25 days of annual leave 🌴"
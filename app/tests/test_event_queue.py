@@ -0,0 +1,233 @@
+import asyncio
+from unittest import mock
+
+from app.utils.event_queue import EventQueue, RENEW_LEASE_SCRIPT, unique_consumer_name
+
+
+class FakePipeline(object):
+    def __init__(self, streams):
+        self.streams = streams
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def xack(self, stream, group, entry_id):
+        self.commands.append(self.streams.xack(stream, group, entry_id))
+
+    def xdel(self, stream, entry_id):
+        pass
+
+    async def execute(self):
+        return [await command for command in self.commands]
+
+
+class FakeStreams(object):
+    """In-memory stand-in for the redis stream and lease commands used by the queue"""
+
+    def __init__(self):
+        self.entries = {}
+        # stream -> [(entry_id, fields, consumer)]
+        self.pending = {}
+        self.acked = []
+        self.keys = {}
+        self.consumers = {}
+        # entry_id -> times delivered
+        self.deliveries = {}
+
+    @property
+    def client(self):
+        return self
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    async def eval(self, script, num_keys, key, consumer, lease_ms):
+        assert script == RENEW_LEASE_SCRIPT
+        if self.keys.get(key) != consumer:
+            return 0
+        if lease_ms == 0:
+            del self.keys[key]
+        return 1
+
+    async def xadd(self, stream, fields):
+        entries = self.entries.setdefault(stream, [])
+        entry_id = f"{len(entries) + len(self.acked)}-0"
+        entries.append((entry_id, fields))
+        return entry_id
+
+    async def xgroup_create(self, stream, group, id="0", mkstream=True):
+        self.entries.setdefault(stream, [])
+
+    async def xreadgroup(self, group, consumer, streams, count=1, block=None):
+        [(stream, last_id)] = streams.items()
+        self.consumers.setdefault(stream, set()).add(consumer)
+        entries = self.entries.get(stream, [])[:count]
+        del self.entries.setdefault(stream, [])[:count]
+        self.pending.setdefault(stream, []).extend((entry_id, fields, consumer) for entry_id, fields in entries)
+        self.deliveries.update((entry_id, 1) for entry_id, _ in entries)
+        if not entries:
+            await asyncio.sleep(0.01)
+            return []
+        encoded = [(entry_id, {k.encode(): v.encode() for k, v in fields.items()}) for entry_id, fields in entries]
+        return [[stream, encoded]]
+
+    async def xpending(self, stream, group):
+        return {"pending": len(self.pending.get(stream, []))}
+
+    async def xautoclaim(self, stream, group, consumer, min_idle_time, start_id="0-0", count=None):
+        # every pending entry in these tests belongs to a consumer that is gone
+        pending = self.pending.get(stream, [])
+        self.pending[stream] = [(entry_id, fields, consumer) for entry_id, fields, _ in pending]
+        for entry_id, _, _ in pending:
+            self.deliveries[entry_id] = self.deliveries.get(entry_id, 1) + 1
+        return ["0-0", [(entry_id, fields) for entry_id, fields, _ in pending], []]
+
+    async def xpending_range(self, stream, group, min, max, count, consumername=None):
+        return [
+            {"message_id": entry_id, "consumer": consumer, "times_delivered": self.deliveries[entry_id]}
+            for entry_id, _, consumer in self.pending.get(stream, []) if consumer == consumername
+        ][:count]
+
+    async def xinfo_consumers(self, stream, group):
+        return [{"name": c, "pending": 0} for c in self.consumers.get(stream, ())]
+
+    async def xgroup_delconsumer(self, stream, group, consumer):
+        self.consumers[stream].discard(consumer)
+
+    async def xack(self, stream, group, entry_id):
+        self.pending[stream] = [entry for entry in self.pending[stream] if entry[0] != entry_id]
+        self.acked.append(entry_id)
+
+
+def run_queues(streams, queues, events, pending=(), delivered=1):
+    async def run():
+        for key, event in events:
+            await queues[0].enqueue(key, event)
+        for key, event in pending:
+            # delivered to a consumer that died before acknowledging it
+            stream = queues[0].stream(key)
+            streams.pending.setdefault(stream, []).append(("p-0", event, "dead-consumer"))
+            streams.deliveries["p-0"] = delivered
+        for queue in queues:
+            await queue.start()
+        await asyncio.sleep(0.1)
+        for queue in queues:
+            await queue.close()
+
+    with mock.patch("app.utils.event_queue.get_redis", lambda: streams), \
+            mock.patch("app.utils.event_queue.EVENT_QUEUE_RETRY_DELAY", 0):
+        asyncio.run(run())
+
+
+def test_events_with_the_same_key_are_processed_in_order():
+    handled = []
+
+    async def handler(event):
+        await asyncio.sleep(0.001 * (3 - int(event["n"]) % 3))
+        handled.append(event["n"])
+
+    streams = FakeStreams()
+    queue = EventQueue("events", handler, workers=4)
+    events = [(f"T1:{i % 2}", {"n": str(i)}) for i in range(6)]
+    run_queues(streams, [queue], events)
+    assert [n for n in handled if int(n) % 2 == 0] == ["0", "2", "4"]
+    assert [n for n in handled if int(n) % 2 == 1] == ["1", "3", "5"]
+    assert queue.stream("T1:0") == EventQueue("events", handler, workers=4).stream("T1:0")
+
+
+def test_pending_events_of_a_dead_consumer_are_reclaimed_and_failures_retried():
+    handled = []
+
+    async def handler(event):
+        handled.append(event["n"])
+        if event["n"] == "1":
+            raise ValueError("boom")
+
+    streams = FakeStreams()
+    queue = EventQueue("events", handler, workers=1, max_attempts=3)
+    run_queues(streams, [queue], [("T1:C1", {"n": "1"}), ("T1:C1", {"n": "2"})], pending=[("T1:C1", {"n": "0"})])
+    # the failing event is given up on after three attempts, the next event of its conversation waits for it
+    assert handled == ["0", "1", "1", "1", "2"]
+    assert len(streams.acked) == 3
+
+
+def test_transient_failure_is_retried_before_acknowledging():
+    attempts = []
+
+    async def handler(event):
+        attempts.append(event["n"])
+        if len(attempts) == 1:
+            raise ConnectionError("slack is down")
+        # the entry stays pending while it is retried
+        assert not streams.acked
+
+    streams = FakeStreams()
+    run_queues(streams, [EventQueue("events", handler, workers=1)], [("T1:C1", {"n": "1"})])
+    assert attempts == ["1", "1"]
+    assert streams.acked == ["0-0"]
+
+
+def test_reclaimed_event_delivered_too_often_is_dropped():
+    handled = []
+
+    async def handler(event):
+        handled.append(event["n"])
+
+    streams = FakeStreams()
+    queue = EventQueue("events", handler, workers=1, max_attempts=3)
+    # the event already crashed three consumers
+    run_queues(streams, [queue], [], pending=[("T1:C1", {"n": "0"})], delivered=3)
+    assert handled == []
+    assert streams.acked == ["p-0"]
+
+
+def test_events_of_different_conversations_in_a_shard_run_concurrently():
+    handled = []
+    fast_handled = asyncio.Event()
+
+    async def handler(event):
+        if event["n"] == "slow":
+            # only finishes once the other conversation's event has been handled
+            await asyncio.wait_for(fast_handled.wait(), 0.05)
+        else:
+            fast_handled.set()
+        handled.append(event["n"])
+
+    streams = FakeStreams()
+    events = [("T1:C1", {"n": "slow"}), ("T1:C2", {"n": "fast"})]
+    run_queues(streams, [EventQueue("events", handler, workers=1)], events)
+    assert handled == ["fast", "slow"]
+
+
+def test_each_shard_is_consumed_by_one_process():
+    handled = {}
+
+    def handler(name):
+        async def handle(event):
+            handled.setdefault(event["n"], []).append(name)
+        return handle
+
+    streams = FakeStreams()
+    first = EventQueue("events", handler("first"), workers=2)
+    second = EventQueue("events", handler("second"), workers=2)
+    assert first.consumer != second.consumer
+    run_queues(streams, [first, second], [(f"T1:{i}", {"n": str(i)}) for i in range(6)])
+    assert sorted(handled) == [str(i) for i in range(6)]
+    # the first process started owns both shards, the second stands by
+    assert all(names == ["first"] for names in handled.values())
+    # the leases are released on close
+    assert not streams.keys
+
+
+def test_consumer_names_are_unique():
+    assert unique_consumer_name() != unique_consumer_name()
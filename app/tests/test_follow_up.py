@@ -0,0 +1,139 @@
+import asyncio
+import json
+from unittest import mock
+
+from app import worker
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def hset(self, key, field, value):
+        self.redis.payloads[field] = value
+
+    def zadd(self, key, mapping):
+        self.redis.queue.update(mapping)
+
+    async def execute(self):
+        return []
+
+
+class FakeRedis(object):
+    queue = {}
+    in_flight = {}
+    payloads = {}
+
+    @classmethod
+    def reset(cls):
+        cls.queue, cls.in_flight, cls.payloads = {}, {}, {}
+
+    @property
+    def client(self):
+        return self
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def eval(self, script, num_keys, *args):
+        # mirrors the follow-up scripts in app.worker
+        if script == worker.CLAIM_DUE_FOLLOW_UPS_SCRIPT:
+            now, batch, lease_until = args[3:]
+            for convo_id in [c for c, score in self.in_flight.items() if score <= now]:
+                self.queue.setdefault(convo_id, now)
+                del self.in_flight[convo_id]
+            due = sorted((score, convo_id) for convo_id, score in self.queue.items() if score <= now)[:batch]
+            result = []
+            for _, convo_id in due:
+                del self.queue[convo_id]
+                self.in_flight[convo_id] = lease_until
+                result += [convo_id, self.payloads.get(convo_id)]
+            return result
+        convo_id = args[3]
+        self.in_flight.pop(convo_id, None)
+        if convo_id in self.queue:
+            return 1
+        if script == worker.ACK_FOLLOW_UP_SCRIPT:
+            self.payloads.pop(convo_id, None)
+        else:
+            self.payloads[convo_id] = args[5]
+            self.queue[convo_id] = args[4]
+        return 1
+
+
+@mock.patch("app.worker.WebClient")
+@mock.patch("app.worker.expired_conversation_callback")
+@mock.patch("app.worker.get_sync_redis", FakeRedis)
+@mock.patch("app.worker.get_redis", FakeRedis)
+def test_rescheduling_replaces_earlier_follow_up(callback, web_client):
+    FakeRedis.reset()
+    asyncio.run(worker.schedule_follow_up("B1:123", "issue_1", "xoxb", "D1"))
+    asyncio.run(worker.schedule_follow_up("B1:123", "issue_2", "xoxb", "D1"))
+    assert len(FakeRedis.queue) == 1
+
+    # nothing is due before the deadline
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 0, "failed": 0}
+    FakeRedis.queue["B1:123"] -= worker.FOLLOW_UP_DELAY
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 1, "failed": 0}
+    callback.assert_called_once_with("B1:123", "issue_2", "xoxb", "D1", web_client.return_value)
+    # a second sweep does not send the follow-up twice
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 0, "failed": 0}
+
+
+@mock.patch("app.worker.FOLLOW_UP_SWEEP_BATCH", 2)
+@mock.patch("app.worker.WebClient")
+@mock.patch("app.worker.expired_conversation_callback")
+@mock.patch("app.worker.get_sync_redis", FakeRedis)
+@mock.patch("app.worker.get_redis", FakeRedis)
+def test_sweep_drains_due_follow_ups_in_batches(callback, web_client):
+    FakeRedis.reset()
+    for i in range(5):
+        asyncio.run(worker.schedule_follow_up(f"B1:{i}", f"issue_{i}", f"xoxb-{i % 2}", "D1", debug=True))
+    for convo_id in FakeRedis.queue:
+        FakeRedis.queue[convo_id] -= worker.FOLLOW_UP_DEBUG_DELAY
+
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 5, "failed": 0}
+    assert not FakeRedis.queue and not FakeRedis.in_flight and not FakeRedis.payloads
+    # one slack client per workspace token
+    assert web_client.call_count == 2
+
+
+@mock.patch("app.worker.WebClient")
+@mock.patch("app.worker.expired_conversation_callback", return_value=None)
+@mock.patch("app.worker.get_sync_redis", FakeRedis)
+@mock.patch("app.worker.get_redis", FakeRedis)
+def test_failed_follow_up_is_retried_until_it_is_sent(callback, web_client):
+    FakeRedis.reset()
+    asyncio.run(worker.schedule_follow_up("B1:123", "issue_1", "xoxb", "D1"))
+    FakeRedis.queue["B1:123"] -= worker.FOLLOW_UP_DELAY
+
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 0, "failed": 1}
+    # the follow-up is back in the queue, due after the retry delay, with its payload
+    assert not FakeRedis.in_flight and json.loads(FakeRedis.payloads["B1:123"])["attempts"] == 1
+    FakeRedis.queue["B1:123"] -= worker.FOLLOW_UP_RETRY_DELAY
+    callback.return_value = True
+    assert worker.sweep_follow_ups() == {"message": "Success", "sent": 1, "failed": 0}
+    assert not FakeRedis.queue and not FakeRedis.payloads
+
+
+@mock.patch("app.worker.WebClient")
+@mock.patch("app.worker.expired_conversation_callback", return_value=True)
+@mock.patch("app.worker.get_sync_redis", FakeRedis)
+@mock.patch("app.worker.get_redis", FakeRedis)
+def test_follow_up_claimed_by_a_dead_sweep_is_sent_after_its_lease(callback, web_client):
+    FakeRedis.reset()
+    asyncio.run(worker.schedule_follow_up("B1:123", "issue_1", "xoxb", "D1"))
+    # a sweep claimed the follow-up and died before sending it
+    FakeRedis.queue = {}
+    FakeRedis.in_flight["B1:123"] = worker.time.time() + worker.FOLLOW_UP_LEASE
+
+    assert worker.sweep_follow_ups()["sent"] == 0
+    FakeRedis.in_flight["B1:123"] -= worker.FOLLOW_UP_LEASE
+    assert worker.sweep_follow_ups()["sent"] == 1
+    callback.assert_called_once()
@@ -0,0 +1,134 @@
+import asyncio
+from unittest import mock
+
+from app.utils import issue_writer as writer_module
+from app.tests.test_event_queue import FakeStreams
+from app.utils.issue_writer import IssueWriter, coalesce
+
+
+def turn(kind, conversation_id, issue_id, **fields):
+    return {"kind": kind, "conversation_id": conversation_id, "issue_id": issue_id, **fields}
+
+
+def test_coalesce_folds_updates_into_the_previous_write():
+    writes = coalesce([
+        turn("create", "B1:1", "issue_1", category="it", org_id="org_1"),
+        turn("update", "B1:2", "issue_2", category="hr"),
+        turn("update", "B1:1", "issue_3", category="hr"),
+        turn("update", "B1:2", "issue_4", category="it"),
+        turn("create", "B1:1", "issue_5", category="it", org_id="org_1"),
+    ])
+    assert [(w["kind"], w["conversation_id"], w["issue_id"], w["category"]) for w in writes] == [
+        ("create", "B1:1", "issue_3", "hr"),
+        ("update", "B1:2", "issue_4", "it"),
+        ("create", "B1:1", "issue_5", "it"),
+    ]
+    # fields only sent when the issue is created survive the updates folded into it
+    assert writes[0]["org_id"] == "org_1"
+
+
+def entries(*events):
+    return [(f"{i}-0", {k.encode(): v.encode() for k, v in event.items()}) for i, event in enumerate(events)]
+
+
+@mock.patch("app.utils.issue_writer.get_redis")
+def test_flush_retries_batch_when_database_is_down(get_redis):
+    write = mock.AsyncMock(side_effect=ConnectionError("database is down"))
+    with mock.patch("app.utils.issue_writer.write_issues", write):
+        assert not asyncio.run(IssueWriter().flush(entries(turn("create", "B1:1", "issue_1"))))
+    # nothing was acknowledged, so the entries are replayed on the next read
+    get_redis.return_value.client.pipeline.assert_not_called()
+
+
+@mock.patch("app.utils.issue_writer.get_redis")
+def test_flush_drops_only_the_invalid_write(get_redis):
+    async def write_issues(writes):
+        if any(w["issue_id"] == "issue_bad" for w in writes):
+            raise ValueError("unique constraint failed")
+
+    pipe = mock.MagicMock()
+    pipe.execute = mock.AsyncMock()
+    get_redis.return_value.client.pipeline.return_value.__aenter__ = mock.AsyncMock(return_value=pipe)
+    get_redis.return_value.client.pipeline.return_value.__aexit__ = mock.AsyncMock(return_value=False)
+    with mock.patch("app.utils.issue_writer.write_issues", mock.AsyncMock(side_effect=write_issues)) as write:
+        batch = entries(turn("create", "B1:1", "issue_1"), turn("create", "B1:2", "issue_bad"))
+        assert asyncio.run(IssueWriter().flush(batch))
+    assert write.await_count == 3
+    pipe.xack.assert_called_once_with(writer_module.ISSUE_STREAM_KEY, writer_module.ISSUE_WRITER_GROUP, "0-0", "1-0")
+
+
+class FakeBatcher(object):
+    def __init__(self, calls):
+        self.issue = mock.Mock()
+        self.issue.create.side_effect = lambda data: calls.append(("create", data["issue_id"]))
+        self.issue.update.side_effect = lambda where, data: calls.append(("update", data["issue_id"]))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+def run_write_issues(writes, open_issues=(), existing=()):
+    calls = []
+    prisma = mock.Mock()
+    prisma.issue.find_many = mock.AsyncMock(
+        side_effect=lambda where, **kwargs: list(open_issues) if "status" in where else list(existing)
+    )
+    prisma.batch_ = lambda: FakeBatcher(calls)
+    with mock.patch("app.utils.issue_writer.prisma", prisma):
+        asyncio.run(writer_module.write_issues(writes))
+    return calls
+
+
+def test_update_without_an_open_issue_is_dropped():
+    fields = {"celery_task_id": "t", "employee_id": "U1", "employee_name": "Jo", "employee_email": "jo@acme.com",
+              "category": "hr", "messages": "[]"}
+    open_issue = mock.Mock(id=1, conversation_id="B1:1")
+    with mock.patch("app.utils.issue_writer.logger") as logger:
+        calls = run_write_issues([
+            turn("update", "B1:1", "issue_1", **fields),
+            # the conversation's issue was resolved before this turn was written
+            turn("update", "B1:2", "issue_2", **fields),
+        ], open_issues=[open_issue])
+    assert calls == [("update", "issue_1")]
+    logger.warning.assert_called_once()
+
+
+def test_replayed_create_is_matched_on_its_conversation():
+    fields = {"celery_task_id": "t", "employee_id": "U1", "employee_name": "Jo", "employee_email": "jo@acme.com",
+              "category": "hr", "messages": "[]", "org_id": "org_1", "org_name": "Acme"}
+    created = mock.Mock(issue_id="issue_1", conversation_id="B1:1")
+    calls = run_write_issues([
+        turn("create", "B1:1", "issue_1", **fields),
+        # another conversation that happens to share the id is not folded into the first one's issue
+        turn("create", "B1:2", "issue_1", **fields),
+    ], existing=[created])
+    assert calls == [("update", "issue_1"), ("create", "issue_1")]
+
+
+def test_a_dead_writers_turns_are_written_before_new_ones():
+    flushed = []
+
+    async def flush(self, batch):
+        flushed.append([entry_id for entry_id, _ in batch])
+        for entry_id, _ in batch:
+            await streams.xack(writer_module.ISSUE_STREAM_KEY, writer_module.ISSUE_WRITER_GROUP, entry_id)
+        return True
+
+    async def run():
+        writer = IssueWriter(lease_ms=30)
+        await writer.start()
+        await asyncio.sleep(0.1)
+        await writer.close()
+
+    streams = FakeStreams()
+    streams.pending[writer_module.ISSUE_STREAM_KEY] = [("0-0", {"kind": "update"}, "dead-writer")]
+    streams.entries[writer_module.ISSUE_STREAM_KEY] = [("1-0", {"kind": "update"})]
+    with mock.patch("app.utils.event_queue.get_redis", lambda: streams), \
+            mock.patch("app.utils.issue_writer.get_redis", lambda: streams), \
+            mock.patch.object(IssueWriter, "flush", flush):
+        asyncio.run(run())
+    assert flushed == [["0-0"], ["1-0"]]
+    assert IssueWriter().consumer != IssueWriter().consumer
@@ -0,0 +1,147 @@
+import asyncio
+from unittest import mock
+
+import pandas as pd
+import pytest
+
+from app.utils.kb_manifest import ManifestEntry
+from app.utils.kb_sync import apply_changes, stream_changes
+from app.utils.types import Article
+from app.utils.zendesk import content_hash
+
+
+def article(i, body="<p>body</p>"):
+    return Article(id=i, title=f"Article {i}", body=body, category="HR", updated_at="2023-07-02", url="")
+
+
+def fake_embeddings(chunks):
+    df = pd.DataFrame({
+        "titles": [c[0] for c in chunks],
+        "content": [c[1] for c in chunks],
+        "categories": [c[2] for c in chunks],
+        "embedding": [[0.1, 0.2] for _ in chunks],
+        "tokens": [3 for _ in chunks],
+    })
+    return df, list(df["embedding"])
+
+
+def one_chunk(articles):
+    return list(articles)
+
+
+@mock.patch("app.utils.kb_sync.clean_up_text", one_chunk)
+@mock.patch("app.utils.kb_sync.bump_namespace_version")
+@mock.patch("app.utils.kb_sync.update_manifest")
+@mock.patch("app.utils.kb_sync.store_embeddings_into_pinecone")
+@mock.patch("app.utils.kb_sync.calculate_embeddings", side_effect=fake_embeddings)
+@mock.patch("app.utils.kb_sync._index")
+def test_only_changed_articles_are_embedded_and_removed_ones_deleted(index, embed, store, update_manifest, bump):
+    unchanged, edited, new = article(1), article(2, "<p>new text</p>"), article(3)
+    manifest = {
+        "1": ManifestEntry("2023-07-01", content_hash(unchanged), 1),
+        "2": ManifestEntry("2023-07-01", content_hash(article(2)), 1),
+        "4": ManifestEntry("2023-07-01", "removed", 2),
+    }
+    result = apply_changes("acme", manifest, [unchanged, edited, new], {"1", "2", "3"}, full=False)
+
+    assert result == {"embedded": 2, "skipped": 1, "removed": 1}
+    assert [c[1] for c in embed.call_args.args[0]] == ["<p>new text</p>", "<p>body</p>"]
+    assert list(store.call_args.args[0]["ids"]) == ["2-0", "3-0"]
+    index.return_value.delete.assert_called_once_with(ids=["4-0", "4-1"], namespace="acme")
+    entries = update_manifest.call_args.args[2]
+    assert set(entries) == {"2", "3"} and entries["2"].hash == content_hash(edited)
+    assert update_manifest.call_args.args[3] == ["4"]
+    bump.assert_called_once()
+
+
+@mock.patch("app.utils.kb_sync.bump_namespace_version")
+@mock.patch("app.utils.kb_sync.update_manifest")
+@mock.patch("app.utils.kb_sync.calculate_embeddings")
+@mock.patch("app.utils.kb_sync._index")
+def test_metadata_only_edits_cost_nothing(index, embed, update_manifest, bump):
+    manifest = {"1": ManifestEntry("2023-07-01", content_hash(article(1)), 1)}
+    result = apply_changes("acme", manifest, [article(1)], None, full=False)
+    assert result == {"embedded": 0, "skipped": 1, "removed": 0}
+    embed.assert_not_called()
+    index.return_value.delete.assert_not_called()
+    bump.assert_not_called()
+
+
+class FakeIndex(object):
+    def __init__(self, ids, fail_on_upsert=None):
+        self.vectors = {i: [0.0] for i in ids}
+        self.upserts = 0
+        self.fail_on_upsert = fail_on_upsert
+
+    def describe_index_stats(self):
+        return {"namespaces": {"acme": {"vector_count": len(self.vectors)}}}
+
+    def upsert(self, vectors, namespace):
+        self.upserts += 1
+        if self.upserts == self.fail_on_upsert:
+            raise RuntimeError("pinecone unavailable")
+        self.vectors.update({i: values for i, values, _ in vectors})
+
+    def delete(self, ids, namespace):
+        for i in ids:
+            self.vectors.pop(i, None)
+
+
+@mock.patch("app.utils.kb_sync.clean_up_text", one_chunk)
+@mock.patch("app.utils.kb_sync.bump_namespace_version")
+@mock.patch("app.utils.kb_sync.update_manifest")
+@mock.patch("app.utils.kb_sync.calculate_embeddings", side_effect=fake_embeddings)
+def test_full_sync_replaces_legacy_vectors_only_after_upserting(embed, update_manifest, bump):
+    index = FakeIndex(["0", "1"])
+    with mock.patch("app.utils.kb_sync._index", return_value=index):
+        apply_changes("acme", {}, [article(1), article(2)], {"1", "2"}, full=True)
+    assert set(index.vectors) == {"1-0", "2-0"}
+    assert update_manifest.call_args.kwargs["reset"] is True
+
+
+@mock.patch("app.utils.kb_sync.clean_up_text", one_chunk)
+@mock.patch("app.utils.kb_sync.bump_namespace_version")
+@mock.patch("app.utils.kb_sync.update_manifest")
+@mock.patch("app.utils.kb_sync.calculate_embeddings", side_effect=fake_embeddings)
+def test_failed_full_sync_keeps_the_previous_vectors(embed, update_manifest, bump):
+    # 40 articles are upserted in two batches of 32, the second of which fails
+    index = FakeIndex(["0", "1", "2"], fail_on_upsert=2)
+    with mock.patch("app.utils.kb_sync._index", return_value=index), pytest.raises(RuntimeError):
+        apply_changes("acme", {}, [article(i) for i in range(40)], {str(i) for i in range(40)}, full=True)
+    assert {"0", "1", "2"} <= set(index.vectors)
+    update_manifest.assert_not_called()
+    bump.assert_not_called()
+
+
+@mock.patch("app.utils.kb_sync.clean_up_text", one_chunk)
+@mock.patch("app.utils.kb_sync.bump_namespace_version")
+@mock.patch("app.utils.kb_sync.update_manifest")
+def test_harvested_articles_are_embedded_in_batches_as_they_arrive(update_manifest, bump):
+    log = []
+
+    def embed(chunks):
+        log.append(("embed", [c[0] for c in chunks]))
+        return fake_embeddings(chunks)
+
+    async def harvest():
+        for i in range(5):
+            log.append(("fetch", i))
+            yield article(i)
+            # give the batch handed over to its thread a chance to run, as awaiting the next page would
+            await asyncio.sleep(0.05)
+
+    manifest = {"9": ManifestEntry("2023-07-01", "removed", 1)}
+    index = FakeIndex(["9-0"])
+    with mock.patch("app.utils.kb_sync._index", return_value=index), \
+            mock.patch("app.utils.kb_sync.calculate_embeddings", side_effect=embed):
+        result = asyncio.run(stream_changes("acme", manifest, harvest(), full=False, batch_size=2))
+
+    assert result == {"embedded": 5, "skipped": 0, "removed": 1}
+    # the first batch is embedded while the rest of the help center is still being fetched
+    assert log.index(("embed", ["Article 0", "Article 1"])) < log.index(("fetch", 4))
+    assert [entry for kind, entry in log if kind == "embed"] == [
+        ["Article 0", "Article 1"], ["Article 2", "Article 3"], ["Article 4"]
+    ]
+    assert set(index.vectors) == {f"{i}-0" for i in range(5)}
+    assert set(update_manifest.call_args.args[2]) == {str(i) for i in range(5)}
+    assert update_manifest.call_args.args[3] == ["9"]
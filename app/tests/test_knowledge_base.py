@@ -0,0 +1,83 @@
+import asyncio
+from unittest import mock
+
+from app.utils import knowledge_base as kb_module
+from app.utils.knowledge_base import KnowledgeBase, KnowledgeBaseCache, get_knowledge_base
+
+
+def make_knowledge_base(n=1):
+    return KnowledgeBase.from_records(
+        titles=[f"Title {i}" for i in range(n)],
+        content=[f"Content {i}" for i in range(n)],
+        categories=["HR"] * n,
+        embeddings=[[1.0, float(i)] for i in range(n)],
+        tokens=[2] * n,
+    )
+
+
+def test_bumped_version_misses_the_cache():
+    cache = KnowledgeBaseCache()
+    fetch = mock.Mock(side_effect=lambda index_name, namespace: make_knowledge_base())
+    versions = iter(["1", "1", "2"])
+
+    async def version(index_name, namespace):
+        return next(versions)
+
+    with mock.patch.object(kb_module, "knowledge_base_cache", cache), \
+            mock.patch.object(kb_module, "get_namespace_version", version), \
+            mock.patch.object(kb_module, "fetch_knowledge_base_from_pinecone", fetch):
+        first = asyncio.run(get_knowledge_base("alfred", "acme"))
+        assert asyncio.run(get_knowledge_base("alfred", "acme")) is first
+        # another process synced the namespace and bumped its version
+        assert asyncio.run(get_knowledge_base("alfred", "acme")) is not first
+    assert fetch.call_count == 2
+
+
+def test_entries_expire_after_their_ttl():
+    cache = KnowledgeBaseCache(ttl=60)
+    knowledge_base = make_knowledge_base()
+    with mock.patch.object(kb_module.time, "monotonic", return_value=1000.0):
+        cache.set("alfred", "acme", knowledge_base, "1")
+    with mock.patch.object(kb_module.time, "monotonic", return_value=1059.0):
+        assert cache.get("alfred", "acme", "1") is knowledge_base
+    with mock.patch.object(kb_module.time, "monotonic", return_value=1061.0):
+        assert cache.get("alfred", "acme", "1") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = KnowledgeBaseCache(max_entries=2)
+    for namespace in ("a", "b"):
+        cache.set("alfred", namespace, make_knowledge_base())
+    cache.get("alfred", "a")
+    cache.set("alfred", "c", make_knowledge_base())
+    assert cache.get("alfred", "b") is None
+    assert cache.get("alfred", "a") is not None and cache.get("alfred", "c") is not None
+
+
+def pinecone_index(ids):
+    def vector(i):
+        metadata = {"title": f"Title {i}", "content": f"Content {i}", "category": "HR", "tokens": 2}
+        return {"values": [1.0, 0.0], "metadata": metadata}
+
+    index = mock.Mock()
+    index.describe_index_stats.return_value = {"namespaces": {"acme": {"vector_count": len(ids)}}}
+    index.fetch.side_effect = lambda ids, namespace: {"vectors": {i: vector(i) for i in ids}}
+    return index
+
+
+@mock.patch("app.utils.knowledge_base.Pinecone")
+def test_namespace_without_a_manifest_is_fetched_by_numbered_ids(pinecone):
+    index = pinecone.return_value.index.return_value = pinecone_index(["0", "1", "2"])
+    with mock.patch.object(kb_module, "manifest_vector_ids", return_value=None):
+        knowledge_base = kb_module.fetch_knowledge_base_from_pinecone("alfred", "acme")
+    assert index.fetch.call_args.kwargs["ids"] == ["0", "1", "2"]
+    assert knowledge_base.titles == ["Title 0", "Title 1", "Title 2"]
+
+
+@mock.patch("app.utils.knowledge_base.Pinecone")
+def test_synced_namespace_is_fetched_by_its_manifest_ids(pinecone):
+    index = pinecone.return_value.index.return_value = pinecone_index(["7-0", "7-1"])
+    with mock.patch.object(kb_module, "manifest_vector_ids", return_value=["7-0", "7-1"]):
+        knowledge_base = kb_module.fetch_knowledge_base_from_pinecone("alfred", "acme")
+    index.describe_index_stats.assert_not_called()
+    assert knowledge_base.titles == ["Title 7-0", "Title 7-1"]
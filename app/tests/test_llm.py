@@ -0,0 +1,54 @@
+import asyncio
+from unittest import mock
+
+import openai
+
+from app.utils.llm import LLMClient
+
+
+def test_calls_share_session_and_respect_concurrency():
+    in_flight = 0
+    peak = 0
+    sessions = set()
+
+    async def fake_acreate(**kwargs):
+        nonlocal in_flight, peak
+        sessions.add(id(openai.aiosession.get()))
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return {"data": [{"index": 1, "embedding": [2.0]}, {"index": 0, "embedding": [1.0]}]}
+
+    async def run():
+        client = LLMClient(max_concurrency=2)
+        with mock.patch.object(openai.Embedding, "acreate", side_effect=fake_acreate):
+            results = await asyncio.gather(*[client.embeddings(["a", "b"], "ada") for _ in range(6)])
+        await client.close()
+        return results
+
+    results = asyncio.run(run())
+    assert results[0] == [[1.0], [2.0]]
+    assert peak == 2
+    assert len(sessions) == 1
+    assert openai.aiosession.get() is None
+
+
+def test_each_event_loop_gets_its_own_session():
+    sessions = []
+
+    async def fake_acreate(**kwargs):
+        session = openai.aiosession.get()
+        # a session used on a loop other than its own fails, as aiohttp's would
+        assert session._loop is asyncio.get_running_loop()
+        sessions.append(session)
+        return {"data": [{"index": 0, "embedding": [1.0]}]}
+
+    client = LLMClient()
+    with mock.patch.object(openai.Embedding, "acreate", side_effect=fake_acreate):
+        # one asyncio.run per call, like the celery tasks, which never close the client
+        asyncio.run(client.embeddings(["a"], "ada"))
+        asyncio.run(client.embeddings(["b"], "ada"))
+    assert sessions[0] is not sessions[1]
+    # the session of the first, closed, loop was forgotten
+    assert len(client._pools) == 1
@@ -0,0 +1,85 @@
+import asyncio
+from unittest import mock
+
+from app.utils.memory import ConversationMemory, SUMMARY_PREFIX, append_turns, strip_context
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def conversation(turns):
+    messages = [
+        {"role": "system", "content": "You are Alfred"},
+        {"role": "user", "content": 'Introduction\n\nContext:\n"""\nlong knowledge base article\n"""\n\nQuestion: hi'},
+    ]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}\n\nContext: article {i} " + "word " * 20})
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+    return messages
+
+
+def test_strip_context():
+    messages = conversation(1)
+    assert strip_context(messages[1])["content"] == "Introduction\n\nQuestion: hi"
+    assert strip_context(messages[2])["content"] == "question 0"
+    assert strip_context(messages[3]) == messages[3]
+
+
+def test_prepare_trims_oldest_turns_to_budget():
+    memory = ConversationMemory(token_budget=40, count_tokens=count_words)
+    prepared = memory.prepare(conversation(5))
+    # the system and introduction prompts are pinned, the latest exchange is kept
+    assert prepared[0]["content"] == "You are Alfred"
+    assert prepared[1]["content"] == "Introduction\n\nQuestion: hi"
+    assert prepared[-1]["content"] == "answer 4"
+    assert memory.num_tokens(prepared) <= 40
+    assert all("Context" not in m["content"] for m in prepared)
+
+
+def test_compaction_summarises_older_turns():
+    memory = ConversationMemory(token_budget=50, recent_messages=2, count_tokens=count_words)
+    messages = conversation(4)
+    saved = []
+
+    async def load():
+        return messages
+
+    async def save(compacted):
+        saved.append(compacted)
+
+    async def chat_completion(*args, **kwargs):
+        return {"choices": [{"message": {"content": "The employee asked four questions."}}]}
+
+    async def run():
+        memory.schedule_compaction(messages, load, save)
+        await asyncio.gather(*memory._tasks)
+
+    with mock.patch("app.utils.memory.llm_client.chat_completion", chat_completion):
+        asyncio.run(run())
+    compacted = saved[0]
+    assert compacted[:2] == messages[:2]
+    assert compacted[2] == {"role": "system", "content": SUMMARY_PREFIX + "The employee asked four questions."}
+    assert compacted[3:] == messages[-2:]
+
+
+@mock.patch("app.redis.utils.issue_writer")
+def test_issue_keeps_every_turn_of_a_compacted_conversation(writer):
+    from app.redis.utils import update_issue
+    from app.utils.codec import decode_messages
+
+    writer.record = mock.AsyncMock()
+    memory = ConversationMemory(token_budget=40, count_tokens=count_words)
+    transcript = conversation(5)
+    prompt = memory.prepare(transcript)
+    prompt_length = len(prompt)
+    # the model's reply is appended to the prompt it was given, as continue_chat_response does
+    messages = prompt + [{"role": "user", "content": "question 5"}, {"role": "assistant", "content": "answer 5"}]
+    assert len(messages) < len(transcript) + 2
+
+    transcript = append_turns(transcript, messages, prompt_length)
+    profile = mock.Mock(email="jo@acme.com")
+    profile.name = "Jo"
+    asyncio.run(update_issue("B1:123", "issue_1", "B1:123", profile, "U1", "HR", transcript))
+    persisted = decode_messages(writer.record.call_args.args[0]["messages"])
+    assert persisted == conversation(5) + messages[prompt_length:]
@@ -0,0 +1,99 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from app.redis.utils import claim_event, conversation_lock, release_event
+
+
+class FakeLock(object):
+    def __init__(self, lock):
+        self.lock = lock
+
+    async def acquire(self):
+        await self.lock.acquire()
+        return True
+
+    async def release(self):
+        self.lock.release()
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.keys = {}
+        self.locks = {}
+
+    @property
+    def client(self):
+        return self
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    async def delete(self, key):
+        self.keys.pop(key, None)
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        return FakeLock(self.locks.setdefault(name, asyncio.Lock()))
+
+
+def test_duplicate_event_is_dropped():
+    redis = FakeRedis()
+
+    async def run():
+        return [await claim_event("Ev1"), await claim_event("Ev1"), await claim_event("Ev2")]
+
+    with mock.patch("app.redis.utils.get_redis", lambda: redis):
+        assert asyncio.run(run()) == [True, False, True]
+
+
+def test_released_event_is_processed_when_retried():
+    redis = FakeRedis()
+
+    async def run():
+        assert await claim_event("Ev1")
+        # enqueueing the event failed, so Slack's retry must not be skipped as a duplicate
+        await release_event("Ev1")
+        return await claim_event("Ev1")
+
+    with mock.patch("app.redis.utils.get_redis", lambda: redis):
+        assert asyncio.run(run())
+
+
+def test_lock_serialises_handlers_of_a_conversation():
+    redis = FakeRedis()
+    log = []
+
+    async def handle(conversation, n):
+        async with conversation_lock(conversation):
+            log.append(("start", conversation, n))
+            await asyncio.sleep(0.01)
+            log.append(("end", conversation, n))
+
+    async def run():
+        await asyncio.gather(handle("T1:C1", 1), handle("T1:C1", 2), handle("T1:C2", 3))
+
+    with mock.patch("app.redis.utils.get_redis", lambda: redis):
+        asyncio.run(run())
+    same = [(kind, n) for kind, conversation, n in log if conversation == "T1:C1"]
+    assert same == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    # another conversation does not wait for it
+    assert log.index(("start", "T1:C2", 3)) < log.index(("end", "T1:C1", 1))
+
+
+def test_lock_is_released_when_the_handler_raises():
+    redis = FakeRedis()
+
+    async def run():
+        with pytest.raises(ValueError):
+            async with conversation_lock("T1:C1"):
+                raise ValueError("reply failed")
+        # the next message of the conversation is not blocked
+        async with conversation_lock("T1:C1"):
+            return True
+
+    with mock.patch("app.redis.utils.get_redis", lambda: redis):
+        assert asyncio.run(asyncio.wait_for(run(), 1))
@@ -0,0 +1,43 @@
+import asyncio
+import os
+
+os.environ.setdefault("PINECONE_API_KEY", "test")
+
+from app.utils.knowledge_base import KnowledgeBase
+from app.utils.retrieval import LocalBackend, PineconeBackend
+
+
+def make_knowledge_base():
+    return KnowledgeBase.from_records(
+        titles=["Password reset", "Annual leave", "Laptop"],
+        content=["Reset your password from the IT portal", "You get 25 days of leave", "Request a laptop from IT"],
+        categories=["IT", "HR", "IT"],
+        embeddings=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.7, 0.0, 0.7]],
+        tokens=[7, 6, 5],
+    )
+
+
+def test_local_backend_returns_top_matches():
+    backend = LocalBackend()
+    backend.add(make_knowledge_base(), "acme")
+    matches = asyncio.run(backend.query([1.0, 0.0, 0.1], 2, "acme"))
+    assert [match.title for match in matches] == ["Password reset", "Laptop"]
+    assert [match.tokens for match in matches] == [7, 5]
+    assert matches[0].score > matches[1].score
+    assert asyncio.run(backend.query([1.0, 0.0, 0.0], 2, "unknown")) == []
+
+
+def test_pinecone_backend_maps_matches():
+    class FakeIndex:
+        def query(self, **kwargs):
+            assert kwargs["top_k"] == 1 and kwargs["include_metadata"] and not kwargs["include_values"]
+            return {
+                "matches": [
+                    {"id": "4", "score": 0.91, "metadata": {"title": "VPN", "content": "Use the VPN", "category": "IT", "tokens": 4.0}}
+                ]
+            }
+
+    backend = PineconeBackend("alfred")
+    backend._index = FakeIndex()
+    (match,) = asyncio.run(backend.query([0.1, 0.2], 1, "acme"))
+    assert match.id == "4" and match.content == "Use the VPN" and match.score == 0.91 and match.tokens == 4
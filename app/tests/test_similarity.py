@@ -0,0 +1,29 @@
+import numpy as np
+
+from app.utils.similarity import normalise_rows, top_k
+
+
+def test_normalise_rows():
+    matrix = normalise_rows([[3, 4], [0, 0], [1, 0]])
+    assert matrix.dtype == np.float32
+    assert matrix.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(matrix, [[0.6, 0.8], [0, 0], [1, 0]], rtol=1e-6)
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(7)
+    embeddings = rng.normal(size=(500, 64))
+    query = rng.normal(size=64)
+    matrix = normalise_rows(embeddings)
+    indices, scores = top_k(matrix, query, 5)
+    expected_scores = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query))
+    expected = np.argsort(expected_scores)[::-1][:5]
+    assert list(indices) == list(expected)
+    np.testing.assert_allclose(scores, expected_scores[expected], rtol=1e-4)
+
+
+def test_top_k_larger_than_matrix():
+    matrix = normalise_rows([[1, 0], [0, 1], [1, 1]])
+    indices, scores = top_k(matrix, [1, 0], 10)
+    assert list(indices) == [0, 2, 1]
+    assert len(scores) == 3
@@ -0,0 +1,132 @@
+import asyncio
+from unittest import mock
+
+from app.utils import slack
+from app.utils.slack import STREAMING_CURSOR, StreamingMessage, UpdateLimiter
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.edits = []
+
+    async def chat_update(self, channel, ts, text):
+        self.edits.append((ts, text))
+        return {"ok": True}
+
+
+def stream(clock, team_id, *steps):
+    """Runs (seconds elapsed, text) steps through a StreamingMessage and finishes it with the last text"""
+    client = FakeClient()
+
+    async def run():
+        message = StreamingMessage(client, "C1", "1.0", team_id)
+        for elapsed, text in steps:
+            clock.now += elapsed
+            await message.update(text)
+        await message.finish(steps[-1][1])
+
+    asyncio.run(run())
+    return [text for _, text in client.edits]
+
+
+@mock.patch.dict(slack._update_limiters, clear=True)
+def test_deltas_are_coalesced_and_the_last_text_is_always_sent():
+    clock = FakeClock()
+    with mock.patch.object(slack, "time", clock):
+        edits = stream(
+            clock, "T1", (0, "He"), (0.3, "Hello"), (0.3, "Hello wor"), (0.5, "Hello world"), (0.1, "Hello world!")
+        )
+    # one edit per second at most, the deltas in between are folded into the next edit
+    assert edits == ["He" + STREAMING_CURSOR, "Hello world" + STREAMING_CURSOR, "Hello world!"]
+
+
+@mock.patch.dict(slack._update_limiters, clear=True)
+def test_streamed_replies_in_a_workspace_share_its_rate_limit():
+    clock = FakeClock()
+    with mock.patch.object(slack, "time", clock), mock.patch.object(slack.asyncio, "sleep", clock.sleep):
+        slack._update_limiters["T1"] = UpdateLimiter(per_minute=60, burst=1)
+        first = stream(clock, "T1", (0, "one"), (1, "one two"))
+        # the workspace's edit was taken by the other reply, so only the final edit goes through once refilled
+        second = stream(clock, "T1", (0, "three"))
+        # another workspace has a limit of its own
+        other = stream(clock, "T2", (0, "four"), (1, "four five"))
+    assert first == ["one" + STREAMING_CURSOR, "one two" + STREAMING_CURSOR, "one two"]
+    assert second == ["three"]
+    assert other == ["four" + STREAMING_CURSOR, "four five" + STREAMING_CURSOR, "four five"]
+
+
+def test_abandoned_reply_deletes_its_placeholder_and_stops_its_stages():
+    client = mock.Mock()
+    client.chat_delete = mock.AsyncMock()
+
+    async def post():
+        return {"ok": True, "channel": "C1", "ts": "1.0"}
+
+    async def fail():
+        raise ValueError("tenant lookup failed")
+
+    async def run():
+        placeholder = asyncio.create_task(post())
+        failed, slow = asyncio.create_task(fail()), asyncio.create_task(asyncio.sleep(60))
+        await asyncio.sleep(0)
+        await slack.abandon_reply(client, placeholder, [failed, slow])
+        return failed, slow
+
+    failed, slow = asyncio.run(run())
+    client.chat_delete.assert_awaited_once_with(channel="C1", ts="1.0")
+    assert slow.cancelled()
+    assert isinstance(failed.exception(), ValueError)
+
+
+def test_abandoned_reply_without_a_placeholder_deletes_nothing():
+    client = mock.Mock()
+    client.chat_delete = mock.AsyncMock()
+
+    async def post():
+        raise ConnectionError("slack is down")
+
+    async def run():
+        await slack.abandon_reply(client, asyncio.create_task(post()), [])
+
+    asyncio.run(run())
+    client.chat_delete.assert_not_awaited()
+
+
+@mock.patch.dict(slack._bot_identities, clear=True)
+def test_bot_identity_falls_back_from_memory_to_the_db_to_auth_test():
+    stored = mock.Mock(org_id="org_1", bot_id="B1", bot_user_id="U1")
+    legacy = mock.Mock(org_id="org_2", bot_id=None, bot_user_id=None)
+    tenants = {"T1": mock.Mock(slack=stored), "T2": mock.Mock(slack=legacy)}
+    get_tenant = mock.AsyncMock(side_effect=lambda team_id: tenants[team_id])
+    prisma = mock.Mock()
+    prisma.slack.update = mock.AsyncMock()
+    client = mock.Mock()
+    client.auth_test = mock.AsyncMock(return_value={"bot_id": "B2", "user_id": "U2"})
+
+    async def run():
+        return [await slack.get_bot_identity(team_id, client) for team_id in ("T1", "T1", "T2", "T2")]
+
+    with mock.patch.object(slack, "get_tenant", get_tenant), mock.patch.object(slack, "prisma", prisma), \
+            mock.patch.object(slack, "invalidate_tenants", mock.AsyncMock()) as invalidate_tenants:
+        identities = asyncio.run(run())
+
+    assert [(i.bot_id, i.user_id) for i in identities] == [("B1", "U1"), ("B1", "U1"), ("B2", "U2"), ("B2", "U2")]
+    # each team is read from the DB once, then served from memory
+    assert [c.args[0] for c in get_tenant.await_args_list] == ["T1", "T2"]
+    # only the installation without a stored identity calls auth.test, and persists what it returns
+    client.auth_test.assert_awaited_once()
+    prisma.slack.update.assert_awaited_once_with(
+        where={"org_id": "org_2"}, data={"bot_id": "B2", "bot_user_id": "U2"}
+    )
+    invalidate_tenants.assert_awaited_once()
@@ -0,0 +1,29 @@
+import asyncio
+from unittest import mock
+
+from app.utils import tenant as tenant_module
+from app.utils.tenant import Tenant, TenantCache
+
+
+def test_tenant_cache_expires_and_follows_version():
+    cache = TenantCache(ttl=60)
+    tenant = Tenant(slack=mock.Mock(), organization=mock.Mock(), zendesk=None)
+    cache.set("T1", tenant, "1")
+    assert cache.get("T1", "1") is tenant
+    # another process bumped the tenant version after a configuration change
+    assert cache.get("T1", "2") is None
+    cache.set("T1", tenant, "2")
+    with mock.patch("app.utils.tenant.time.monotonic", return_value=10 ** 9):
+        assert cache.get("T1", "2") is None
+
+
+@mock.patch("app.utils.tenant.get_tenant_version", mock.AsyncMock(return_value="1"))
+def test_get_tenant_reads_the_database_once():
+    tenant = Tenant(slack=mock.Mock(), organization=mock.Mock(), zendesk=mock.Mock())
+    fetch = mock.AsyncMock(side_effect=[tenant, None])
+    with mock.patch("app.utils.tenant.fetch_tenant", fetch), \
+            mock.patch("app.utils.tenant.tenant_cache", TenantCache()):
+        assert asyncio.run(tenant_module.get_tenant("T1")) is tenant
+        assert asyncio.run(tenant_module.get_tenant("T1")) is tenant
+        assert asyncio.run(tenant_module.get_tenant("T2")) is None
+    assert fetch.await_count == 2
@@ -0,0 +1,22 @@
+import asyncio
+import time
+
+from app.utils.timer import StageTimings
+
+
+def test_stage_timings_overlap_concurrent_stages():
+    async def run():
+        timings = StageTimings()
+        started = time.perf_counter()
+        first = timings.start("first", asyncio.sleep(0.05, "a"))
+        second = timings.start("second", asyncio.sleep(0.05, "b"))
+        assert await asyncio.gather(first, second) == ["a", "b"]
+        # the two background stages ran side by side rather than one after the other
+        assert time.perf_counter() - started < 0.09
+        assert await timings.run("third", asyncio.sleep(0, "c")) == "c"
+        return timings
+
+    timings = asyncio.run(run())
+    assert list(timings.durations) == ["first", "second", "third"]
+    assert timings.durations["first"] >= 0.04
+    assert timings.summary().startswith("total=")
@@ -0,0 +1,75 @@
+import asyncio
+from unittest import mock
+
+from app.utils.zendesk import ZendeskGuideHarvester
+
+BASE = "https://acme.zendesk.com/api/v2/help_center"
+
+
+def article(i, section):
+    return {"id": i, "title": f"Article {i}", "body": f"<p>{i}</p>", "updated_at": "2023-07-01T00:00:00Z",
+            "html_url": f"https://acme.zendesk.com/hc/articles/{i}", "section_id": section}
+
+
+PAGES = {
+    f"{BASE}/sections.json": {
+        "sections": [{"id": 1, "name": "IT Queries"}], "meta": {"has_more": True}, "links": {"next": "sections-2"}
+    },
+    "sections-2": {"sections": [{"id": 2, "name": "Benefits"}], "meta": {"has_more": False}, "links": {"next": None}},
+    f"{BASE}/sections/1/articles.json": {
+        "articles": [article(1, 1), article(2, 1)], "meta": {"has_more": True}, "links": {"next": "articles-1-2"}
+    },
+    "articles-1-2": {"articles": [article(3, 1)], "meta": {"has_more": False}, "links": {"next": None}},
+    f"{BASE}/sections/2/articles.json": {
+        "articles": [article(4, 2)], "meta": {"has_more": False}, "links": {"next": None}
+    },
+}
+
+
+def test_articles_follow_cursors_across_sections():
+    async def get(url, params=None):
+        await asyncio.sleep(0.01)
+        return PAGES[url]
+
+    async def harvest():
+        harvester = ZendeskGuideHarvester("acme", "token")
+        with mock.patch.object(harvester, "_get", side_effect=get):
+            return [a async for a in harvester.articles()]
+
+    articles = asyncio.run(harvest())
+    assert sorted(a.id for a in articles) == [1, 2, 3, 4]
+    assert {a.id: a.category for a in articles} == {1: "IT", 2: "IT", 3: "IT", 4: "HR"}
+
+
+class FakeResponse(object):
+    def __init__(self, status, headers=None, body=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        assert self.status == 200
+
+    async def json(self):
+        return self.body
+
+
+def test_rate_limited_request_is_retried_after_retry_after():
+    responses = [FakeResponse(429, {"Retry-After": "0.05"}), FakeResponse(200, body={"sections": []})]
+
+    async def get():
+        harvester = ZendeskGuideHarvester("acme", "token")
+        harvester._semaphore = asyncio.Semaphore(1)
+        harvester._session = mock.Mock(get=mock.Mock(side_effect=responses))
+        return harvester, await harvester._get(f"{BASE}/sections.json")
+
+    harvester, page = asyncio.run(get())
+    assert page == {"sections": []}
+    assert harvester._session.get.call_count == 2
+    assert harvester._resume_at > 0
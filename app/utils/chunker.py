@@ -0,0 +1,112 @@
+import os
+import re
+from typing import List, NamedTuple, Tuple
+
+from bs4 import BeautifulSoup
+
+from app.utils.tokenizer import get_encoding
+
+CHUNK_TARGET_TOKENS = int(os.environ.get("CHUNK_TARGET_TOKENS", 400))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 50))
+
+HEADING_TAGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+BLOCK_TAGS = ["p", "div", "li", "ul", "ol", "pre", "blockquote", "table", "tr", "section", "article"]
+# marks a heading in the extracted text, a private use character that never appears in article content
+HEADING_MARK = "\ue000"
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+class Chunk(NamedTuple):
+    """A piece of an article small enough to embed on its own and to quote in a prompt"""
+    title: str
+    content: str
+    category: str
+    tokens: int
+    anchor: str  # id of the heading the chunk falls under, empty before the first heading
+
+
+def slugify(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+def sections(body: str) -> List[Tuple[str, List[str]]]:
+    """Splits an article's HTML into the paragraphs under each heading, as (anchor, paragraphs) with markup removed"""
+    soup = BeautifulSoup(body, "html.parser")
+    for br in soup.find_all("br"):
+        br.replace_with("\n")
+    for heading in soup.find_all(HEADING_TAGS):
+        text = heading.get_text(" ", strip=True)
+        anchor = heading.get("id") or slugify(text)
+        heading.replace_with(f"\n\n{HEADING_MARK}{anchor}{HEADING_MARK}{text}\n\n")
+    # get_text runs adjacent blocks together, so each block is ended with a blank line
+    for tag in soup.find_all(BLOCK_TAGS):
+        tag.append("\n\n")
+    result: List[Tuple[str, List[str]]] = [("", [])]
+    for paragraph in re.split(r"\n\s*\n", soup.get_text()):
+        paragraph = re.sub(r"\s+", " ", paragraph).strip()
+        if not paragraph:
+            continue
+        if paragraph.startswith(HEADING_MARK):
+            _, anchor, text = paragraph.split(HEADING_MARK, 2)
+            result.append((anchor, [text] if text else []))
+        else:
+            result[-1][1].append(paragraph)
+    return [(anchor, paragraphs) for anchor, paragraphs in result if paragraphs]
+
+
+def _windows(tokens: List[int], size: int, overlap: int) -> List[List[int]]:
+    step = max(1, size - overlap)
+    return [tokens[i: i + size] for i in range(0, max(1, len(tokens) - overlap), step)]
+
+
+def _joined_length(pieces: List[List[int]], separator: List[int]) -> int:
+    return sum(len(piece) for piece in pieces) + len(separator) * max(0, len(pieces) - 1)
+
+
+def chunk_article(
+    title: str,
+    body: str,
+    category: str,
+    target_tokens: int = CHUNK_TARGET_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+    encoding=None,
+) -> List[Chunk]:
+    """
+    Splits an article into chunks of at most `target_tokens` that never cross a heading. Whole paragraphs are packed
+    into each chunk and up to `overlap_tokens` of trailing paragraphs are repeated at the start of the next one. The
+    paragraphs are tokenized once, in one batch, and chunks are decoded from their tokens so the counts are exact.
+    """
+    encoding = encoding or get_encoding()
+    separator = encoding.encode(PARAGRAPH_SEPARATOR)
+    article_sections = sections(body)
+    encoded = iter(encoding.encode_batch([p for _, paragraphs in article_sections for p in paragraphs]))
+    chunks = []
+
+    def emit(pieces: List[List[int]], anchor: str):
+        tokens = [t for i, piece in enumerate(pieces) for t in (separator if i else []) + piece]
+        chunks.append(Chunk(title, encoding.decode(tokens), category, len(tokens), anchor))
+
+    for anchor, paragraphs in article_sections:
+        pieces = []
+        for tokens in (next(encoded) for _ in paragraphs):
+            # a paragraph longer than a chunk is cut into overlapping windows of tokens
+            pieces.extend(_windows(tokens, target_tokens, overlap_tokens) if len(tokens) > target_tokens else [tokens])
+        current: List[List[int]] = []
+        for piece in pieces:
+            if current and _joined_length(current + [piece], separator) > target_tokens:
+                emit(current, anchor)
+                carried: List[List[int]] = []
+                for previous in reversed(current):
+                    if _joined_length([previous] + carried, separator) > overlap_tokens:
+                        break
+                    carried.insert(0, previous)
+                current = carried if _joined_length(carried + [piece], separator) <= target_tokens else []
+            current.append(piece)
+        if current:
+            emit(current, anchor)
+    # an article with no body is still found by its title
+    return chunks or [Chunk(title, "", category, 0, "")]
+
+
+def chunk_articles(articles) -> List[Chunk]:
+    return [chunk for title, body, category in articles for chunk in chunk_article(title, body, category)]
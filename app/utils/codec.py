@@ -0,0 +1,151 @@
+"""
+Versioned serialisation for GPT conversation histories.
+
+Both the Redis conversation cache and `Issue.messageHistory` store histories in the same compact binary format:
+
+    header   magic (2 bytes) | version (1 byte) | flags (1 byte)
+    body     varint message count, then per message a role byte (an unknown role is written as 0xFF followed by a
+             varint length and its UTF-8 name) and the varint length and UTF-8 bytes of the content
+
+The body is zlib compressed when it is large enough for that to pay off (flag bit 0). Redis stores the bytes as they
+are. The MySQL column is text, so histories written there are armoured as a prefix plus base64. Histories written
+before the codec existed (JSON in Redis, a Python repr in MySQL) are still decoded.
+"""
+import ast
+import base64
+import json
+import os
+import zlib
+from typing import Dict, List
+
+MAGIC = b"\xa1\xcf"
+VERSION = 1
+FLAG_COMPRESSED = 0b00000001
+TEXT_PREFIX = "alfred:v1:"
+# compressing a handful of short messages costs more than it saves
+COMPRESSION_THRESHOLD = int(os.environ.get("CONVERSATION_COMPRESSION_THRESHOLD", 512))
+COMPRESSION_LEVEL = 6
+
+ROLES = ["system", "user", "assistant"]
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+CUSTOM_ROLE = 0xFF
+
+Messages = List[Dict[str, str]]
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _write_varint(buffer: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            buffer.append(byte | 0x80)
+        else:
+            buffer.append(byte)
+            return
+
+
+def _read_varint(data: memoryview, offset: int):
+    result = shift = 0
+    while True:
+        if offset >= len(data):
+            raise CodecError("Truncated conversation payload")
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def _write_string(buffer: bytearray, value: str):
+    encoded = value.encode("utf-8")
+    _write_varint(buffer, len(encoded))
+    buffer += encoded
+
+
+def _read_string(data: memoryview, offset: int):
+    length, offset = _read_varint(data, offset)
+    if offset + length > len(data):
+        raise CodecError("Truncated conversation payload")
+    return str(data[offset:offset + length], encoding="utf-8"), offset + length
+
+
+def encode_messages(messages: Messages, compression_threshold: int = COMPRESSION_THRESHOLD) -> bytes:
+    body = bytearray()
+    _write_varint(body, len(messages))
+    for message in messages:
+        role = message["role"]
+        if role in ROLE_CODES:
+            body.append(ROLE_CODES[role])
+        else:
+            body.append(CUSTOM_ROLE)
+            _write_string(body, role)
+        _write_string(body, message["content"])
+    flags = 0
+    payload = bytes(body)
+    if len(payload) >= compression_threshold:
+        compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+        if len(compressed) < len(payload):
+            flags |= FLAG_COMPRESSED
+            payload = compressed
+    return MAGIC + bytes([VERSION, flags]) + payload
+
+
+def _decode_binary(data: bytes) -> Messages:
+    if len(data) < 4:
+        raise CodecError("Truncated conversation header")
+    version, flags = data[2], data[3]
+    if version != VERSION:
+        raise CodecError(f"Unsupported conversation codec version {version}")
+    payload = data[4:]
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    view = memoryview(payload)
+    count, offset = _read_varint(view, 0)
+    messages = []
+    for _ in range(count):
+        if offset >= len(view):
+            raise CodecError("Truncated conversation payload")
+        code = view[offset]
+        offset += 1
+        if code == CUSTOM_ROLE:
+            role, offset = _read_string(view, offset)
+        elif code < len(ROLES):
+            role = ROLES[code]
+        else:
+            raise CodecError(f"Unknown role code {code}")
+        content, offset = _read_string(view, offset)
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def _decode_legacy(text: str) -> Messages:
+    # older redis entries were written with json.dumps, older issue rows with str(messages)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError) as e:
+        raise CodecError(f"Unrecognised conversation payload: {e}") from e
+
+
+def decode_messages(data: bytes | str) -> Messages:
+    """Decodes a history written by `encode_messages`, `encode_messages_text` or a legacy JSON/repr payload"""
+    if isinstance(data, str):
+        if data.startswith(TEXT_PREFIX):
+            return _decode_binary(base64.b64decode(data[len(TEXT_PREFIX):]))
+        return _decode_legacy(data)
+    if data.startswith(MAGIC):
+        return _decode_binary(data)
+    return decode_messages(str(data, encoding="utf-8"))
+
+
+def encode_messages_text(messages: Messages) -> str:
+    """Text-safe form of `encode_messages` for string columns"""
+    return TEXT_PREFIX + base64.b64encode(encode_messages(messages)).decode("ascii")
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import numpy as np
+from redis.exceptions import RedisError
+
+from app.redis.client import get_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 2048))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 60 * 60 * 24 * 7))
+CONTENT_EMBEDDING_CACHE_TTL = int(os.environ.get("CONTENT_EMBEDDING_CACHE_TTL", 60 * 60 * 24 * 30))
+
+
+def normalise_query(text: str) -> str:
+    """Lower-cases the query, collapses whitespace and drops trailing punctuation so near-identical queries match"""
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return text.rstrip("?!. ")
+
+
+def vector_to_bytes(vector) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def vector_from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class EmbeddingCache(object):
+    """
+    Two-tier cache of query embeddings keyed by model and normalised query text. Lookups check the in-process LRU
+    first and then Redis, where vectors are stored as raw float32 bytes with a TTL.
+    """
+
+    def __init__(self, prefix: str = "query_embedding", max_entries: int = EMBEDDING_CACHE_SIZE,
+                 ttl: int = EMBEDDING_CACHE_TTL):
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def key(self, model: str, text: str) -> str:
+        digest = hashlib.sha1(normalise_query(text).encode("utf-8")).hexdigest()
+        return f"{self.prefix}:{model}:{digest}"
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def get(self, model: str, text: str) -> np.ndarray | None:
+        key = self.key(model, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        try:
+            data = await get_redis().get_value(key)
+        except RedisError as e:
+            logger.warning(f"Could not read embedding from Redis: {e}")
+            data = None
+        if data:
+            vector = vector_from_bytes(data)
+            self._remember(key, vector)
+            self.redis_hits += 1
+            return vector
+        self.misses += 1
+        return None
+
+    async def set(self, model: str, text: str, vector):
+        key = self.key(model, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._remember(key, vector)
+        try:
+            await get_redis().add_to_cache(key, vector_to_bytes(vector), self.ttl)
+        except RedisError as e:
+            logger.warning(f"Could not write embedding to Redis: {e}")
+
+    async def get_or_create(self, text: str, model: str, embed: Callable[[str, str], Awaitable[list]]) -> np.ndarray:
+        vector = await self.get(model, text)
+        if vector is None:
+            vector = await embed(text, model)
+            await self.set(model, text, vector)
+        return vector
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.redis_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.redis_hits) / lookups if lookups else 0.0,
+        }
+
+
+query_embedding_cache = EmbeddingCache()
+
+
+class ContentEmbeddingCache(object):
+    """
+    Content-addressed cache of the embeddings made during knowledge base ingestion, keyed by model and a hash of the
+    exact text embedded. Chunks embedded before, by an earlier sync, another tenant or a failed run, are read back
+    from Redis and only the misses of a batch are sent to OpenAI. Blocking, as ingestion runs outside the event loop.
+    """
+
+    def __init__(self, prefix: str = "content_embedding", ttl: int = CONTENT_EMBEDDING_CACHE_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model: str, text: str) -> str:
+        return f"{self.prefix}:{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, model: str, texts: List[str]) -> List[np.ndarray | None]:
+        try:
+            values = get_sync_redis().client.mget([self.key(model, text) for text in texts])
+        except RedisError as e:
+            logger.warning(f"Could not read embeddings from Redis: {e}")
+            return [None] * len(texts)
+        return [vector_from_bytes(value) if value else None for value in values]
+
+    def set_many(self, model: str, texts: List[str], vectors):
+        try:
+            pipe = get_sync_redis().client.pipeline(transaction=False)
+            for text, vector in zip(texts, vectors):
+                pipe.setex(self.key(model, text), self.ttl, vector_to_bytes(vector))
+            pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Could not write embeddings to Redis: {e}")
+
+    def lookup(self, model: str, texts: List[str]) -> Tuple[List[np.ndarray | None], List[str]]:
+        """Returns the cached embedding of each text, None for a miss, and the distinct texts that missed"""
+        vectors = self.get_many(model, texts)
+        # a text repeated within the batch is embedded once
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return vectors, missing
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+content_embedding_cache = ContentEmbeddingCache()
@@ -0,0 +1,163 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List
+
+import openai
+from tqdm.auto import tqdm
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", 1_000_000))
+EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", 50_000))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 6))
+EMBEDDING_MAX_BACKOFF = float(os.environ.get("EMBEDDING_MAX_BACKOFF", 60))
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+
+def pack_batches(texts: List[str], tokens: List[int], max_tokens: int, max_items: int) -> List[List[int]]:
+    """Groups texts, in order, into batches of at most `max_tokens` tokens and `max_items` texts. Returns indices."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, count in enumerate(tokens):
+        if batch and (batch_tokens + count > max_tokens or len(batch) == max_items):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def retry_after(error: Exception) -> float | None:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBudget(object):
+    """
+    Thread-safe token bucket refilled at `tokens_per_minute` and holding at most a minute's worth. A rate limit
+    response drains it, so every batch waits rather than only the one that was rejected.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: int):
+        # a batch larger than the whole budget would never fit, it waits for a full bucket instead
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._refill()
+            self.available = min(self.available, 0.0) - seconds * self.rate
+
+
+class EmbeddingScheduler(object):
+    """
+    Embeds texts for bulk ingestion. Texts are packed into batches by token count and up to `max_concurrency`
+    batches are sent at once, paced by a tokens per minute budget. A batch that fails with a rate limit, timeout or
+    server error is retried with exponential backoff. `on_batch` is called with each batch as soon as it completes,
+    so a run that fails part way can be resumed without embedding the finished batches again.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[List[str], str], List[list]],
+        batch_size: int,
+        batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+    ):
+        self.embed = embed
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.budget = TokenBudget(tokens_per_minute)
+
+    def _embed_batch(self, texts: List[str], tokens: int, model: str) -> List[list]:
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(tokens)
+            try:
+                return self.embed(texts, model)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(EMBEDDING_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1)
+                if isinstance(e, openai.error.RateLimitError):
+                    self.budget.pause(delay)
+                logger.warning(f"Embedding batch of {len(texts)} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def run(
+        self,
+        texts: List[str],
+        tokens: List[int],
+        model: str,
+        on_batch: Callable[[List[str], List[list]], None] | None = None,
+    ) -> Dict[str, list]:
+        """Returns the embedding of each text. Raises the first batch error once every other batch has finished."""
+        batches = pack_batches(texts, tokens, self.batch_tokens, self.batch_size)
+        results: Dict[str, list] = {}
+        errors = []
+        progress = tqdm(total=len(texts), unit="text")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            futures = {
+                pool.submit(
+                    self._embed_batch, [texts[i] for i in batch], sum(tokens[i] for i in batch), model
+                ): [texts[i] for i in batch]
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    vectors = future.result()
+                except Exception as e:
+                    logger.error(f"Embedding batch of {len(batch)} failed: {e}")
+                    errors.append(e)
+                    continue
+                if on_batch is not None:
+                    on_batch(batch, vectors)
+                results.update(zip(batch, vectors))
+                progress.update(len(batch))
+        progress.close()
+        logger.info(f"Embedded {len(results)}/{len(texts)} texts in {len(batches)} batches")
+        if errors:
+            raise errors[0]
+        return results
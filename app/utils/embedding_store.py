@@ -0,0 +1,156 @@
+"""
+Binary on-disk format for knowledge bases.
+
+A store called <name> is made of three files that sit next to each other:
+    <name>.f32        raw row-major float32 matrix of L2-normalised embeddings
+    <name>.strings    UTF-8 blob holding the content of every chunk back to back
+    <name>.meta.json  shape of the matrix plus the title, category, token count and (offset, length) of each chunk
+
+Both binary files are opened with mmap, so every worker process shares the same pages through the OS page cache and
+only the chunks that are actually returned to the user get decoded.
+
+Convert an existing CSV knowledge base with:
+    python -m app.utils.embedding_store app/data/zendesk_vector_embeddings.csv
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+from collections.abc import Sequence
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from app.utils.knowledge_base import KnowledgeBase
+from app.utils.similarity import normalise_rows
+from app.utils.tokenizer import num_tokens_from_texts
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+MATRIX_SUFFIX = ".f32"
+STRINGS_SUFFIX = ".strings"
+META_SUFFIX = ".meta.json"
+
+
+class StringTable(Sequence):
+    """Read-only sequence of strings decoded on demand from a memory-mapped UTF-8 blob"""
+
+    def __init__(self, blob, offsets, lengths):
+        self._blob = blob
+        self._offsets = offsets
+        self._lengths = lengths
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        offset = self._offsets[i]
+        return bytes(self._blob[offset:offset + self._lengths[i]]).decode("utf-8")
+
+
+def write_store(knowledge_base: KnowledgeBase, base_path: str):
+    """Writes a knowledge base to disk. Each file is written to a temporary path first and then moved into place."""
+    matrix = normalise_rows(knowledge_base.embeddings)
+    # suffix temporary files with the pid so concurrent workers converting the same CSV don't clobber each other
+    tmp = f".{os.getpid()}.tmp"
+    records = []
+    offset = 0
+    with open(base_path + STRINGS_SUFFIX + tmp, "wb") as strings_file:
+        for title, content, category, tokens in zip(
+            knowledge_base.titles, knowledge_base.content, knowledge_base.categories, knowledge_base.tokens
+        ):
+            encoded = content.encode("utf-8")
+            strings_file.write(encoded)
+            records.append(
+                {"title": title, "category": category, "tokens": tokens, "offset": offset, "length": len(encoded)}
+            )
+            offset += len(encoded)
+    with open(base_path + MATRIX_SUFFIX + tmp, "wb") as matrix_file:
+        matrix.tofile(matrix_file)
+    meta = {
+        "version": STORE_VERSION,
+        "dtype": "float32",
+        "rows": int(matrix.shape[0]),
+        "dim": int(matrix.shape[1]),
+        "records": records,
+    }
+    with open(base_path + META_SUFFIX + tmp, "w") as meta_file:
+        json.dump(meta, meta_file)
+    # the metadata file is moved last so a reader never sees it before the data it describes
+    for suffix in (STRINGS_SUFFIX, MATRIX_SUFFIX, META_SUFFIX):
+        os.replace(base_path + suffix + tmp, base_path + suffix)
+
+
+def _map_file(path: str):
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _record_tokens(records, content):
+    tokens = [record.get("tokens") for record in records]
+    # stores written before token counts were recorded are tokenised once when opened
+    return num_tokens_from_texts(content) if None in tokens else tokens
+
+
+def open_store(base_path: str) -> KnowledgeBase:
+    """Opens a knowledge base store without copying or parsing the embedding matrix"""
+    with open(base_path + META_SUFFIX) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != STORE_VERSION:
+        raise ValueError(f"Unsupported embedding store version {meta['version']} at {base_path}")
+    records = meta["records"]
+    if meta["rows"]:
+        embeddings = np.memmap(
+            base_path + MATRIX_SUFFIX, dtype=np.float32, mode="r", shape=(meta["rows"], meta["dim"])
+        )
+    else:
+        embeddings = np.empty((0, meta["dim"]), dtype=np.float32)
+    content = StringTable(
+        _map_file(base_path + STRINGS_SUFFIX),
+        [record["offset"] for record in records],
+        [record["length"] for record in records],
+    )
+    return KnowledgeBase(
+        titles=[record["title"] for record in records],
+        content=content,
+        categories=[record["category"] for record in records],
+        embeddings=embeddings,
+        tokens=_record_tokens(records, content),
+    )
+
+
+def store_exists(base_path: str) -> bool:
+    return os.path.exists(base_path + META_SUFFIX)
+
+
+def convert_csv_to_store(csv_path: str, base_path: str | None = None) -> str:
+    """One-off conversion of a CSV knowledge base (titles, content, categories, embedding) into a binary store"""
+    base_path = base_path or os.path.splitext(csv_path)[0]
+    df = pd.read_csv(csv_path, dtype={"titles": str, "content": str, "categories": str, "embedding": str})
+    write_store(KnowledgeBase.from_dataframe(df), base_path)
+    logger.info(f"Converted {len(df)} rows from {csv_path} into {base_path}")
+    return base_path
+
+
+@lru_cache(maxsize=None)
+def load_csv_knowledge_base(csv_path: str) -> KnowledgeBase:
+    """Opens the binary store next to a CSV knowledge base, converting the CSV on first use if it is missing"""
+    base_path = os.path.splitext(csv_path)[0]
+    if not store_exists(base_path) or os.path.getmtime(csv_path) > os.path.getmtime(base_path + META_SUFFIX):
+        convert_csv_to_store(csv_path, base_path)
+    return open_store(base_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a CSV knowledge base into a binary embedding store")
+    parser.add_argument("csv_path")
+    parser.add_argument("--out", help="base path of the store (defaults to the CSV path without its extension)")
+    args = parser.parse_args()
+    print(f"Saved embedding store to {convert_csv_to_store(args.csv_path, args.out)}")
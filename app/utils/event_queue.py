@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List
+
+from redis.exceptions import ResponseError, RedisError
+
+from app.redis.client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# each worker holds one pooled redis connection while it blocks waiting for events
+EVENT_QUEUE_WORKERS = int(os.environ.get("EVENT_QUEUE_WORKERS", 8))
+# events of different ordering keys handled at once by the owner of a shard
+EVENT_QUEUE_CONCURRENCY = int(os.environ.get("EVENT_QUEUE_CONCURRENCY", 16))
+EVENT_QUEUE_BLOCK_MS = int(os.environ.get("EVENT_QUEUE_BLOCK_MS", 5000))
+# a failing event is retried, including after being reclaimed from a dead consumer, until it has been tried this often
+EVENT_QUEUE_MAX_ATTEMPTS = int(os.environ.get("EVENT_QUEUE_MAX_ATTEMPTS", 3))
+EVENT_QUEUE_RETRY_DELAY = float(os.environ.get("EVENT_QUEUE_RETRY_DELAY", 1))
+# a process owns a shard for this long unless it renews its lease, a shard whose owner died is taken over after it
+EVENT_QUEUE_LEASE_MS = int(os.environ.get("EVENT_QUEUE_LEASE_MS", 30000))
+
+Event = Dict[str, str]
+
+# stream entry field holding the ordering key of the event
+ORDERING_KEY_FIELD = "ordering_key"
+
+# renews a stream lease, or releases it when ARGV[2] is 0, only if it is still held by the consumer ARGV[1]
+RENEW_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == "0" then
+    return redis.call("DEL", KEYS[1])
+end
+return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+"""
+
+
+def unique_consumer_name() -> str:
+    """
+    A consumer name no other process uses, now or after a restart, so that no two processes ever read each other's
+    pending entries. Entries left pending by a process that died are reclaimed explicitly instead.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class StreamLease(object):
+    """
+    Exclusive ownership of a stream by one consumer. The lease is held in redis for `lease_ms` and renewed in the
+    background while its holder works, so another process takes the stream over if the holder dies.
+    """
+
+    def __init__(self, key: str, consumer: str, lease_ms: int = EVENT_QUEUE_LEASE_MS):
+        self.key = key
+        self.consumer = consumer
+        self.lease_ms = lease_ms
+
+    async def acquire(self) -> bool:
+        try:
+            return bool(await get_redis().client.set(self.key, self.consumer, nx=True, px=self.lease_ms))
+        except (ResponseError, RedisError) as e:
+            logger.error(f"Error acquiring {self.key}: {e}")
+            return False
+
+    async def _renew(self, lease_ms: int) -> bool:
+        return bool(await get_redis().client.eval(RENEW_LEASE_SCRIPT, 1, self.key, self.consumer, lease_ms))
+
+    async def _keep(self, lost: asyncio.Event):
+        while True:
+            await asyncio.sleep(self.lease_ms / 3000)
+            try:
+                renewed = await self._renew(self.lease_ms)
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error renewing {self.key}: {e}")
+                renewed = False
+            if not renewed:
+                lost.set()
+                return
+
+    @asynccontextmanager
+    async def held(self):
+        """Waits until the lease is acquired and keeps it renewed. Yields an event that is set if the lease is lost."""
+        while not await self.acquire():
+            await asyncio.sleep(self.lease_ms / 3000)
+        lost = asyncio.Event()
+        keeper = asyncio.create_task(self._keep(lost))
+        try:
+            yield lost
+        finally:
+            keeper.cancel()
+            await asyncio.gather(keeper, return_exceptions=True)
+            try:
+                await self._renew(0)
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error releasing {self.key}: {e}")
+        logger.warning(f"Lost {self.key}")
+
+
+async def claim_abandoned(stream: str, group: str, consumer: str, min_idle_ms: int, count: int = 100) -> List | None:
+    """
+    Claims the entries of a stream delivered to another consumer and left unacknowledged for `min_idle_ms`, i.e. by a
+    consumer that is gone. Returns None once no entry is pending for any consumer.
+    """
+    client = get_redis().client
+    if not (await client.xpending(stream, group))["pending"]:
+        return None
+    return (await client.xautoclaim(stream, group, consumer, min_idle_ms, "0-0", count=count))[1]
+
+
+async def delivery_counts(stream: str, group: str, consumer: str, entry_ids: List) -> Dict[str, int]:
+    """How many times each of the consumer's pending entries has been delivered, claims included"""
+    if not entry_ids:
+        return {}
+    pending = await get_redis().client.xpending_range(
+        stream, group, min=entry_ids[0], max=entry_ids[-1], count=len(entry_ids), consumername=consumer
+    )
+    return {_decode(entry["message_id"]): entry["times_delivered"] for entry in pending}
+
+
+async def remove_idle_consumers(stream: str, group: str, consumer: str):
+    """Forgets the consumers with nothing pending, a new one is created each time a process starts"""
+    client = get_redis().client
+    try:
+        for other in await client.xinfo_consumers(stream, group):
+            if _decode(other["name"]) != consumer and not other["pending"]:
+                await client.xgroup_delconsumer(stream, group, other["name"])
+    except (ResponseError, RedisError) as e:
+        logger.error(f"Error removing old consumers of {stream}: {e}")
+
+
+class EventQueue(object):
+    """
+    Durable queue of incoming events backed by redis streams.
+
+    Events are split across `workers` streams by their ordering key. Each stream is consumed by exactly one process at
+    a time, the one holding the stream's lease; every other process stands by to take the stream over if the owner
+    stops renewing its lease. The owner handles up to `concurrency` events of a stream at once, but events sharing an
+    ordering key one after another, so they are processed in the order they arrived even with several replicas.
+
+    An entry is acknowledged and deleted once it has been handled. A failing event is retried up to `max_attempts`
+    times and stays pending meanwhile. A process taking over a stream first claims and handles the entries its previous
+    owner was delivered but never acknowledged, before reading new ones.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Event], Awaitable],
+        workers: int = EVENT_QUEUE_WORKERS,
+        consumer: str | None = None,
+        lease_ms: int = EVENT_QUEUE_LEASE_MS,
+        concurrency: int = EVENT_QUEUE_CONCURRENCY,
+        max_attempts: int = EVENT_QUEUE_MAX_ATTEMPTS,
+    ):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.consumer = consumer or unique_consumer_name()
+        self.lease_ms = lease_ms
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._tasks: List[asyncio.Task] = []
+
+    def stream(self, key: str) -> str:
+        # crc32 rather than hash() so that every process routes a key to the same shard
+        return f"{self.name}:{zlib.crc32(key.encode()) % self.workers}"
+
+    async def enqueue(self, key: str, event: Event) -> str:
+        # not capped with maxlen, which could trim entries never delivered, handled entries are deleted instead
+        return await get_redis().client.xadd(self.stream(key), {**event, ORDERING_KEY_FIELD: key})
+
+    async def start(self):
+        if self._tasks:
+            return
+        for shard in range(self.workers):
+            stream = f"{self.name}:{shard}"
+            try:
+                await get_redis().client.xgroup_create(stream, self.name, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self._tasks.append(asyncio.create_task(self._consume(stream)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _consume(self, stream: str):
+        while True:
+            async with StreamLease(f"{stream}:owner", self.consumer, self.lease_ms).held() as lost:
+                shard = _Shard(self, stream)
+                try:
+                    await self._reclaim(shard)
+                    await self._read(shard, lost)
+                finally:
+                    # events already started are finished before the lease is released
+                    await shard.drain()
+
+    async def _reclaim(self, shard: "_Shard"):
+        """Handles, in order, the entries delivered to previous owners of the stream and never acknowledged"""
+        while True:
+            try:
+                # an entry becomes claimable once it has been idle for a lease, i.e. its consumer is surely gone
+                claimed = await claim_abandoned(shard.stream, self.name, self.consumer, self.lease_ms)
+                delivered = await delivery_counts(
+                    shard.stream, self.name, self.consumer, [entry_id for entry_id, _ in claimed or []]
+                )
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error reclaiming entries of {shard.stream}: {e}")
+                await asyncio.sleep(1)
+                continue
+            if claimed is None:
+                break
+            if not claimed:
+                await asyncio.sleep(1)
+                continue
+            for entry_id, fields in claimed:
+                if fields:
+                    await shard.dispatch(entry_id, fields, delivered.get(_decode(entry_id), 1))
+            # claimed entries stay pending until handled, so they are finished before looking for more
+            await shard.drain()
+        await remove_idle_consumers(shard.stream, self.name, self.consumer)
+
+    async def _read(self, shard: "_Shard", lost: asyncio.Event):
+        while not lost.is_set():
+            try:
+                response = await get_redis().client.xreadgroup(
+                    self.name, self.consumer, {shard.stream: ">"}, count=self.concurrency, block=EVENT_QUEUE_BLOCK_MS
+                )
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error reading from {shard.stream}: {e}")
+                await asyncio.sleep(1)
+                continue
+            entries = response[0][1] if response else []
+            for entry_id, fields in entries:
+                await shard.dispatch(entry_id, fields)
+
+    async def _handle(self, stream: str, entry_id: str, event: Event, delivered: int = 1):
+        if delivered > self.max_attempts:
+            logger.error(f"Dropping event {_decode(entry_id)} from {stream}, delivered {delivered} times")
+        for attempt in range(delivered, self.max_attempts + 1):
+            try:
+                await self.handler(event)
+                break
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    # given up on rather than redelivered forever
+                    logger.exception(f"Error processing event {_decode(entry_id)} from {stream}, dropping it: {e}")
+                    break
+                logger.warning(f"Error processing event {_decode(entry_id)} from {stream} (attempt {attempt}): {e}")
+                await asyncio.sleep(EVENT_QUEUE_RETRY_DELAY * attempt)
+        try:
+            async with get_redis().client.pipeline(transaction=True) as pipe:
+                pipe.xack(stream, self.name, entry_id)
+                pipe.xdel(stream, entry_id)
+                await pipe.execute()
+        except (ResponseError, RedisError) as e:
+            logger.error(f"Error acknowledging event {_decode(entry_id)} from {stream}: {e}")
+
+
+class _Shard(object):
+    """
+    The events of one stream being handled by its owner. Each event is chained after the last event dispatched with
+    the same ordering key, and at most `concurrency` events are dispatched and not yet finished.
+    """
+
+    def __init__(self, queue: EventQueue, stream: str):
+        self.queue = queue
+        self.stream = stream
+        self.slots = asyncio.Semaphore(queue.concurrency)
+        self.tails: Dict[str, asyncio.Task] = {}
+
+    async def dispatch(self, entry_id: str, fields: dict, delivered: int = 1):
+        event = {_decode(k): _decode(v) for k, v in fields.items()}
+        key = event.pop(ORDERING_KEY_FIELD, "")
+        await self.slots.acquire()
+        task = asyncio.create_task(self._handle_after(self.tails.get(key), entry_id, event, delivered))
+        self.tails[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+
+    async def _handle_after(self, previous: asyncio.Task | None, entry_id: str, event: Event, delivered: int):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.queue._handle(self.stream, entry_id, event, delivered)
+        finally:
+            self.slots.release()
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+    async def drain(self):
+        while self.tails:
+            await asyncio.gather(*self.tails.values(), return_exceptions=True)
@@ -1,18 +1,21 @@
 import json
 import os
+from functools import lru_cache
 from pprint import pprint
-from typing import List, Dict, Literal
+from typing import List, Dict, Literal, Callable, Awaitable
 
 import random
 import numpy as np
 import openai
 import pandas as pd
-import tiktoken
 import httpx, asyncio
-from openai.embeddings_utils import cosine_similarity, get_embedding
 from prisma.models import Zendesk
 
-from app.utils.helpers import convert_csv_embeddings_to_floats, validate_ticket_object, border_asterisk, border_line
+from app.utils.embedding_cache import query_embedding_cache
+from app.utils.llm import llm_client
+from app.utils.tokenizer import num_tokens_from_text, num_tokens_from_template
+from app.utils.helpers import validate_ticket_object, border_asterisk, border_line
+from app.utils.retrieval import RetrievalBackend, DEFAULT_NAMESPACE
 from app.utils.types import Message, Profile, ZendeskOAuthCredentials
 
 openai.api_key = os.environ["OPENAI_API_KEY"]
@@ -60,63 +63,32 @@ def classify_issue(query: str):
     return random.choice(categories)
 
 
-def num_tokens_from_text(string: str, encoding_name: str = "cl100k_base") -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
-
-def strings_ranked_by_relatedness_from_csv(
-    query: str, df: pd.DataFrame, relatedness_fn=lambda x, y: cosine_similarity(x, y), top_n: int = 100
-) -> tuple[list[str], list[float], list[np.ndarray]]:
-    """Returns a list of strings and relatednesses, sorted from most related to least."""
-    question_vector = get_embedding(query, EMBEDDING_MODEL)
-    strings_and_relatednesses = []
-    for i, row in df.iterrows():
-        knowledge_base_embedding = convert_csv_embeddings_to_floats(row["embedding"])
-        item = (
-            row["content"],
-            relatedness_fn(np.array(question_vector), knowledge_base_embedding),
-            knowledge_base_embedding,
-        )
-        strings_and_relatednesses.append(item)
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-    strings, relatednesses, embedding = zip(*strings_and_relatednesses)
-    return strings[:top_n], relatednesses[:top_n], embedding[:top_n]
-
-
-def strings_ranked_by_relatedness_from_pinecone(
-    query: str, df: pd.DataFrame, relatedness_fn=lambda x, y: cosine_similarity(x, y), top_n: int = 100
-) -> tuple[list[str], list[float], list[np.ndarray]]:
-    """Returns a list of strings and relatednesses, sorted from most related to least."""
-    question_vector = get_embedding(query, EMBEDDING_MODEL)
-    strings_and_relatednesses = [
-        (row["content"], relatedness_fn(row["embedding"], question_vector), row["embedding"])
-        for i, row in df.iterrows()
-    ]
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-    strings, relatednesses, embedding = zip(*strings_and_relatednesses)
-    return strings[:top_n], relatednesses[:top_n], embedding[:top_n]
+async def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> list[float]:
+    return await llm_client.embedding(text, model)
 
 
-async def get_similarities(
-    query: str, df: pd.DataFrame, source: Literal["csv", "pinecone"] = "pinecone"
-) -> pd.DataFrame:
-    SCORES = []
-    ANSWERS = []
-    EMBEDDINGS = []
-    if source == "csv":
-        strings, relatednesses, embeddings = strings_ranked_by_relatedness_from_csv(query, df, top_n=3)
-    else:
-        strings, relatednesses, embeddings = strings_ranked_by_relatedness_from_pinecone(query, df, top_n=3)
+async def embed_query(query: str) -> np.ndarray:
+    # repeated questions are served from the embedding cache instead of another round trip to OpenAI
+    return await query_embedding_cache.get_or_create(query, EMBEDDING_MODEL, get_embedding)
 
-    for string, relatedness, embedding in zip(strings, relatednesses, embeddings):
-        ANSWERS.append(string)
-        SCORES.append("%.3f" % relatedness)
-        EMBEDDINGS.append(embedding)
 
-    results = pd.DataFrame({"answers": ANSWERS, "match_scores": SCORES, "embeddings": EMBEDDINGS})
+async def get_similarities(
+    query: str, backend: RetrievalBackend, namespace: str = DEFAULT_NAMESPACE, top_n: int = 3, question_vector=None
+) -> pd.DataFrame:
+    """
+    Embeds the query and returns the top n most related knowledge base chunks from the retrieval backend. Callers that
+    embedded the query ahead of time pass the vector in.
+    """
+    if question_vector is None:
+        question_vector = await embed_query(query)
+    matches = await backend.query(question_vector, top_n, namespace)
+    results = pd.DataFrame(
+        {
+            "answers": [match.content for match in matches],
+            "match_scores": ["%.3f" % match.score for match in matches],
+            "tokens": [match.tokens for match in matches],
+        }
+    )
     return results
 
 
@@ -129,9 +101,13 @@ def generate_context_array(results: pd.DataFrame) -> str:
     return context
 
 
-def query_message(query: str, context: str, company: str, token_budget: int, sender_name: str = "Ola") -> str:
-    """Return a message for GPT, with relevant source texts pulled from a dataframe."""
-    introduction = f"""Your name is Alfred. You are an AI-powered assistant designed to help employees with HR and IT questions at {company}. You have been programmed to provide fast and accurate solutions to their inquiries. As an AI, you do not have a gender, age, sexual orientation or human race.
+CONTEXT_PREFIX = '\n\nContext:\n"""\n'
+CONTEXT_SUFFIX = '\n"""'
+
+
+@lru_cache(maxsize=256)
+def introduction_prompt(company: str, sender_name: str) -> str:
+    return f"""Your name is Alfred. You are an AI-powered assistant designed to help employees with HR and IT questions at {company}. You have been programmed to provide fast and accurate solutions to their inquiries. As an AI, you do not have a gender, age, sexual orientation or human race.
 
 As an experienced assistant, you can create Zendesk tickets and forward complex inquiries to the appropriate person.
 
@@ -146,37 +122,86 @@ For general responses by the user you should answer as a normal human assistant
 If a question is outside your scope, you will make a note of it and store it as a "knowledge gap" to learn and improve. It is important to address employees in a friendly and compassionate tone, speaking to them in first person terms.
 
 Please feel free to answer any HR or IT related questions."""
+
+
+def count_context_tokens(results: pd.DataFrame) -> int:
+    """Token count of the context built by generate_context_array, from the per-chunk counts stored with the chunks."""
+    if not len(results):
+        return 0
+    # chunks are joined with a newline, which is a single token
+    return int(results["tokens"].sum()) + len(results) - 1
+
+
+def query_message(
+    query: str,
+    context: str,
+    company: str,
+    token_budget: int,
+    sender_name: str = "Ola",
+    context_tokens: int | None = None
+) -> str:
+    """Return a message for GPT, with relevant source texts pulled from a dataframe."""
+    introduction = introduction_prompt(company, sender_name)
     question = f"\n\nQuestion: {query}"
+    if context_tokens is None:
+        context_tokens = num_tokens_from_text(context)
+    # the static parts of the prompt are tokenised once, so budgeting is mostly integer addition
+    num_tokens = (
+        num_tokens_from_template(introduction)
+        + num_tokens_from_template(CONTEXT_PREFIX + CONTEXT_SUFFIX)
+        + context_tokens
+        + num_tokens_from_text(question)
+    )
     message = introduction
-    context = f'\n\nContext:\n"""\n{context}\n"""'
-    num_tokens = num_tokens_from_text(message + context + question)
     if num_tokens > token_budget:
         print(f"Question too long: {num_tokens} tokens")
     else:
-        message += context
+        message += CONTEXT_PREFIX + context + CONTEXT_SUFFIX
 
     return message + question
 
 
+async def complete_chat(
+    messages: List[Dict[str, str]], on_delta: Callable[[str], Awaitable[None]] | None = None
+) -> str:
+    """
+    Returns the sanitized chat completion for the messages. When `on_delta` is given the completion is streamed and
+    the callback receives the accumulated text every time a new piece arrives.
+    """
+    if on_delta is None:
+        response = await llm_client.chat_completion(messages, CHAT_COMPLETIONS_MODEL, temperature=0)
+        return response['choices'][0]['message']['content'].strip(" \n")
+    content = ""
+    async for delta in llm_client.stream_chat_completion(messages, CHAT_COMPLETIONS_MODEL, temperature=0):
+        content += delta
+        await on_delta(content)
+    return content.strip(" \n")
+
+
 async def generate_gpt_chat_response(
     question: str,
     context: str,
     sender_name: str = "Ola",
-    company: str = "Omnicentra"
+    company: str = "Omnicentra",
+    on_delta: Callable[[str], Awaitable[None]] | None = None,
+    context_tokens: int | None = None
 ):
-    message = query_message(question, context, company, MAX_INPUT_TOKENS, sender_name)
+    message = query_message(question, context, company, MAX_INPUT_TOKENS, sender_name, context_tokens)
     messages = [
         {"role": "system", "content": f"Your name is Alfred. You are a helpful assistant that answers HR and IT questions at {company}"},
         {"role": "user", "content": message},
     ]
-    response = openai.ChatCompletion.create(model=CHAT_COMPLETIONS_MODEL, messages=messages, temperature=0)
-    sanitized_response = response['choices'][0]['message']['content'].strip(" \n").strip(" \n")
+    sanitized_response = await complete_chat(messages, on_delta)
     messages.append({"role": "assistant", "content": sanitized_response})
     return sanitized_response, messages
 
 
 async def continue_chat_response(
-    query: str, context: str, messages: List[Dict[str, str]], is_question: bool = False
+    query: str,
+    context: str,
+    messages: List[Dict[str, str]],
+    is_question: bool = False,
+    on_delta: Callable[[str], Awaitable[None]] | None = None
 ) -> object:
     if is_question:
         message = Message(role="user", content=f"{query}\n\nContext: {context}")
@@ -186,8 +211,7 @@ async def continue_chat_response(
     print(message.to_dict())
     print("*" * 100)
     messages.append(message.to_dict())
-    response = openai.ChatCompletion.create(model=CHAT_COMPLETIONS_MODEL, messages=messages, temperature=0)
-    sanitized_response = response['choices'][0]['message']['content'].strip(" \n").strip(" \n")
+    sanitized_response = await complete_chat(messages, on_delta)
     messages.append({"role": "assistant", "content": sanitized_response})
     return sanitized_response, messages
 
@@ -209,14 +233,8 @@ async def send_zendesk_ticket(
     ]
 
     completion = (
-        openai.ChatCompletion.create(
-            messages=messages,
-            temperature=0,
-            model=CHAT_COMPLETIONS_MODEL,
-        )
-    )[
-        'choices'
-    ][0]['message']['content']
+        await llm_client.chat_completion(messages, CHAT_COMPLETIONS_MODEL, temperature=0)
+    )['choices'][0]['message']['content']
     pprint(completion)
     data: Dict = json.loads(completion.replace("`", "").strip())
     # Set up the authentication credentials
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List
+
+from redis.exceptions import ResponseError, RedisError
+
+from app.db.prisma_client import prisma
+from app.redis.client import get_redis
+from app.utils.event_queue import StreamLease, claim_abandoned, remove_idle_consumers, unique_consumer_name
+
+logger = logging.getLogger(__name__)
+
+ISSUE_STREAM_KEY = "issue_events"
+ISSUE_WRITER_GROUP = "issue_writer"
+ISSUE_WRITER_BATCH = int(os.environ.get("ISSUE_WRITER_BATCH", 200))
+# how long the writer waits for turns before flushing whatever it has, i.e. how far the database trails the replies
+ISSUE_WRITER_BLOCK_MS = int(os.environ.get("ISSUE_WRITER_BLOCK_MS", 1000))
+ISSUE_WRITER_RETRY_DELAY = float(os.environ.get("ISSUE_WRITER_RETRY_DELAY", 5))
+# one writer at a time flushes the stream, another process takes over if it stops renewing its lease
+ISSUE_WRITER_LEASE_MS = int(os.environ.get("ISSUE_WRITER_LEASE_MS", 30000))
+
+IssueEvent = Dict[str, str]
+
+# columns written on every turn, the rest are only set when the issue is created
+UPDATE_FIELDS = ("issue_id", "celery_task_id", "employee_id", "employee_name", "employee_email", "category")
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def coalesce(events: List[IssueEvent]) -> List[IssueEvent]:
+    """
+    Folds consecutive turns of a conversation into one write. A turn that updates an issue only overrides the fields
+    of the write before it, a turn that creates an issue starts a new write.
+    """
+    writes: List[IssueEvent] = []
+    latest: Dict[str, IssueEvent] = {}
+    for event in events:
+        previous = latest.get(event["conversation_id"])
+        if event["kind"] == "update" and previous is not None:
+            previous.update({k: v for k, v in event.items() if k != "kind"})
+            continue
+        write = dict(event)
+        writes.append(write)
+        latest[event["conversation_id"]] = write
+    return writes
+
+
+def _update_data(write: IssueEvent) -> dict:
+    data = {field: write[field] for field in UPDATE_FIELDS}
+    return {**data, "messageHistory": write["messages"], "status": "open"}
+
+
+def _create_data(write: IssueEvent) -> dict:
+    return {
+        **_update_data(write),
+        "conversation_id": write["conversation_id"],
+        "org_id": write["org_id"],
+        "org_name": write["org_name"],
+        "channel": "slack",
+        "is_satisfied": False,
+    }
+
+
+async def write_issues(writes: List[IssueEvent]):
+    """Applies a batch of coalesced writes in one transaction"""
+    conversation_ids = list({w["conversation_id"] for w in writes if w["kind"] == "update"})
+    created_ids = [w["issue_id"] for w in writes if w["kind"] == "create"]
+    open_issues = {}
+    if conversation_ids:
+        # newest first, so the first issue seen for a conversation is its latest open issue
+        for issue in await prisma.issue.find_many(
+            where={"conversation_id": {"in": conversation_ids}, "status": "open"},
+            order={"created_at": "desc"},
+        ):
+            open_issues.setdefault(issue.conversation_id, issue)
+    # a replayed batch finds the issues it created the first time round and updates them instead, an issue is only
+    # taken for the one it created if it also belongs to the same conversation
+    existing = set()
+    if created_ids:
+        existing = {
+            (issue.issue_id, issue.conversation_id)
+            for issue in await prisma.issue.find_many(where={"issue_id": {"in": created_ids}})
+        }
+    async with prisma.batch_() as batcher:
+        for write in writes:
+            if write["kind"] == "create" and (write["issue_id"], write["conversation_id"]) in existing:
+                batcher.issue.update(where={"issue_id": write["issue_id"]}, data=_update_data(write))
+            elif write["kind"] == "create":
+                batcher.issue.create(data=_create_data(write))
+            elif write["conversation_id"] in open_issues:
+                batcher.issue.update(
+                    where={"id": open_issues[write["conversation_id"]].id}, data=_update_data(write)
+                )
+            else:
+                # the issue was resolved, a turn arriving after that is not reopened as a new issue
+                logger.warning(f"No open issue for conversation {write['conversation_id']}, dropping the turn")
+
+
+class IssueWriter(object):
+    """
+    Write-behind persistence of issues. Each turn of a conversation is appended to a redis stream on the reply path,
+    and a background task flushes the stream to the database in batches. Only the process holding the writer lease
+    flushes, so turns are written in the order they were recorded. Entries are acknowledged only once their batch
+    has been committed, so turns queued before a crash are written by whichever process takes the lease over.
+    """
+
+    def __init__(
+        self, batch_size: int = ISSUE_WRITER_BATCH, consumer: str | None = None, lease_ms: int = ISSUE_WRITER_LEASE_MS
+    ):
+        self.batch_size = batch_size
+        self.consumer = consumer or unique_consumer_name()
+        self.lease_ms = lease_ms
+        self._task: asyncio.Task | None = None
+
+    async def record(self, event: IssueEvent):
+        await get_redis().client.xadd(ISSUE_STREAM_KEY, event)
+
+    async def start(self):
+        if self._task is not None:
+            return
+        try:
+            await get_redis().client.xgroup_create(ISSUE_STREAM_KEY, ISSUE_WRITER_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            async with StreamLease(f"{ISSUE_STREAM_KEY}:owner", self.consumer, self.lease_ms).held() as lost:
+                await self._reclaim()
+                await self._read(lost)
+
+    async def _reclaim(self):
+        """Writes the turns a previous writer read but never committed, before any newer turn"""
+        while True:
+            try:
+                claimed = await claim_abandoned(
+                    ISSUE_STREAM_KEY, ISSUE_WRITER_GROUP, self.consumer, self.lease_ms, self.batch_size
+                )
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error reclaiming issue events: {e}")
+                claimed = []
+            if claimed is None:
+                break
+            if not claimed or not await self.flush([(entry_id, fields) for entry_id, fields in claimed if fields]):
+                await asyncio.sleep(ISSUE_WRITER_RETRY_DELAY)
+        await remove_idle_consumers(ISSUE_STREAM_KEY, ISSUE_WRITER_GROUP, self.consumer)
+
+    async def _read(self, lost: asyncio.Event):
+        # ">" reads new turns, "0" replays this writer's turns left unacknowledged by a failed flush
+        last_id = ">"
+        while not lost.is_set():
+            try:
+                response = await get_redis().client.xreadgroup(
+                    ISSUE_WRITER_GROUP, self.consumer, {ISSUE_STREAM_KEY: last_id},
+                    count=self.batch_size, block=ISSUE_WRITER_BLOCK_MS,
+                )
+            except (ResponseError, RedisError) as e:
+                logger.error(f"Error reading issue events: {e}")
+                await asyncio.sleep(ISSUE_WRITER_RETRY_DELAY)
+                continue
+            entries = response[0][1] if response else []
+            if not entries:
+                last_id = ">"
+                continue
+            if not await self.flush(entries):
+                last_id = "0"
+                await asyncio.sleep(ISSUE_WRITER_RETRY_DELAY)
+
+    async def flush(self, entries) -> bool:
+        """Writes a batch of stream entries to the database. Returns False if the batch has to be retried."""
+        writes = coalesce([{_decode(k): _decode(v) for k, v in fields.items()} for _, fields in entries])
+        try:
+            await write_issues(writes)
+        except Exception as e:
+            logger.warning(f"Error writing {len(writes)} issues in one batch, retrying one by one: {e}")
+            failed = 0
+            for write in writes:
+                try:
+                    await write_issues([write])
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Error writing issue {write['issue_id']}: {e}")
+            # nothing could be written, so the database is unavailable rather than a write being invalid
+            if failed == len(writes):
+                return False
+        entry_ids = [entry_id for entry_id, _ in entries]
+        try:
+            async with get_redis().client.pipeline(transaction=True) as pipe:
+                pipe.xack(ISSUE_STREAM_KEY, ISSUE_WRITER_GROUP, *entry_ids)
+                pipe.xdel(ISSUE_STREAM_KEY, *entry_ids)
+                await pipe.execute()
+        except (ResponseError, RedisError) as e:
+            # the entries are replayed, which updates the issues they already wrote
+            logger.error(f"Error acknowledging issue events: {e}")
+        return True
+
+
+issue_writer = IssueWriter()
@@ -0,0 +1,68 @@
+import json
+from typing import Dict, Iterable, List, NamedTuple
+
+from app.redis.client import get_sync_redis
+
+
+class ManifestEntry(NamedTuple):
+    """What was last embedded for an article: its Zendesk `updated_at`, a hash of its content and its chunk count"""
+    updated_at: str
+    hash: str
+    chunks: int
+
+
+def _manifest_key(index_name: str, namespace: str) -> str:
+    return f"kb_manifest:{index_name}:{namespace}"
+
+
+def _sync_state_key(index_name: str, namespace: str) -> str:
+    return f"kb_sync:{index_name}:{namespace}"
+
+
+def chunk_ids(article_id, chunks: int) -> List[str]:
+    """Vector ids of an article's chunks, stable across syncs so that a changed article overwrites its own vectors"""
+    return [f"{article_id}-{i}" for i in range(chunks)]
+
+
+def load_manifest(index_name: str, namespace: str) -> Dict[str, ManifestEntry]:
+    entries = get_sync_redis().client.hgetall(_manifest_key(index_name, namespace))
+    return {
+        (k.decode() if isinstance(k, bytes) else k): ManifestEntry(**json.loads(v))
+        for k, v in entries.items()
+    }
+
+
+def update_manifest(
+    index_name: str, namespace: str, entries: Dict[str, ManifestEntry], removed: Iterable[str] = (), reset=False
+):
+    key = _manifest_key(index_name, namespace)
+    removed = list(removed)
+    pipe = get_sync_redis().client.pipeline(transaction=True)
+    if reset:
+        pipe.delete(key)
+    if entries:
+        pipe.hset(key, mapping={k: json.dumps(v._asdict()) for k, v in entries.items()})
+    if removed:
+        pipe.hdel(key, *removed)
+    pipe.execute()
+
+
+def load_sync_state(index_name: str, namespace: str) -> Dict[str, str]:
+    state = get_sync_redis().client.hgetall(_sync_state_key(index_name, namespace))
+    return {(k.decode() if isinstance(k, bytes) else k): v.decode() for k, v in state.items()}
+
+
+def save_sync_state(index_name: str, namespace: str, **state):
+    get_sync_redis().client.hset(_sync_state_key(index_name, namespace), mapping={k: str(v) for k, v in state.items()})
+
+
+def clear_sync_state(index_name: str, namespace: str):
+    get_sync_redis().delete_key(_sync_state_key(index_name, namespace))
+
+
+def manifest_vector_ids(index_name: str, namespace: str) -> List[str] | None:
+    """Ids of every vector in a synced namespace, or None for namespaces ingested before the manifest existed"""
+    manifest = load_manifest(index_name, namespace)
+    if not manifest:
+        return None
+    return [vector_id for article_id, entry in manifest.items() for vector_id in chunk_ids(article_id, entry.chunks)]
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List, Tuple
+
+import pinecone
+
+from app.utils.kb_manifest import (
+    ManifestEntry,
+    chunk_ids,
+    load_manifest,
+    update_manifest,
+    load_sync_state,
+    save_sync_state,
+    clear_sync_state,
+)
+from app.utils.knowledge_base import bump_namespace_version
+from app.utils.types import Article
+from app.utils.zendesk import (
+    ZendeskGuideHarvester,
+    clean_up_text,
+    calculate_embeddings,
+    content_hash,
+    store_embeddings_into_pinecone,
+)
+
+logger = logging.getLogger(__name__)
+
+PINECONE_API_KEY = os.environ["PINECONE_API_KEY"]
+KB_INDEX_NAME = "alfred"
+# the incremental export does not report deleted articles, so the full article list is compared this often
+KB_RECONCILE_INTERVAL = int(os.environ.get("KB_RECONCILE_INTERVAL", 60 * 60 * 24))
+PINECONE_DELETE_BATCH = 1000
+# articles chunked and embedded together while the harvester keeps fetching the next ones
+KB_SYNC_BATCH = int(os.environ.get("KB_SYNC_BATCH", 100))
+
+
+def _index() -> pinecone.Index:
+    pinecone.init(api_key=PINECONE_API_KEY, environment="us-west1-gcp-free")
+    return pinecone.Index(KB_INDEX_NAME)
+
+
+def embed_articles(index: pinecone.Index, namespace: str, articles: List[Article]) -> Dict[str, ManifestEntry]:
+    """Chunks, embeds and upserts articles under per-article vector ids. Returns their manifest entries."""
+    entries, chunks, ids = {}, [], []
+    for article in articles:
+        article_chunks = clean_up_text([(article.title, article.body, article.category)])
+        chunks.extend(article_chunks)
+        ids.extend(chunk_ids(article.id, len(article_chunks)))
+        entries[str(article.id)] = ManifestEntry(article.updated_at, content_hash(article), len(article_chunks))
+    if chunks:
+        df, _ = calculate_embeddings(chunks)
+        df["ids"] = ids
+        store_embeddings_into_pinecone(df, index, namespace)
+    return entries
+
+
+def delete_vectors(index: pinecone.Index, namespace: str, ids: List[str]):
+    for i in range(0, len(ids), PINECONE_DELETE_BATCH):
+        index.delete(ids=ids[i: i + PINECONE_DELETE_BATCH], namespace=namespace)
+
+
+def legacy_vector_ids(index: pinecone.Index, namespace: str) -> List[str]:
+    """Ids of the vectors of an ingestion made before the manifest existed, which numbered them 0..n"""
+    namespaces = index.describe_index_stats()["namespaces"]
+    return [str(n) for n in range(int(namespaces.get(namespace, {}).get("vector_count", 0)))]
+
+
+def embed_changes(
+    index: pinecone.Index, namespace: str, manifest: Dict[str, ManifestEntry], articles: List[Article], full: bool
+) -> Tuple[Dict[str, ManifestEntry], List[str]]:
+    """Embeds the articles whose content changed. Returns their manifest entries and the ids of chunks they dropped."""
+    # an article whose content is unchanged is skipped even if its metadata was edited, a full sync embeds everything
+    to_embed = [
+        a for a in articles if full or str(a.id) not in manifest or manifest[str(a.id)].hash != content_hash(a)
+    ]
+    entries = embed_articles(index, namespace, to_embed)
+    stale = []
+    for article_id, entry in entries.items():
+        # an article that shrank leaves chunks behind that are no longer overwritten
+        if article_id in manifest and manifest[article_id].chunks > entry.chunks:
+            stale.extend(chunk_ids(article_id, manifest[article_id].chunks)[entry.chunks:])
+    return entries, stale
+
+
+def finish_sync(
+    index: pinecone.Index,
+    namespace: str,
+    manifest: Dict[str, ManifestEntry],
+    entries: Dict[str, ManifestEntry],
+    stale: List[str],
+    live_ids: set | None,
+    full: bool,
+) -> List[str]:
+    """Deletes the stale vectors and those of removed articles, then records the new manifest. Returns removed ids."""
+    removed = [] if live_ids is None else [a for a in manifest if a not in live_ids]
+    for article_id in removed:
+        stale = stale + chunk_ids(article_id, manifest[article_id].chunks)
+    delete_vectors(index, namespace, stale)
+    update_manifest(KB_INDEX_NAME, namespace, entries, removed, reset=full)
+    if entries or stale:
+        bump_namespace_version(KB_INDEX_NAME, namespace)
+    return removed
+
+
+def apply_changes(
+    namespace: str,
+    manifest: Dict[str, ManifestEntry],
+    changed: List[Article],
+    live_ids: set | None,
+    full: bool,
+) -> Dict[str, int]:
+    """
+    Blocking sync of a list of articles: embeds what changed, deletes what was removed and records the new manifest.
+    New vectors are upserted before anything is deleted, so the namespace keeps answering while it syncs and a failed
+    sync leaves the previous vectors in place.
+    """
+    index = _index()
+    # a namespace without a manifest was ingested with numbered vector ids, which are replaced by per-article ones
+    legacy = legacy_vector_ids(index, namespace) if full and not manifest else []
+    entries, stale = embed_changes(index, namespace, manifest, changed, full)
+    removed = finish_sync(index, namespace, manifest, entries, legacy + stale, live_ids, full)
+    return {"embedded": len(entries), "skipped": len(changed) - len(entries), "removed": len(removed)}
+
+
+async def stream_changes(
+    namespace: str,
+    manifest: Dict[str, ManifestEntry],
+    articles: AsyncIterator[Article],
+    full: bool,
+    batch_size: int = KB_SYNC_BATCH,
+) -> Dict[str, int]:
+    """
+    Same as `apply_changes` for a full listing of the help center, consumed as it is harvested. Articles are chunked
+    and embedded in batches of `batch_size`, one batch at a time while the next one is fetched, so only a couple of
+    batches are ever held in memory.
+    """
+    index = await asyncio.to_thread(_index)
+    legacy = await asyncio.to_thread(legacy_vector_ids, index, namespace) if full and not manifest else []
+    entries: Dict[str, ManifestEntry] = {}
+    stale: List[str] = list(legacy)
+    live_ids = set()
+
+    async def embed(batch: List[Article]):
+        batch_entries, batch_stale = await asyncio.to_thread(embed_changes, index, namespace, manifest, batch, full)
+        entries.update(batch_entries)
+        stale.extend(batch_stale)
+
+    batch: List[Article] = []
+    pending: asyncio.Task | None = None
+    try:
+        async for article in articles:
+            live_ids.add(str(article.id))
+            batch.append(article)
+            if len(batch) == batch_size:
+                if pending is not None:
+                    await pending
+                pending = asyncio.create_task(embed(batch))
+                batch = []
+        if pending is not None:
+            await pending
+        if batch:
+            await embed(batch)
+    finally:
+        # a batch still embedding in its thread is waited for, its vectors are simply left for the next sync
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+    removed = await asyncio.to_thread(finish_sync, index, namespace, manifest, entries, stale, live_ids, full)
+    return {"embedded": len(entries), "skipped": len(live_ids) - len(entries), "removed": len(removed)}
+
+
+def reset_knowledge_base(namespace: str):
+    """Deletes every vector of a namespace and forgets its sync state, so the next sync starts from scratch"""
+    _index().delete(delete_all=True, namespace=namespace)
+    update_manifest(KB_INDEX_NAME, namespace, {}, reset=True)
+    clear_sync_state(KB_INDEX_NAME, namespace)
+    bump_namespace_version(KB_INDEX_NAME, namespace)
+
+
+async def sync_knowledge_base(subdomain: str, token: str, namespace: str, full: bool = False) -> Dict[str, int]:
+    """
+    Brings a namespace up to date with its Zendesk help center. The first sync, or a `full` one, embeds every
+    article. Later syncs read only the articles changed since the last sync from the incremental export, embed those
+    whose content changed and, once per reconcile interval, delete the vectors of articles that no longer exist.
+    """
+    state = await asyncio.to_thread(load_sync_state, KB_INDEX_NAME, namespace)
+    manifest = await asyncio.to_thread(load_manifest, KB_INDEX_NAME, namespace)
+    full = full or "cursor" not in state
+    started = int(time.time())
+    reconcile = full or started - int(state.get("reconciled_at", 0)) >= KB_RECONCILE_INTERVAL
+    async with ZendeskGuideHarvester(subdomain, token) as harvester:
+        if reconcile:
+            # a full listing holds every article, only those changed since the manifest was written are re-embedded
+            result = await stream_changes(namespace, manifest, harvester.articles(), full)
+            cursor = started
+        else:
+            changed, cursor = await harvester.incremental_articles(int(state["cursor"]))
+    if not reconcile:
+        result = await asyncio.to_thread(apply_changes, namespace, manifest, changed, None, full)
+    sync_state = {"cursor": cursor, **({"reconciled_at": started} if reconcile else {})}
+    await asyncio.to_thread(save_sync_state, KB_INDEX_NAME, namespace, **sync_state)
+    logger.info(f"Synced knowledge base {namespace}: {result}")
+    return result
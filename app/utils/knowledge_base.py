@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from redis.exceptions import RedisError
+
+from app.pinecone.client import Pinecone
+from app.redis.client import get_redis, get_sync_redis
+from app.utils.kb_manifest import manifest_vector_ids
+from app.utils.similarity import normalise_rows, top_k
+from app.utils.tokenizer import num_tokens_from_texts
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_BASE_CACHE_TTL = int(os.environ.get("KNOWLEDGE_BASE_CACHE_TTL", 60 * 15))
+KNOWLEDGE_BASE_CACHE_SIZE = int(os.environ.get("KNOWLEDGE_BASE_CACHE_SIZE", 32))
+
+
+@dataclass
+class KnowledgeBase:
+    """Knowledge base chunks for a single namespace, with L2-normalised embeddings held in one float32 matrix"""
+    titles: List[str]
+    content: List[str]
+    categories: List[str]
+    embeddings: np.ndarray
+    tokens: List[int] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.content)
+
+    @classmethod
+    def from_records(cls, titles, content, categories, embeddings, tokens=None) -> "KnowledgeBase":
+        content = list(content)
+        matrix = normalise_rows(embeddings) if len(content) else np.empty((0, 0), dtype=np.float32)
+        # chunks stored without a token count are tokenised once here rather than on every prompt
+        if tokens is None or any(t is None for t in tokens):
+            tokens = num_tokens_from_texts(content)
+        return cls(
+            titles=list(titles),
+            content=content,
+            categories=list(categories),
+            embeddings=matrix,
+            tokens=[int(t) for t in tokens],
+        )
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "KnowledgeBase":
+        # embeddings read back from CSV are stringified lists
+        embeddings = [json.loads(e) if isinstance(e, str) else e for e in df["embedding"]]
+        return cls.from_records(
+            titles=df["titles"],
+            content=df["content"],
+            categories=df["categories"],
+            embeddings=embeddings,
+            tokens=df["tokens"] if "tokens" in df else None,
+        )
+
+    def top_k(self, query_vector, k: int):
+        return top_k(self.embeddings, query_vector, k)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "titles": self.titles,
+                "content": self.content,
+                "categories": self.categories,
+                "embedding": list(self.embeddings),
+                "tokens": self.tokens,
+            }
+        )
+
+
+def fetch_knowledge_base_from_pinecone(index_name: str, namespace: str) -> KnowledgeBase:
+    p = Pinecone()
+    # Connect to the index <INDEX_NAME> provided
+    index = p.index(index_name)
+    # synced namespaces key their vectors by article, older ones were numbered 0..n
+    ids = manifest_vector_ids(index_name, namespace)
+    if ids is None:
+        # describe the pinecone index
+        index_stats = index.describe_index_stats()
+        # extract the total_vector_count
+        num_vectors = int(index_stats["namespaces"][namespace]["vector_count"])
+        # Use vector count to fetch all vectors in the index
+        ids = [str(x) for x in range(0, num_vectors)]
+    vectors = (index.fetch(ids=ids, namespace=namespace))["vectors"]
+    ordered = [vectors[i] for i in ids if i in vectors]
+    return KnowledgeBase.from_records(
+        titles=[v["metadata"]["title"] for v in ordered],
+        content=[v["metadata"]["content"] for v in ordered],
+        categories=[v["metadata"]["category"] for v in ordered],
+        embeddings=[v["values"] for v in ordered],
+        tokens=[v["metadata"].get("tokens") for v in ordered],
+    )
+
+
+def _version_key(index_name: str, namespace: str) -> str:
+    return f"kb_version:{index_name}:{namespace}"
+
+
+class KnowledgeBaseCache(object):
+    """
+    In-process LRU cache of knowledge bases keyed by (index, namespace). Entries expire after `ttl` seconds and are
+    also dropped when the namespace version stored in Redis changes, so that an ingestion handled by one worker
+    process invalidates the copies held by every other process.
+    """
+
+    def __init__(self, max_entries: int = KNOWLEDGE_BASE_CACHE_SIZE, ttl: int = KNOWLEDGE_BASE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, str | None, KnowledgeBase]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, index_name: str, namespace: str, version: str | None = None) -> KnowledgeBase | None:
+        key = (index_name, namespace)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, cached_version, knowledge_base = entry
+            if expires_at < time.monotonic() or cached_version != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return knowledge_base
+
+    def set(self, index_name: str, namespace: str, knowledge_base: KnowledgeBase, version: str | None = None):
+        key = (index_name, namespace)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, knowledge_base)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, index_name: str, namespace: str | None = None):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if key[0] == index_name and (namespace is None or key[1] == namespace):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+knowledge_base_cache = KnowledgeBaseCache()
+
+
+async def get_namespace_version(index_name: str, namespace: str) -> str | None:
+    try:
+        version = await get_redis().get_value(_version_key(index_name, namespace))
+        return version.decode("utf-8") if isinstance(version, bytes) else version
+    except RedisError as e:
+        logger.warning(f"Could not read knowledge base version for {namespace}: {e}")
+        return None
+
+
+async def get_knowledge_base(index_name: str, namespace: str) -> KnowledgeBase:
+    version = await get_namespace_version(index_name, namespace)
+    knowledge_base = knowledge_base_cache.get(index_name, namespace, version)
+    if knowledge_base is not None:
+        logger.debug(f"Knowledge base cache hit for {index_name}:{namespace}")
+        return knowledge_base
+    logger.info(f"Knowledge base cache miss for {index_name}:{namespace}, fetching from pinecone")
+    knowledge_base = await asyncio.to_thread(fetch_knowledge_base_from_pinecone, index_name, namespace)
+    knowledge_base_cache.set(index_name, namespace, knowledge_base, version)
+    return knowledge_base
+
+
+def bump_namespace_version(index_name: str, namespace: str):
+    """
+    Drops the cached copy of a namespace, and bumps its version so that the copies held by other processes are
+    dropped on their next read. Blocking, as it is called from the sync and ingestion threads.
+    """
+    knowledge_base_cache.invalidate(index_name, namespace)
+    try:
+        get_sync_redis().increment(_version_key(index_name, namespace))
+    except RedisError as e:
+        logger.warning(f"Could not bump knowledge base version for {namespace}: {e}")
+
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+
+import aiohttp
+import openai
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 32))
+LLM_CHAT_TIMEOUT = float(os.environ.get("LLM_CHAT_TIMEOUT", 60))
+LLM_EMBEDDING_TIMEOUT = float(os.environ.get("LLM_EMBEDDING_TIMEOUT", 10))
+
+
+class LLMClient(object):
+    """
+    Non-blocking OpenAI client. All calls share one pooled aiohttp session, are bounded by a semaphore so a burst of
+    conversations cannot open an unbounded number of requests, and carry their own timeout. A session only works on
+    the event loop it was opened on, so each loop gets its own session and semaphore, e.g. every asyncio.run of a
+    celery task.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_connections: int = LLM_MAX_CONNECTIONS):
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self._pools: Dict[asyncio.AbstractEventLoop, Tuple[aiohttp.ClientSession, asyncio.Semaphore]] = {}
+
+    async def start(self) -> Tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None or pool[0].closed:
+            # the sessions of loops that have since been closed can no longer be used or closed, only forgotten
+            for closed in [other for other in self._pools if other.is_closed()]:
+                del self._pools[closed]
+            pool = self._pools[loop] = (
+                aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections)),
+                asyncio.Semaphore(self.max_concurrency),
+            )
+        return pool
+
+    async def close(self):
+        session, _ = self._pools.pop(asyncio.get_running_loop(), (None, None))
+        if session is not None and not session.closed:
+            await session.close()
+
+    @asynccontextmanager
+    async def _slot(self):
+        # lazily open the session for processes that never ran the FastAPI startup hook
+        session, semaphore = await self.start()
+        async with semaphore:
+            yield session
+
+    async def _acreate(self, session: aiohttp.ClientSession, resource, **kwargs):
+        # openai reads the session to use from a context variable when the request is made, so it is only set for
+        # the duration of the call (a streamed response keeps reading from the same connection afterwards)
+        token = openai.aiosession.set(session)
+        try:
+            return await resource.acreate(**kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def chat_completion(
+        self, messages: List[Dict[str, str]], model: str, temperature: float = 0, timeout: float = LLM_CHAT_TIMEOUT,
+        **kwargs
+    ):
+        async with self._slot() as session:
+            return await self._acreate(
+                session,
+                openai.ChatCompletion,
+                model=model, messages=messages, temperature=temperature, request_timeout=timeout, **kwargs
+            )
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], model: str, temperature: float = 0, timeout: float = LLM_CHAT_TIMEOUT,
+        **kwargs
+    ) -> AsyncIterator[str]:
+        """Yields the content of a chat completion piece by piece as the tokens are generated"""
+        async with self._slot() as session:
+            response = await self._acreate(
+                session,
+                openai.ChatCompletion,
+                model=model, messages=messages, temperature=temperature, request_timeout=timeout, stream=True, **kwargs
+            )
+            async for chunk in response:
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    yield delta
+
+    async def embeddings(self, texts: List[str], model: str, timeout: float = LLM_EMBEDDING_TIMEOUT) -> List[List[float]]:
+        async with self._slot() as session:
+            response = await self._acreate(
+                session, openai.Embedding, model=model, input=texts, request_timeout=timeout
+            )
+        return [data["embedding"] for data in sorted(response["data"], key=lambda d: d["index"])]
+
+    async def embedding(self, text: str, model: str, timeout: float = LLM_EMBEDDING_TIMEOUT) -> List[float]:
+        # newlines degrade embedding quality for ada-002, matching openai.embeddings_utils.get_embedding
+        return (await self.embeddings([text.replace("\n", " ")], model, timeout))[0]
+
+
+llm_client = LLMClient()
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Awaitable, Callable, Dict, List, Set
+
+from app.utils.llm import llm_client
+from app.utils.tokenizer import num_tokens_from_text
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", 6000))
+# once a conversation passes this share of the budget the older turns are folded into a summary in the background
+CONVERSATION_SUMMARY_THRESHOLD = float(os.environ.get("CONVERSATION_SUMMARY_THRESHOLD", 0.75))
+CONVERSATION_RECENT_MESSAGES = int(os.environ.get("CONVERSATION_RECENT_MESSAGES", 6))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-3.5-turbo")
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_PROMPT = """Summarise the conversation below between an employee and Alfred, an HR and IT assistant. Keep every
+fact Alfred relies on to continue helping: the employee's problem, answers already given, ticket details and anything
+still unresolved. Be concise and write in the third person."""
+# every chat message costs a few tokens on top of its content (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# the introduction prompt wraps its context in triple quotes, follow-up questions append it after a marker
+INTRODUCTION_CONTEXT = re.compile(r'\n\nContext:\n""".*?\n"""', re.DOTALL)
+FOLLOW_UP_CONTEXT = "\n\nContext: "
+
+Messages = List[Dict[str, str]]
+
+
+def strip_context(message: Dict[str, str]) -> Dict[str, str]:
+    """Returns the message without the knowledge base context that was pasted into it"""
+    if message["role"] != "user":
+        return message
+    content = INTRODUCTION_CONTEXT.sub("", message["content"])
+    content = content.split(FOLLOW_UP_CONTEXT, 1)[0]
+    return {**message, "content": content}
+
+
+def append_turns(transcript: Messages, messages: Messages, prompt_length: int) -> Messages:
+    """
+    Returns the full transcript of a conversation after a reply. `messages` is the compacted prompt the reply was
+    generated from, `prompt_length` messages long, followed by the turns the reply added.
+    """
+    return transcript + messages[prompt_length:]
+
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+
+class ConversationMemory(object):
+    """
+    Keeps the history sent to the chat model within a token budget.
+
+    The leading system prompt and the introduction prompt are pinned. On the reply path the memory only does cheap
+    work: it strips the context pasted into earlier user turns and, if the history is still over budget, drops the
+    oldest turns. Folding old turns into a summary needs a model call, so it runs in a background task once the reply
+    has been sent and the compacted history is written back to the conversation key.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = CONVERSATION_TOKEN_BUDGET,
+        recent_messages: int = CONVERSATION_RECENT_MESSAGES,
+        summary_threshold: float = CONVERSATION_SUMMARY_THRESHOLD,
+        count_tokens: Callable[[str], int] = num_tokens_from_text,
+    ):
+        self.token_budget = token_budget
+        self.recent_messages = recent_messages
+        self.summary_threshold = summary_threshold
+        self.count_tokens = count_tokens
+        self._tasks: Set[asyncio.Task] = set()
+
+    def num_tokens(self, messages: Messages) -> int:
+        return sum(self.count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+    @staticmethod
+    def _split(messages: Messages):
+        """Splits the history into the pinned prompts, an existing summary and the remaining turns"""
+        pinned = []
+        i = 0
+        while i < len(messages) and messages[i]["role"] == "system" and not is_summary(messages[i]):
+            pinned.append(messages[i])
+            i += 1
+        # the first user message carries the introduction prompt with Alfred's instructions
+        if i < len(messages) and messages[i]["role"] == "user":
+            pinned.append(messages[i])
+            i += 1
+        summary = None
+        if i < len(messages) and is_summary(messages[i]):
+            summary = messages[i]
+            i += 1
+        return pinned, summary, messages[i:]
+
+    def prepare(self, messages: Messages) -> Messages:
+        """Cheap compaction done before a reply: strips old context blobs and hard-trims the oldest turns"""
+        pinned, summary, turns = self._split([strip_context(m) for m in messages])
+        head = pinned + ([summary] if summary else [])
+        while turns and self.num_tokens(head + turns) > self.token_budget:
+            # drop the oldest turn, keeping at least the most recent exchange
+            if len(turns) <= 2:
+                break
+            turns = turns[1:]
+        return head + turns
+
+    def needs_summary(self, messages: Messages) -> bool:
+        pinned, summary, turns = self._split(messages)
+        return (
+            len(turns) > self.recent_messages
+            and self.num_tokens(messages) > self.token_budget * self.summary_threshold
+        )
+
+    async def summarise(self, messages: Messages) -> Messages:
+        """Folds everything but the most recent turns into a single summary message"""
+        pinned, summary, turns = self._split(messages)
+        older, recent = turns[:-self.recent_messages], turns[-self.recent_messages:]
+        transcript = "\n".join(f"{m['role']}: {strip_context(m)['content']}" for m in ([summary] if summary else []) + older)
+        response = await llm_client.chat_completion(
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+            SUMMARY_MODEL,
+            temperature=0,
+        )
+        summary_text = response["choices"][0]["message"]["content"].strip()
+        return pinned + [{"role": "system", "content": SUMMARY_PREFIX + summary_text}] + recent
+
+    def schedule_compaction(
+        self,
+        messages: Messages,
+        load: Callable[[], Awaitable[Messages | None]],
+        save: Callable[[Messages], Awaitable[None]],
+    ):
+        """Summarises the conversation in the background, off the reply path, if it has grown past the threshold"""
+        if not self.needs_summary(messages):
+            return
+        task = asyncio.create_task(self._compact(messages, load, save))
+        # keep a reference to the task so it isn't garbage collected before it finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, messages: Messages, load, save):
+        try:
+            compacted = await self.summarise(messages)
+            # only write back if no newer turn has been stored while the summary was being generated
+            if await load() == messages:
+                await save(compacted)
+                logger.info(f"Compacted conversation from {len(messages)} to {len(compacted)} messages")
+        except Exception as e:
+            logger.error(f"Failed to summarise conversation: {e}")
+
+
+conversation_memory = ConversationMemory()
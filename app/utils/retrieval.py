@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple
+
+from app.pinecone.client import Pinecone
+from app.utils.knowledge_base import KnowledgeBase, get_knowledge_base
+from app.utils.tokenizer import num_tokens_from_text
+
+logger = logging.getLogger(__name__)
+
+# "pinecone" asks the index for the top k matches, "cache" downloads the whole namespace once and ranks locally
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "pinecone")
+DEFAULT_NAMESPACE = ""
+
+
+class Match(NamedTuple):
+    id: str
+    score: float
+    title: str
+    content: str
+    category: str
+    tokens: int
+
+
+class RetrievalBackend(ABC):
+    """Returns the knowledge base chunks most related to a query embedding"""
+
+    @abstractmethod
+    async def query(self, vector, top_k: int, namespace: str = DEFAULT_NAMESPACE) -> List[Match]:
+        raise NotImplementedError
+
+
+class PineconeBackend(RetrievalBackend):
+    """Server-side top-k search, only the k best matches and their metadata are sent over the wire"""
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = Pinecone().index(self.index_name)
+        return self._index
+
+    async def query(self, vector, top_k: int, namespace: str = DEFAULT_NAMESPACE) -> List[Match]:
+        # the pinecone client is synchronous, so the request runs in a worker thread to keep the event loop free
+        response = await asyncio.to_thread(
+            self.index.query,
+            vector=[float(x) for x in vector],
+            top_k=top_k,
+            namespace=namespace,
+            include_metadata=True,
+            include_values=False,
+        )
+        return [self._to_match(match) for match in response["matches"]]
+
+    @staticmethod
+    def _to_match(match) -> Match:
+        metadata = match["metadata"]
+        content = metadata.get("content", "")
+        # vectors ingested before token counts were stored in the metadata are counted on the fly
+        tokens = metadata.get("tokens")
+        return Match(
+            id=match["id"],
+            score=float(match["score"]),
+            title=metadata.get("title", ""),
+            content=content,
+            category=metadata.get("category", ""),
+            tokens=int(tokens) if tokens is not None else num_tokens_from_text(content),
+        )
+
+
+class LocalBackend(RetrievalBackend):
+    """In-memory backend that ranks knowledge bases held by the process, used for the CSV knowledge base and tests"""
+
+    def __init__(self, knowledge_bases: Dict[str, KnowledgeBase] | None = None):
+        self.knowledge_bases = knowledge_bases or {}
+
+    def add(self, knowledge_base: KnowledgeBase, namespace: str = DEFAULT_NAMESPACE):
+        self.knowledge_bases[namespace] = knowledge_base
+
+    async def knowledge_base(self, namespace: str) -> KnowledgeBase | None:
+        return self.knowledge_bases.get(namespace)
+
+    async def query(self, vector, top_k: int, namespace: str = DEFAULT_NAMESPACE) -> List[Match]:
+        knowledge_base = await self.knowledge_base(namespace)
+        if knowledge_base is None or not len(knowledge_base):
+            return []
+        indices, scores = knowledge_base.top_k(vector, top_k)
+        return [
+            Match(
+                id=str(i),
+                score=float(score),
+                title=knowledge_base.titles[i],
+                content=knowledge_base.content[i],
+                category=knowledge_base.categories[i],
+                tokens=knowledge_base.tokens[i],
+            )
+            for i, score in zip(indices.tolist(), scores.tolist())
+        ]
+
+
+class CachedNamespaceBackend(LocalBackend):
+    """Downloads whole namespaces into the in-process knowledge base cache and ranks them locally"""
+
+    def __init__(self, index_name: str):
+        super().__init__()
+        self.index_name = index_name
+
+    async def knowledge_base(self, namespace: str) -> KnowledgeBase | None:
+        return await get_knowledge_base(self.index_name, namespace)
+
+
+_backends: Dict[str, RetrievalBackend] = {}
+
+
+def get_retrieval_backend(index_name: str = "alfred") -> RetrievalBackend:
+    if index_name not in _backends:
+        if RETRIEVAL_BACKEND == "cache":
+            _backends[index_name] = CachedNamespaceBackend(index_name)
+        else:
+            _backends[index_name] = PineconeBackend(index_name)
+        logger.info(f"Using {type(_backends[index_name]).__name__} for index {index_name}")
+    return _backends[index_name]
@@ -0,0 +1,39 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def normalise_rows(matrix) -> np.ndarray:
+    """Returns a C-contiguous float32 copy of the matrix with every row scaled to unit L2 norm."""
+    matrix = np.array(matrix, dtype=np.float32, order="C", ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # leave all-zero rows untouched instead of dividing by zero
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def normalise_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def top_k(matrix: np.ndarray, query_vector, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the row indices and cosine similarities of the k rows of an L2-normalised matrix that are most related
+    to the query vector, sorted from most related to least.
+    """
+    num_rows = matrix.shape[0]
+    k = min(k, num_rows)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    # a single matrix-vector product scores every row since the rows are already unit length
+    scores = matrix @ normalise_vector(query_vector)
+    if k < num_rows:
+        candidates = np.argpartition(scores, num_rows - k)[num_rows - k:]
+    else:
+        candidates = np.arange(num_rows)
+    # only the k selected candidates need to be sorted
+    indices = candidates[np.argsort(scores[candidates])[::-1]]
+    return indices, scores[indices]
@@ -1,23 +1,163 @@
+import asyncio
 import os
+import time
 from pprint import pprint
+from typing import Dict, Iterable
 
-from slack_sdk import WebClient
+import aiohttp
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
 from slack_sdk.models.blocks import ActionsBlock, DividerBlock, ButtonElement, PlainTextObject, \
     InputBlock, PlainTextInputElement
 
 from app.db.prisma_client import prisma
-from app.utils.types import Profile
+from app.utils.tenant import get_tenant, invalidate_tenants
+from app.utils.types import Profile, BotIdentity
 
 installation_base_dir = (
     f"{os.getcwd()}/app/data/installations"
     if os.environ["DOPPLER_ENVIRONMENT"] == "dev"
     else f"/data/installations"
 )
+# chat.update is a tier 3 method (~50 calls per minute per workspace), shared by every streamed reply in a workspace,
+# and a single reply edits its message at most once a second
+SLACK_STREAM_UPDATE_INTERVAL = float(os.environ.get("SLACK_STREAM_UPDATE_INTERVAL", 1.0))
+SLACK_TEAM_UPDATES_PER_MINUTE = int(os.environ.get("SLACK_TEAM_UPDATES_PER_MINUTE", 50))
+SLACK_TEAM_UPDATE_BURST = int(os.environ.get("SLACK_TEAM_UPDATE_BURST", 5))
+STREAMING_CURSOR = " :writing_hand:"
+SLACK_MAX_CONNECTIONS = int(os.environ.get("SLACK_MAX_CONNECTIONS", 64))
+
+_slack_session: aiohttp.ClientSession | None = None
+_slack_clients: Dict[str | None, AsyncWebClient] = {}
+# bot id and bot user id never change for an installation, so they are cached per team id for the process lifetime
+_bot_identities: Dict[str, BotIdentity] = {}
+_update_limiters: Dict[str, "UpdateLimiter"] = {}
+
+
+def get_slack_client(token: str | None = None) -> AsyncWebClient:
+    """Returns the async Web API client for a workspace token. Every client shares one pooled HTTP session."""
+    global _slack_session
+    if _slack_session is None or _slack_session.closed:
+        _slack_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=SLACK_MAX_CONNECTIONS))
+        _slack_clients.clear()
+    client = _slack_clients.get(token)
+    if client is None:
+        client = AsyncWebClient(token=token, session=_slack_session)
+        _slack_clients[token] = client
+    return client
+
+
+async def close_slack_clients():
+    global _slack_session
+    _slack_clients.clear()
+    if _slack_session is not None and not _slack_session.closed:
+        await _slack_session.close()
+    _slack_session = None
+
+
+class UpdateLimiter(object):
+    """
+    chat.update calls a workspace has left, refilled at `per_minute` and holding at most `burst`. Every streamed reply
+    in the workspace draws on the same limiter, and a rate limit response drains it for all of them.
+    """
+
+    def __init__(self, per_minute: int = SLACK_TEAM_UPDATES_PER_MINUTE, burst: int = SLACK_TEAM_UPDATE_BURST):
+        self.capacity = burst
+        self.rate = per_minute / 60
+        self.available = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.available < 1:
+            return False
+        self.available -= 1
+        return True
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.available) / self.rate)
+
+    def pause(self, seconds: float):
+        self._refill()
+        self.available = min(self.available, 0.0) - seconds * self.rate
+
+
+def get_update_limiter(team_id: str) -> UpdateLimiter:
+    limiter = _update_limiters.get(team_id)
+    if limiter is None:
+        limiter = _update_limiters[team_id] = UpdateLimiter()
+    return limiter
+
+
+class StreamingMessage(object):
+    """Progressively edits a placeholder message with the text of a streamed reply"""
+
+    def __init__(
+        self,
+        client: AsyncWebClient,
+        channel: str,
+        ts: str,
+        team_id: str,
+        interval: float = SLACK_STREAM_UPDATE_INTERVAL,
+    ):
+        self.client = client
+        self.channel = channel
+        self.ts = ts
+        self.limiter = get_update_limiter(team_id)
+        self.interval = interval
+        self._next_edit_at = 0.0
+        self._last_text = None
+
+    async def _edit(self, text: str):
+        response = await self.client.chat_update(channel=self.channel, ts=self.ts, text=text)
+        self._last_text = text
+        return response
+
+    async def update(self, text: str):
+        # skip intermediate edits until the throttle window has passed and the workspace has an edit to spare
+        if time.monotonic() < self._next_edit_at or not text.strip() or not self.limiter.try_acquire():
+            return
+        self._next_edit_at = time.monotonic() + self.interval
+        try:
+            await self._edit(text + STREAMING_CURSOR)
+        except SlackApiError as e:
+            retry_after = int(e.response.headers.get("Retry-After", 1)) if e.response is not None else 1
+            print(f"Error streaming reply, backing off for {retry_after}s: {e}")
+            self.limiter.pause(retry_after)
+            self._next_edit_at = time.monotonic() + retry_after
+
+    async def finish(self, text: str):
+        # the final edit always goes through so the message ends with the complete reply, once the workspace allows it
+        await self.limiter.acquire()
+        return await self._edit(text)
+
+
+async def abandon_reply(client: AsyncWebClient, placeholder: asyncio.Task, stages: Iterable[asyncio.Task]):
+    """
+    Stops the stages of a reply that will not be sent, retrieving their results so that no error goes unnoticed, then
+    deletes its placeholder message. The placeholder is awaited rather than cancelled, as a post cut short may still
+    have gone through.
+    """
+    stages = [stage for stage in stages if stage is not placeholder]
+    for stage in stages:
+        stage.cancel()
+    posted, *_ = await asyncio.gather(placeholder, *stages, return_exceptions=True)
+    if isinstance(posted, BaseException):
+        return
+    try:
+        await client.chat_delete(channel=posted["channel"], ts=posted["ts"])
+    except SlackApiError as e:
+        print(f"Error deleting placeholder message: {e}")
 
 
 async def display_plain_text_dialog(
-        question: str, sender_id: str, recipient_name: str, client: WebClient, response
+        question: str, sender_id: str, recipient_name: str, client: AsyncWebClient, response
 ):
     pprint(response)
     input_block = InputBlock(
@@ -35,7 +175,7 @@ async def display_plain_text_dialog(
     blocks = [input_block]
     # Post a message to a user using the interactivity pointer
     try:
-        response = client.chat_postMessage(
+        response = await client.chat_postMessage(
             channel=response["channel"], text=question, blocks=blocks
         )
         print(response)
@@ -43,7 +183,7 @@ async def display_plain_text_dialog(
         print("Error posting message: {}".format(e))
 
 
-def display_support_dialog(client: WebClient, response):
+async def display_support_dialog(client: AsyncWebClient, response):
     print("TAKING ACTION!!!!")
     # Define the interactive message
     # Create an interactivity pointer for the "Create ticket" button
@@ -63,7 +203,7 @@ def display_support_dialog(client: WebClient, response):
     block = [divider, buttons]
     # Post a message to a user using the interactivity pointer
     try:
-        response = client.chat_postMessage(
+        response = await client.chat_postMessage(
             channel=response["channel"], text="New message", blocks=block
         )
         print(response)
@@ -71,7 +211,7 @@ def display_support_dialog(client: WebClient, response):
         print("Error posting message: {}".format(e))
 
 
-async def issue_resolved_dialog(client: WebClient, response):
+async def issue_resolved_dialog(client: AsyncWebClient, response):
     # Define the interactive message
     # Create an interactivity pointer for the "Create ticket" button
     resolved_pointer = {
@@ -93,7 +233,7 @@ async def issue_resolved_dialog(client: WebClient, response):
     block = [divider, buttons]
     # Post a message to a user using the interactivity pointer
     try:
-        response = client.chat_postMessage(
+        response = await client.chat_postMessage(
             channel=response["channel"], text="New message", blocks=block
         )
         print(response)
@@ -101,9 +241,9 @@ async def issue_resolved_dialog(client: WebClient, response):
         print("Error posting message: {}".format(e))
 
 
-def get_user_from_id(user_id: str, client: WebClient):
+async def get_user_from_id(user_id: str, client: AsyncWebClient):
     try:
-        response = client.users_info(user=user_id)
+        response = await client.users_info(user=user_id)
         profile = response.data["user"]["profile"]
         pprint(f"{user_id} <=> {profile['first_name']}")
         return profile
@@ -112,9 +252,9 @@ def get_user_from_id(user_id: str, client: WebClient):
         raise Exception(f"Error fetching user information for user {user_id}: {e}")
 
 
-def get_profile_from_id(user_id: str, client: WebClient) -> Profile:
+async def get_profile_from_id(user_id: str, client: AsyncWebClient) -> Profile:
     try:
-        response = client.users_profile_get(user=user_id)
+        response = await client.users_profile_get(user=user_id)
         profile = response.data["profile"]
         pprint(f"{user_id} <=> {profile['first_name']}")
         return Profile(name=profile["real_name_normalized"], email=profile["email"])
@@ -123,12 +263,12 @@ def get_profile_from_id(user_id: str, client: WebClient) -> Profile:
         raise Exception(f"Error fetching user information for user {user_id}: {e}")
 
 
-async def get_user_from_event(event, client: WebClient):
+async def get_user_from_event(event, client: AsyncWebClient):
     try:
         # Extract the user ID from the message event
         user_id = event["user"]
         # Use the app.client method to fetch user information by ID
-        response = client.users_info(user=user_id)
+        response = await client.users_info(user=user_id)
         pprint(f"USER INFO: {response.data['user']['profile']['real_name_normalized']}")
         # Extract the username from the API response
         if response.data:
@@ -141,9 +281,9 @@ async def get_user_from_event(event, client: WebClient):
         raise Exception(f"Error fetching user information: {e}")
 
 
-def get_conversation_id(channel, ts, client: WebClient):
+async def get_conversation_id(channel, ts, client: AsyncWebClient):
     # fetch all replies from the last message
-    conversation = client.conversations_replies(channel=channel, ts=ts, inclusive=True)
+    conversation = await client.conversations_replies(channel=channel, ts=ts, inclusive=True)
     # get the timestamp of the root message for the conversation
     root_message_id = conversation.data["messages"][0]["ts"]
     return root_message_id
@@ -153,8 +293,34 @@ async def fetch_access_token(team_id: str, logger):
     # fetch slack access token from database using the team_id
     if not team_id:
         return None
-    slack_config = await prisma.slack.find_first(where={"team_id": team_id})
-    if not slack_config:
+    tenant = await get_tenant(team_id)
+    if not tenant:
         logger.error(f"Slack config not found for team_id: {team_id}")
         return
-    return slack_config.access_token
+    return tenant.slack.access_token
+
+
+def cache_bot_identity(team_id: str, bot_id: str, user_id: str) -> BotIdentity:
+    identity = BotIdentity(bot_id=bot_id, user_id=user_id)
+    _bot_identities[team_id] = identity
+    return identity
+
+
+async def get_bot_identity(team_id: str, client: AsyncWebClient) -> BotIdentity:
+    """Returns the bot id and bot user id for a workspace, from memory, then the DB, then auth.test as a last resort"""
+    identity = _bot_identities.get(team_id)
+    if identity:
+        return identity
+    tenant = await get_tenant(team_id)
+    slack_config = tenant.slack if tenant else None
+    if slack_config and slack_config.bot_id and slack_config.bot_user_id:
+        return cache_bot_identity(team_id, slack_config.bot_id, slack_config.bot_user_id)
+    # installations made before the identity was stored need one auth.test call, which is then persisted
+    auth_test = await client.auth_test()
+    if slack_config:
+        await prisma.slack.update(
+            where={"org_id": slack_config.org_id},
+            data={"bot_id": auth_test["bot_id"], "bot_user_id": auth_test["user_id"]},
+        )
+        await invalidate_tenants()
+    return cache_bot_identity(team_id, auth_test["bot_id"], auth_test["user_id"])
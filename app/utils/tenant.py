@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Tuple
+
+from prisma.models import Organization, Slack, Zendesk
+from redis.exceptions import RedisError
+
+from app.db.prisma_client import prisma
+from app.redis.client import get_redis
+
+logger = logging.getLogger(__name__)
+
+TENANT_CACHE_TTL = int(os.environ.get("TENANT_CACHE_TTL", 60 * 5))
+TENANT_CACHE_SIZE = int(os.environ.get("TENANT_CACHE_SIZE", 1024))
+# bumped whenever a workspace's configuration changes, so every process drops its cached tenants on the next read
+TENANT_VERSION_KEY = "tenant_version"
+
+
+@dataclass
+class Tenant:
+    """The Slack installation of a workspace with the organization it belongs to and its Zendesk integration"""
+    slack: Slack
+    organization: Organization | None
+    zendesk: Zendesk | None
+
+
+class TenantCache(object):
+    """
+    In-process LRU cache of tenants keyed by Slack team id. Entries expire after `ttl` seconds and are dropped when
+    the tenant version stored in Redis changes.
+    """
+
+    def __init__(self, max_entries: int = TENANT_CACHE_SIZE, ttl: int = TENANT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, str | None, Tenant]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, team_id: str, version: str | None = None) -> Tenant | None:
+        with self._lock:
+            entry = self._entries.get(team_id)
+            if entry is None:
+                return None
+            expires_at, cached_version, tenant = entry
+            if expires_at < time.monotonic() or cached_version != version:
+                del self._entries[team_id]
+                return None
+            self._entries.move_to_end(team_id)
+            return tenant
+
+    def set(self, team_id: str, tenant: Tenant, version: str | None = None):
+        with self._lock:
+            self._entries[team_id] = (time.monotonic() + self.ttl, version, tenant)
+            self._entries.move_to_end(team_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+tenant_cache = TenantCache()
+
+
+async def get_tenant_version() -> str | None:
+    try:
+        version = await get_redis().get_value(TENANT_VERSION_KEY)
+        return version.decode("utf-8") if isinstance(version, bytes) else version
+    except RedisError as e:
+        logger.warning(f"Could not read tenant version: {e}")
+        return None
+
+
+async def fetch_tenant(team_id: str) -> Tenant | None:
+    # the slack row, its organization and the organization's zendesk integration are loaded in one query
+    slack = await prisma.slack.find_first(
+        where={"team_id": team_id},
+        include={"organization": {"include": {"zendesk": True}}},
+    )
+    if slack is None:
+        return None
+    organization = slack.organization
+    return Tenant(slack=slack, organization=organization, zendesk=organization.zendesk if organization else None)
+
+
+async def get_tenant(team_id: str) -> Tenant | None:
+    if not team_id:
+        return None
+    version = await get_tenant_version()
+    tenant = tenant_cache.get(team_id, version)
+    if tenant is not None:
+        return tenant
+    tenant = await fetch_tenant(team_id)
+    # unknown workspaces are not cached so that a new installation is picked up straight away
+    if tenant is not None:
+        tenant_cache.set(team_id, tenant, version)
+    return tenant
+
+
+async def invalidate_tenants():
+    """Called after a workspace's Slack, Organization or Zendesk configuration has been written"""
+    tenant_cache.clear()
+    try:
+        await get_redis().increment(TENANT_VERSION_KEY)
+    except RedisError as e:
+        logger.warning(f"Could not bump tenant version: {e}")
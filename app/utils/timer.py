@@ -1,4 +1,8 @@
 import asyncio
+import time
+from typing import Awaitable, Dict, TypeVar
+
+T = TypeVar("T")
 
 
 class Timer:
@@ -12,4 +16,27 @@ class Timer:
         await self._callback()
 
     def cancel(self):
-        self._task.cancel()
\ No newline at end of file
+        self._task.cancel()
+
+
+class StageTimings:
+    """Records how long each stage of a pipeline took. Stages that run concurrently are timed independently."""
+
+    def __init__(self):
+        self._started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.durations[name] = time.perf_counter() - start
+
+    def start(self, name: str, awaitable: Awaitable[T]) -> "asyncio.Task[T]":
+        """Runs a stage in the background so that it overlaps with the stages started after it"""
+        return asyncio.create_task(self.run(name, awaitable))
+
+    def summary(self) -> str:
+        stages = ", ".join(f"{name}={duration * 1000:.0f}ms" for name, duration in self.durations.items())
+        return f"total={(time.perf_counter() - self._started) * 1000:.0f}ms, {stages}"
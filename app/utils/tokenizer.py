@@ -0,0 +1,31 @@
+from functools import lru_cache
+from typing import Iterable, List
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """Loads a tiktoken encoding once per process."""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def encode(string: str, encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    return get_encoding(encoding_name).encode(string)
+
+
+def num_tokens_from_text(string: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """Returns the number of tokens in a text string."""
+    return len(encode(string, encoding_name))
+
+
+@lru_cache(maxsize=1024)
+def num_tokens_from_template(string: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """Memoised token count for static prompt text that is sent on every request."""
+    return num_tokens_from_text(string, encoding_name)
+
+
+def num_tokens_from_texts(strings: Iterable[str], encoding_name: str = DEFAULT_ENCODING) -> List[int]:
+    return [len(tokens) for tokens in get_encoding(encoding_name).encode_batch(list(strings))]
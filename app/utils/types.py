@@ -7,6 +7,11 @@ class Profile(NamedTuple):
     email: str
 
 
+class BotIdentity(NamedTuple):
+    bot_id: str
+    user_id: str
+
+
 class ZendeskCredentials(NamedTuple):
     email: str
     token: str
@@ -18,6 +23,15 @@ class ZendeskOAuthCredentials(NamedTuple):
     subdomain: str
 
 
+class Article(NamedTuple):
+    id: int
+    title: str
+    body: str
+    category: str
+    updated_at: str
+    url: str
+
+
 class Message:
     def __init__(self, role: Literal["user", "system", "assistant"], content: str):
         self.role = role
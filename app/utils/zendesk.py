@@ -1,56 +1,151 @@
+import asyncio
+import hashlib
 import os
-from pprint import pprint
+import time
+from functools import partial
+from typing import AsyncIterator, Dict, List, Tuple
 
+import aiohttp
 import openai  # for generating embeddings
 import pandas as pd  # for DataFrames to store article sections and embeddings
 import pinecone
-import tiktoken  # for counting tokens
-from bs4 import BeautifulSoup
 from tqdm.auto import tqdm  # this is our progress bar
 
-# Import the Zenpy Class
-from zenpy import Zenpy
+from app.utils.chunker import Chunk, chunk_articles
+from app.utils.embedding_cache import content_embedding_cache
+from app.utils.embedding_scheduler import EmbeddingScheduler
+from app.utils.types import Article
 
 # GLOBAL VARIABLES
 MAX_INPUT_TOKENS = 8191
 EMBEDDING_MODEL = "text-embedding-ada-002"  # OpenAI's best embeddings as of Apr 2023
 BATCH_SIZE = 1000  # you can submit up to 2048 embedding inputs per request
+EMBEDDING_REQUEST_TIMEOUT = float(os.environ.get("EMBEDDING_REQUEST_TIMEOUT", 60))
 ZENDESK_API_KEY = os.environ["ZENDESK_API_KEY"]
+ZENDESK_MAX_CONCURRENCY = int(os.environ.get("ZENDESK_MAX_CONCURRENCY", 8))
+ZENDESK_MAX_RETRIES = int(os.environ.get("ZENDESK_MAX_RETRIES", 5))
+ZENDESK_REQUEST_TIMEOUT = float(os.environ.get("ZENDESK_REQUEST_TIMEOUT", 30))
+ZENDESK_PAGE_SIZE = 100  # the largest page the help center API serves
 
 
-def fetch_zendesk_sections(zenpy_client: Zenpy):
-    sections = []
-    for section in zenpy_client.help_center.sections():
-        if section.name == "IT Queries":
-            section.name = "IT"
-        else:
-            section.name = "HR"
-        sections.append(section)
-        pass
-    print(f"Sections: {sections}")
-    return sections
+def section_category(section: Dict) -> str:
+    return "IT" if section["name"] == "IT Queries" else "HR"
 
 
-def fetch_all_zendesk_articles(zenpy_client: Zenpy):
-    articles = zenpy_client.help_center.articles()
-    for article in articles:
-        pprint(article)
-        pass
-    return articles
+def to_article(article: Dict, category: str) -> Article:
+    return Article(
+        id=article["id"],
+        title=article["title"],
+        body=article["body"] or "",
+        category=category,
+        updated_at=article["updated_at"],
+        url=article["html_url"],
+    )
 
 
-def fetch_zendesk_articles_by_section(zenpy_client: Zenpy, sections):
-    my_articles = []
-    for _section in sections:
-        category = "IT" if _section.name == "IT" else "HR"
-        print(f"Searching for articles in section {_section.name}")
-        articles = zenpy_client.help_center.sections.articles(section=_section)
-        print(f"Found {len(articles)} articles in section {_section}")
-        for article in articles:
-            # pprint("--------------------------------------------------------------------------------------------------")
-            my_articles.append((article.title, article.body, category))
-            pass
-    return my_articles
+def content_hash(article: Article) -> str:
+    """Changes only when what gets embedded changes, unlike `updated_at` which also moves on metadata edits"""
+    return hashlib.sha256("\x1f".join((article.title, article.body, article.category)).encode()).hexdigest()
+
+
+class ZendeskGuideHarvester(object):
+    """
+    Async client for the Zendesk Help Center API. Every request goes through one pooled HTTP session and a semaphore
+    bounding how many are in flight. A 429 pauses all requests for the Retry-After period Zendesk asks for.
+    """
+
+    def __init__(self, subdomain: str, token: str, max_concurrency: int = ZENDESK_MAX_CONCURRENCY):
+        self.base_url = f"https://{subdomain}.zendesk.com"
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._resume_at = 0.0
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {self.token}"},
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=ZENDESK_REQUEST_TIMEOUT),
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+
+    async def _get(self, url: str, params: Dict | None = None) -> Dict:
+        for attempt in range(ZENDESK_MAX_RETRIES + 1):
+            async with self._semaphore:
+                # wait out a rate limit hit by any request before sending this one
+                await asyncio.sleep(max(0.0, self._resume_at - time.monotonic()))
+                async with self._session.get(url, params=params) as response:
+                    if response.status not in (429, 503) or attempt == ZENDESK_MAX_RETRIES:
+                        response.raise_for_status()
+                        return await response.json()
+                    retry_after = float(response.headers.get("Retry-After", 2 ** attempt))
+                    print(f"Zendesk rate limit hit, retrying in {retry_after}s")
+                    self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+
+    async def _paginate(self, path: str, key: str) -> AsyncIterator[Dict]:
+        url, params = f"{self.base_url}{path}", {"page[size]": ZENDESK_PAGE_SIZE}
+        while url:
+            page = await self._get(url, params)
+            for item in page[key]:
+                yield item
+            # the next link already carries the cursor and page size
+            url = page["links"]["next"] if page.get("meta", {}).get("has_more") else None
+            params = None
+
+    async def sections(self) -> List[Dict]:
+        sections = [section async for section in self._paginate("/api/v2/help_center/sections.json", "sections")]
+        print(f"Sections: {[section['name'] for section in sections]}")
+        return sections
+
+    async def _section_articles(self, section: Dict, queue: asyncio.Queue):
+        print(f"Searching for articles in section {section['name']}")
+        async for article in self._paginate(f"/api/v2/help_center/sections/{section['id']}/articles.json", "articles"):
+            await queue.put(to_article(article, section_category(section)))
+
+    async def articles(self) -> AsyncIterator[Article]:
+        """Yields the articles of every section as they arrive, the sections are fetched concurrently"""
+        # bounded so that fetching pauses when the next stage falls behind
+        queue: asyncio.Queue = asyncio.Queue(maxsize=ZENDESK_PAGE_SIZE * self.max_concurrency)
+        tasks = [asyncio.create_task(self._section_articles(section, queue)) for section in await self.sections()]
+        done = asyncio.gather(*tasks)
+        try:
+            while not (done.done() and queue.empty()):
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait([getter, done], return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            # surface the error of a section that failed
+            await done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def incremental_articles(self, start_time: int) -> Tuple[List[Article], int]:
+        """
+        Returns the articles created or updated since `start_time` from the incremental export, with the export's end
+        time to use as the start time of the next call
+        """
+        categories = {section["id"]: section_category(section) for section in await self.sections()}
+        url = f"{self.base_url}/api/v2/help_center/incremental/articles.json"
+        params, articles, end_time = {"start_time": start_time}, [], start_time
+        while url:
+            page = await self._get(url, params)
+            for article in page["articles"]:
+                if not article.get("draft"):
+                    articles.append(to_article(article, categories.get(article["section_id"], "HR")))
+            end_time = page.get("end_time") or end_time
+            url, params = page.get("next_page"), None
+            # the export keeps returning its last page with no articles once it has caught up
+            if not page["articles"]:
+                break
+        return articles, int(end_time)
 
 
 def create_txt_knowledge_base(articles, path: str):
@@ -64,29 +159,9 @@ def create_txt_knowledge_base(articles, path: str):
         pass
 
 
-def num_tokens_from_text(string: str, encoding_name: str = "cl100k_base") -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
-
-def clean_up_text(articles):
-    cleaned_articles = []
-    for title, body, category in articles:
-        cleaned_body = BeautifulSoup(body, "html.parser").get_text()
-        if (
-            num_tokens_from_text(title.strip() + cleaned_body.strip())
-            > MAX_INPUT_TOKENS
-        ):
-            left = body[:MAX_INPUT_TOKENS]
-            right = body[MAX_INPUT_TOKENS:]
-            cleaned_articles.append((title, left, category))
-            cleaned_articles.append((title, right, category))
-        else:
-            cleaned_articles.append((title, cleaned_body, category))
-    pass
-    return cleaned_articles
+def clean_up_text(articles) -> List[Chunk]:
+    """Strips the markup from articles and splits them on headings and paragraphs into chunks sized by tokens"""
+    return chunk_articles(articles)
 
 
 def print_example_data(articles):
@@ -103,34 +178,48 @@ def print_example_data(articles):
         print("-" * 50)
 
 
-def calculate_embeddings(articles):
-    titles = []
-    content = []
-    categories = []
-    embeddings = []
-    for batch_start in range(0, len(articles), BATCH_SIZE):
-        batch_end = batch_start + BATCH_SIZE
-        batch = articles[batch_start:batch_end]
-        titles.extend([article[0] for article in batch])
-        content.extend([article[1] for article in batch])
-        categories.extend([article[2] for article in batch])
-        batch_text = [title + " " + body for title, body, category in batch]
-        print(f"Batch {batch_start} to {batch_end - 1}")
-        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=batch_text)
-        for i, be in enumerate(response["data"]):
-            assert (
-                i == be["index"]
-            )  # double check embeddings are in same order as input
-        batch_embeddings = [e["embedding"] for e in response["data"]]
-        embeddings.extend(batch_embeddings)
+def create_embeddings(texts: List[str], model: str = EMBEDDING_MODEL) -> List[list]:
+    response = openai.Embedding.create(model=model, input=texts, request_timeout=EMBEDDING_REQUEST_TIMEOUT)
+    for i, be in enumerate(response["data"]):
+        assert (
+            i == be["index"]
+        )  # double check embeddings are in same order as input
+    return [e["embedding"] for e in response["data"]]
+
+
+embedding_scheduler = EmbeddingScheduler(create_embeddings, batch_size=BATCH_SIZE)
+
+
+def calculate_embeddings(chunks: List[Chunk]):
+    texts = [chunk.title + " " + chunk.content for chunk in chunks]
+    # titles are short, so they are estimated at four characters a token rather than tokenized again
+    costs = {text: chunk.tokens + len(chunk.title) // 4 + 1 for text, chunk in zip(texts, chunks)}
+    # chunks embedded before are read from the content cache, only the rest are sent to openai
+    vectors, missing = content_embedding_cache.lookup(EMBEDDING_MODEL, texts)
+    if chunks:
+        hits = len(chunks) - len(missing)
+        print(f"Embedding cache hit rate: {hits / len(chunks):.1%} ({hits}/{len(chunks)})")
+    embedded = {}
+    if missing:
+        # each batch is cached as soon as it completes, so a failed ingestion resumes from the batches left over
+        embedded = embedding_scheduler.run(
+            missing,
+            [costs[text] for text in missing],
+            EMBEDDING_MODEL,
+            on_batch=partial(content_embedding_cache.set_many, EMBEDDING_MODEL),
+        )
+    embeddings = [vector.tolist() if vector is not None else embedded[text] for text, vector in zip(texts, vectors)]
 
     return (
         pd.DataFrame(
             {
-                "titles": titles,
-                "content": content,
-                "categories": categories,
+                "titles": [chunk.title for chunk in chunks],
+                "content": [chunk.content for chunk in chunks],
+                "categories": [chunk.category for chunk in chunks],
                 "embedding": embeddings,
+                # the chunker already counted each chunk's tokens, so prompts are budgeted without re-tokenising
+                "tokens": [chunk.tokens for chunk in chunks],
+                "anchors": [chunk.anchor for chunk in chunks],
             }
         ),
         embeddings,
@@ -152,11 +241,16 @@ def store_embeddings_into_pinecone(
         i_end = min(i + batch_size, len(df))
         batch = df[i : i + batch_size]
         embeddings_batch = batch["embedding"]
-        ids_batch = [str(n) for n in range(i, i_end)]
+        # synced knowledge bases carry a stable id per chunk, full ingestions number their vectors
+        ids_batch = list(batch["ids"]) if "ids" in batch else [str(n) for n in range(i, i_end)]
         # prep metadata and upsert batch
+        # the anchor is the heading a chunk falls under, so an answer can link to the section it came from
+        anchors_batch = batch["anchors"] if "anchors" in batch else [""] * len(batch)
         meta = [
-            {"title": titles, "content": content, "category": categories}
-            for titles, content, categories, embeddings in batch.to_numpy()
+            {"title": titles, "content": content, "category": categories, "tokens": int(tokens), "anchor": anchor}
+            for titles, content, categories, tokens, anchor in zip(
+                batch["titles"], batch["content"], batch["categories"], batch["tokens"], anchors_batch
+            )
         ]
         to_upsert = zip(ids_batch, embeddings_batch, meta)
         # upsert to Pinecone
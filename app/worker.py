@@ -7,13 +7,18 @@ from slack_sdk.models.blocks import ActionsBlock, DividerBlock, ButtonElement
 
 load_dotenv()
 
+import asyncio
 import ssl
 import os
+import json
 import logging
 import time
+from typing import Dict
 from celery import Celery
 from redis.exceptions import ResponseError, RedisError
-from app.redis.client import Redis
+from app.db.prisma_client import prisma
+from app.redis.client import get_redis, get_sync_redis, init_sync_redis, close_sync_redis
+from app.utils.kb_sync import sync_knowledge_base
 from celery.signals import worker_shutdown, celeryd_after_setup, worker_process_init
 
 logger = logging.getLogger(__name__)
@@ -23,6 +28,87 @@ celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:
 celery.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379")
 celery.flower_unauthenticated_api = True
 
+# a conversation's follow-up is due this long after its latest reply
+FOLLOW_UP_DELAY = int(os.environ.get("FOLLOW_UP_DELAY", 300))
+FOLLOW_UP_DEBUG_DELAY = int(os.environ.get("FOLLOW_UP_DEBUG_DELAY", 60))
+# one beat job sweeps every due follow-up, so follow-up latency is at most one sweep interval
+FOLLOW_UP_SWEEP_INTERVAL = float(os.environ.get("FOLLOW_UP_SWEEP_INTERVAL", 15))
+FOLLOW_UP_SWEEP_BATCH = int(os.environ.get("FOLLOW_UP_SWEEP_BATCH", 100))
+# how long a sweep has to send a claimed follow-up before another sweep may claim it again
+FOLLOW_UP_LEASE = int(os.environ.get("FOLLOW_UP_LEASE", 300))
+FOLLOW_UP_RETRY_DELAY = int(os.environ.get("FOLLOW_UP_RETRY_DELAY", 60))
+FOLLOW_UP_MAX_ATTEMPTS = int(os.environ.get("FOLLOW_UP_MAX_ATTEMPTS", 5))
+# sorted set of conversation ids scored by the unix time their follow-up is due, with the follow-up payloads in a hash
+FOLLOW_UP_QUEUE_KEY = "follow_ups"
+FOLLOW_UP_PAYLOAD_KEY = "follow_up_payloads"
+# sorted set of the follow-ups being sent, scored by the unix time their claim expires
+FOLLOW_UP_IN_FLIGHT_KEY = "follow_ups_in_flight"
+CELERY_VISIBILITY_TIMEOUT = int(os.environ.get("CELERY_VISIBILITY_TIMEOUT", 3600))
+celery.conf.broker_transport_options = {"visibility_timeout": CELERY_VISIBILITY_TIMEOUT}
+# acknowledge once the task has run so a sweep interrupted by a worker restart is redelivered, the follow-ups it had
+# claimed are sent again once their lease expires
+celery.conf.task_acks_late = True
+celery.conf.task_reject_on_worker_lost = True
+# knowledge bases connected to zendesk guide are brought up to date this often, each sync only embeds what changed
+KB_SYNC_INTERVAL = float(os.environ.get("KB_SYNC_INTERVAL", 60 * 60))
+celery.conf.beat_schedule = {
+    "sweep-follow-ups": {
+        "task": "app.worker.sweep_follow_ups",
+        "schedule": FOLLOW_UP_SWEEP_INTERVAL,
+        # a sweep that is still queued when the next one is due is dropped instead of piling up
+        "options": {"expires": FOLLOW_UP_SWEEP_INTERVAL},
+    },
+    "sync-knowledge-bases": {
+        "task": "app.worker.sync_knowledge_bases",
+        "schedule": KB_SYNC_INTERVAL,
+        "options": {"expires": KB_SYNC_INTERVAL},
+    },
+}
+
+# claims up to ARGV[2] conversations due by ARGV[1] together with their payloads, moving them to the in-flight set
+# until ARGV[3] so each follow-up is sent by one sweep even when sweeps overlap. Claims that expired without being
+# acknowledged, because the sweep sending them died, are due again.
+CLAIM_DUE_FOLLOW_UPS_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, convo_id in ipairs(expired) do
+    redis.call("ZADD", KEYS[1], "NX", ARGV[1], convo_id)
+    redis.call("ZREM", KEYS[2], convo_id)
+end
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+if #due == 0 then
+    return {}
+end
+local payloads = redis.call("HMGET", KEYS[3], unpack(due))
+local result = {}
+for i, convo_id in ipairs(due) do
+    redis.call("ZREM", KEYS[1], convo_id)
+    redis.call("ZADD", KEYS[2], ARGV[3], convo_id)
+    result[#result + 1] = convo_id
+    result[#result + 1] = payloads[i]
+end
+return result
+"""
+
+# drops a sent follow-up, a conversation rescheduled while its follow-up was being sent keeps its new payload
+ACK_FOLLOW_UP_SCRIPT = """
+redis.call("ZREM", KEYS[1], ARGV[1])
+if not redis.call("ZSCORE", KEYS[2], ARGV[1]) then
+    redis.call("HDEL", KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# puts a follow-up that could not be sent back in the queue at ARGV[2] with the payload ARGV[3], unless the
+# conversation was rescheduled in the meantime
+RELEASE_FOLLOW_UP_SCRIPT = """
+redis.call("ZREM", KEYS[1], ARGV[1])
+if not redis.call("ZSCORE", KEYS[2], ARGV[1]) then
+    redis.call("HSET", KEYS[3], ARGV[1], ARGV[3])
+    redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+end
+return 1
+"""
+
 if os.environ.get("DOPPLER_ENVIRONMENT") == "prd":
     celery.conf.redis_backend_use_ssl = {
         'ssl_cert_reqs': ssl.CERT_NONE
@@ -41,21 +127,25 @@ def capture_worker_name(sender, instance, **kwargs):
 @worker_process_init.connect
 def configure_worker(**kwargs):
     print("Initialising Prisma")
+    # one pooled redis client per worker process, shared by every task it runs
+    init_sync_redis()
 
 
 @worker_shutdown.connect
 def shutdown_worker(**kwargs):
     print("Shutting down Prisma")
+    close_sync_redis()
 
 
-def expired_conversation_callback(convo_id, issue_id, token, channel):
+def expired_conversation_callback(convo_id, issue_id, token, channel, client: WebClient | None = None):
+    """Posts the resolution prompt for a conversation. Returns None if it could not be sent and should be retried."""
     try:
         print("executing task....")
-        r = Redis()
+        r = get_sync_redis()
         convo = r.get_value(convo_id)
         # if the conversation exists in redis cache, set resolved status to unresolved
         if convo:
-            client = WebClient(token=token)
+            client = client or WebClient(token=token)
             response = client.chat_postMessage(channel=channel, text="Has this issue been resolved?")
             # Define the interactive message
             # Create an interactivity pointer for the "Yes" button
@@ -83,6 +173,9 @@ def expired_conversation_callback(convo_id, issue_id, token, channel):
     except (ResponseError, RedisError) as e:
         logger.error(f"Error retrieving conversation from Redis: {e}")
         return None  # or any other default value you want to return
+    except SlackApiError as e:
+        logger.error(f"Error sending follow-up for {convo_id}: {e}")
+        return None
 
 
 @celery.task()
@@ -90,8 +183,110 @@ def adding_task(x, y):
     return x + y
 
 
+def _ack_follow_up(r, convo_id: str):
+    r.client.eval(ACK_FOLLOW_UP_SCRIPT, 3, FOLLOW_UP_IN_FLIGHT_KEY, FOLLOW_UP_QUEUE_KEY, FOLLOW_UP_PAYLOAD_KEY, convo_id)
+
+
+def _release_follow_up(r, convo_id: str, follow_up: Dict):
+    attempts = follow_up.get("attempts", 0) + 1
+    if attempts >= FOLLOW_UP_MAX_ATTEMPTS:
+        logger.error(f"Giving up on the follow-up for {convo_id} after {attempts} attempts")
+        _ack_follow_up(r, convo_id)
+        return
+    r.client.eval(
+        RELEASE_FOLLOW_UP_SCRIPT, 3, FOLLOW_UP_IN_FLIGHT_KEY, FOLLOW_UP_QUEUE_KEY, FOLLOW_UP_PAYLOAD_KEY, convo_id,
+        time.time() + FOLLOW_UP_RETRY_DELAY, json.dumps({**follow_up, "attempts": attempts})
+    )
+
+
 @celery.task()
-def create_task(convo_id: str, issue_id: str, token: str, channel: str, debug: bool = False):
-    time.sleep(60 if debug else 300)
-    expired_conversation_callback(convo_id, issue_id, token, channel)
-    return {"message": "Success"}
+def sweep_follow_ups():
+    """
+    Sends the follow-up for every conversation whose deadline has passed. Due conversations are claimed in batches
+    and each workspace's follow-ups go through one Slack client. A follow-up is only removed once it has been sent,
+    one that fails is retried after FOLLOW_UP_RETRY_DELAY and one whose sweep died is retried when its lease expires.
+    """
+    r = get_sync_redis()
+    clients: Dict[str, WebClient] = {}
+    sent = failed = 0
+    while True:
+        now = time.time()
+        try:
+            claimed = r.client.eval(
+                CLAIM_DUE_FOLLOW_UPS_SCRIPT, 3, FOLLOW_UP_QUEUE_KEY, FOLLOW_UP_IN_FLIGHT_KEY, FOLLOW_UP_PAYLOAD_KEY,
+                now, FOLLOW_UP_SWEEP_BATCH, now + FOLLOW_UP_LEASE
+            )
+        except (ResponseError, RedisError) as e:
+            logger.error(f"Error claiming due follow-ups: {e}")
+            break
+        for convo_id, payload in zip(claimed[::2], claimed[1::2]):
+            convo_id = _decode(convo_id)
+            try:
+                if payload is None:
+                    _ack_follow_up(r, convo_id)
+                    continue
+                follow_up = json.loads(payload)
+                token = follow_up["token"]
+                if token not in clients:
+                    clients[token] = WebClient(token=token)
+                try:
+                    result = expired_conversation_callback(
+                        convo_id, follow_up["issue_id"], token, follow_up["channel"], clients[token]
+                    )
+                except Exception as e:
+                    logger.error(f"Error sending follow-up for {convo_id}: {e}")
+                    result = None
+                if result is None:
+                    _release_follow_up(r, convo_id, follow_up)
+                    failed += 1
+                else:
+                    _ack_follow_up(r, convo_id)
+                    sent += 1
+            except (ResponseError, RedisError) as e:
+                # the claim expires and the follow-up is picked up again by a later sweep
+                logger.error(f"Error settling follow-up for {convo_id}: {e}")
+        if len(claimed) < 2 * FOLLOW_UP_SWEEP_BATCH:
+            break
+    return {"message": "Success", "sent": sent, "failed": failed}
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def list_guide_integrations():
+    await prisma.connect()
+    try:
+        return await prisma.zendesk.find_many(where={"guide": True, "active": True}, include={"organization": True})
+    finally:
+        await prisma.disconnect()
+
+
+@celery.task()
+def sync_knowledge_bases():
+    """Queues an incremental knowledge base sync for every organization with zendesk guide connected"""
+    integrations = asyncio.run(list_guide_integrations())
+    for zendesk in integrations:
+        if zendesk.organization and zendesk.organization.slug:
+            sync_knowledge_base_task.delay(zendesk.subdomain, zendesk.access_token, zendesk.organization.slug)
+    return {"message": "Success", "queued": len(integrations)}
+
+
+@celery.task()
+def sync_knowledge_base_task(subdomain: str, token: str, namespace: str):
+    return asyncio.run(sync_knowledge_base(subdomain, token, namespace))
+
+
+async def schedule_follow_up(convo_id: str, issue_id: str, token: str, channel: str, debug: bool = False) -> str:
+    """
+    Schedules the "Has this issue been resolved?" follow-up for a conversation, replacing any follow-up already
+    scheduled for it. Rescheduling moves the conversation's deadline in the follow-up queue, no task is enqueued.
+    Returns the id the follow-up is tracked by.
+    """
+    delay = FOLLOW_UP_DEBUG_DELAY if debug else FOLLOW_UP_DELAY
+    payload = json.dumps({"issue_id": issue_id, "token": token, "channel": channel})
+    async with get_redis().client.pipeline(transaction=True) as pipe:
+        pipe.hset(FOLLOW_UP_PAYLOAD_KEY, convo_id, payload)
+        pipe.zadd(FOLLOW_UP_QUEUE_KEY, {convo_id: time.time() + delay})
+        await pipe.execute()
+    return convo_id